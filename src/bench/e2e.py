@@ -0,0 +1,174 @@
+""" Сквозной нагрузочный прогон настоящего ``Manager`` против ``FakeTelegramServer``.
+
+    Бот работает как в продакшене - long polling, общая очередь отправки, отложенные ответы, -
+    но Bot API заменён локальным сервером с настраиваемой задержкой, ошибками 500 и 429.
+    ``--users`` пользователей одновременно шлют команды из ``--commands`` по кругу, следующая
+    команда уходит после ответа на предыдущую. Команда считается выполненной, когда бот
+    отправил в этот чат текстовое сообщение (кубики ответом не считаются).
+
+    Отчёт: время от команды до ответа с точки зрения клиента, пропускная способность, таймауты,
+    время обработчиков на стороне бота, повторы и ошибки очереди отправки, число внесённых ошибок.
+
+    Запуск::
+
+        python -m src.bench.e2e --users 200 --duration 30 --latency-ms 50 --flood-rate 0.01
+"""
+import argparse
+import asyncio
+import logging
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from src.bench.fake_telegram import FakeTelegramServer
+from src.bench.utils import format_ms, percentiles
+from src.bot import Manager
+from src.constants import COMMAND_GAME_LEADERS, COMMAND_ROLL, COMMAND_ROUND_LEADERS
+from src.utils.latency import format_percentiles
+
+
+DEFAULT_COMMANDS = [f'/{COMMAND_ROLL}', f'/{COMMAND_ROUND_LEADERS}', f'/{COMMAND_GAME_LEADERS}']
+
+
+async def start_bot(server: FakeTelegramServer, base_path: str, **kwargs) -> Tuple[Manager, asyncio.Task]:
+    """Запустить бота в режиме polling против ``server``, как ``Manager.run``, но на текущем event loop."""
+    m = Manager(token='123456:e2e', api_server=server.api_server, base_path=base_path, **kwargs)
+    m.set_up_commands()
+    await m.on_startup(dispatcher=m.dispatcher)
+    polling = asyncio.ensure_future(m.dispatcher.start_polling(timeout=1))
+    # Иначе ``stop_bot`` может остановить polling раньше, чем он начнётся, и ждать его вечно
+    while not m.dispatcher.is_polling():
+        await asyncio.sleep(0.01)
+    return m, polling
+
+
+async def stop_bot(m: Manager, polling: asyncio.Task):
+    m.dispatcher.stop_polling()
+    await asyncio.gather(polling, return_exceptions=True)
+    await m.on_shutdown(dispatcher=m.dispatcher)
+    await (await m.bot.get_session()).close()
+
+
+async def run(users: int, duration: float, commands: List[str], latency_ms: float, jitter_ms: float,
+              error_rate: float, flood_rate: float, timeout: float, roll_delay: float,
+              global_rate: float = None, chat_rate: float = None, seed: int = 0) -> Dict[str, object]:
+    server = FakeTelegramServer(
+        latency=latency_ms / 1000,
+        jitter=jitter_ms / 1000,
+        error_rate=error_rate,
+        flood_rate=flood_rate,
+        seed=seed,
+    )
+    await server.start()
+
+    # Ответ на команду: ждущий клиент этого чата
+    waiters: Dict[int, asyncio.Future] = {}
+
+    def on_send(method: str, chat_id: int, message: dict):
+        future = waiters.get(chat_id)
+        if method == 'sendmessage' and future is not None and not future.done():
+            future.set_result(None)
+
+    server.on_send = on_send
+
+    with tempfile.TemporaryDirectory() as tmp:
+        m, polling = await start_bot(server=server, base_path=tmp, roll_animation_delay=roll_delay)
+        if global_rate is not None:
+            m.sender.global_rate = global_rate
+        if chat_rate is not None:
+            m.sender.chat_rate = chat_rate
+
+        e2e = []
+        by_command: Dict[str, List[float]] = defaultdict(list)
+        timeouts = 0
+        deadline = time.perf_counter() + duration
+
+        async def user(chat_id: int):
+            nonlocal timeouts
+            i = chat_id
+            while time.perf_counter() < deadline:
+                text = commands[i % len(commands)]
+                i += 1
+                future = asyncio.get_event_loop().create_future()
+                waiters[chat_id] = future
+                t0 = time.perf_counter()
+                server.push_message(chat_id=chat_id, text=text)
+                try:
+                    await asyncio.wait_for(future, timeout=timeout)
+                except asyncio.TimeoutError:
+                    timeouts += 1
+                    continue
+                dt = time.perf_counter() - t0
+                e2e.append(dt)
+                by_command[text].append(dt)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*[user(chat_id=10 ** 9 + i) for i in range(users)])
+        elapsed = time.perf_counter() - t0
+
+        await stop_bot(m=m, polling=polling)
+    await server.close()
+
+    return {
+        'users': users,
+        'elapsed': elapsed,
+        'completed': len(e2e),
+        'throughput': len(e2e) / elapsed,
+        'timeouts': timeouts,
+        'e2e': percentiles(e2e),
+        'by_command': {k: percentiles(v) for k, v in by_command.items()},
+        'handlers': {k: rec.percentiles() for k, rec in m.func_latency.items()},
+        'sender': {'sent': m.sender.sent, 'retried': m.sender.retried, 'failed': m.sender.failed},
+        'injected': {'errors': server.errors, 'floods': server.floods},
+        'calls': dict(server.calls),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end bot benchmark against a fake Bot API.')
+    parser.add_argument('--users', type=int, default=100, help='simultaneous users')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds')
+    parser.add_argument('--commands', nargs='+', default=DEFAULT_COMMANDS, help='commands each user cycles through')
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='Bot API response time for sends')
+    parser.add_argument('--jitter-ms', type=float, default=10.0, help='random extra response time')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of sends answered with 500')
+    parser.add_argument('--flood-rate', type=float, default=0.0, help='share of sends answered with 429')
+    parser.add_argument('--timeout', type=float, default=10.0, help='seconds to wait for a reply')
+    parser.add_argument('--roll-delay', type=float, default=0.0, help='dice animation delay before the result')
+    parser.add_argument('--global-rate', type=float, help='override the outbound messages/sec limit')
+    parser.add_argument('--chat-rate', type=float, help='override the per-chat messages/sec limit')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # Логи каждого сообщения бота и предупреждения о 429 искажают замер
+    logging.getLogger().setLevel(logging.ERROR)
+
+    res = asyncio.get_event_loop().run_until_complete(run(
+        users=args.users,
+        duration=args.duration,
+        commands=args.commands,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        flood_rate=args.flood_rate,
+        timeout=args.timeout,
+        roll_delay=args.roll_delay,
+        global_rate=args.global_rate,
+        chat_rate=args.chat_rate,
+        seed=args.seed,
+    ))
+    print(f'{res["completed"]} commands in {res["elapsed"]:.2f} sec, {res["throughput"]:.0f} commands/sec')
+    print(f'timeouts: {res["timeouts"]}')
+    print(f'e2e: {format_ms(res["e2e"])}')
+    for command, stats in sorted(res['by_command'].items()):
+        print(f'  {command}: {format_ms(stats)}')
+    print('handlers:')
+    for fn, stats in sorted(res['handlers'].items()):
+        print(f'  {fn}: {format_percentiles(stats)}')
+    print(f'sender: {res["sender"]}')
+    print(f'injected: {res["injected"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+""" Локальная замена Telegram Bot API для нагрузочных прогонов без сети.
+
+    Поддерживает методы, которыми пользуется бот: ``getUpdates`` (long polling), ``sendMessage``,
+    ``sendDice``, ``editMessageText``, а на остальные (``getMe``, ``deleteWebhook``, ...) отвечает успехом. Ответам
+    на отправку можно добавить задержку, долю ошибок 500 и долю ответов 429 с ``retry_after``.
+
+    Подключение бота::
+
+        server = FakeTelegramServer(latency=0.05, flood_rate=0.01)
+        await server.start()
+        bot = Bot(token='123456:fake', server=server.api_server)
+"""
+import asyncio
+import json
+import random
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional
+
+from aiogram.bot.api import TelegramAPIServer
+from aiohttp import web
+
+
+SEND_METHODS = {'sendmessage', 'senddice', 'editmessagetext'}
+
+
+class FakeTelegramServer:
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, flood_rate: float = 0.0,
+                 retry_after: int = 1, seed: int = None, host: str = '127.0.0.1', port: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.host = host
+        self.port = port
+        self.random = random.Random(seed)
+
+        self.updates: List[dict] = []
+        self._update_id = 0
+        self._message_id = 0
+        self._new_updates: Optional[asyncio.Event] = None
+        self._runner: Optional[web.AppRunner] = None
+        # Вызывается на каждое успешно отправленное ботом сообщение: (метод, chat_id, сообщение)
+        self.on_send: Optional[Callable[[str, int, dict], None]] = None
+
+        # Метрики
+        self.calls: Dict[str, int] = defaultdict(int)
+        # Параметры последнего ``setWebhook``
+        self.webhook: Dict[str, str] = {}
+        self.errors = 0
+        self.floods = 0
+
+    @property
+    def base_url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    @property
+    def api_server(self) -> TelegramAPIServer:
+        return TelegramAPIServer.from_base(self.base_url)
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        return app
+
+    async def start(self):
+        self._new_updates = asyncio.Event()
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host=self.host, port=self.port).start()
+        self.port = self._runner.addresses[0][1]
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def push_message(self, chat_id: int, text: str, chat_type: str = 'private') -> int:
+        """Сообщение от пользователя ``chat_id`` боту; вернуть ``update_id``."""
+        self._update_id += 1
+        self._message_id += 1
+        user = {'id': chat_id, 'is_bot': False, 'first_name': f'User {chat_id}'}
+        message = {
+            'message_id': self._message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': chat_type, 'first_name': user['first_name']},
+            'from': user,
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        self.updates.append({'update_id': self._update_id, 'message': message})
+        self._new_updates.set()
+        return self._update_id
+
+    def push_callback(self, chat_id: int, message_id: int, data: str) -> int:
+        """Нажатие кнопки ``data`` под сообщением бота ``message_id`` в чате пользователя ``chat_id``."""
+        self._update_id += 1
+        user = {'id': chat_id, 'is_bot': False, 'first_name': f'User {chat_id}'}
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private', 'first_name': user['first_name']},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'Fake'},
+        }
+        self.updates.append({'update_id': self._update_id, 'callback_query': {
+            'id': str(self._update_id),
+            'from': user,
+            'message': message,
+            'chat_instance': str(chat_id),
+            'data': data,
+        }})
+        self._new_updates.set()
+        return self._update_id
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method'].lower()
+        params = dict(await request.post())
+        self.calls[method] += 1
+
+        if method == 'getupdates':
+            return self.ok(await self.get_updates(params=params))
+
+        if method in SEND_METHODS:
+            delay = self.latency + self.random.random() * self.jitter
+            if delay > 0:
+                await asyncio.sleep(delay)
+            roll = self.random.random()
+            if roll < self.flood_rate:
+                self.floods += 1
+                return self.fail(
+                    status=429,
+                    description=f'Too Many Requests: retry after {self.retry_after}',
+                    parameters={'retry_after': self.retry_after},
+                )
+            if roll < self.flood_rate + self.error_rate:
+                self.errors += 1
+                return self.fail(status=500, description='Internal Server Error: injected')
+
+        if method == 'sendmessage':
+            return self.ok(self.sent(method=method, params=params, text=params.get('text', ''),
+                                     **self.markup(params=params)))
+        if method == 'editmessagetext':
+            return self.ok(self.sent(method=method, params=params, text=params.get('text', ''),
+                                     message_id=int(params['message_id']), **self.markup(params=params)))
+        if method == 'senddice':
+            return self.ok(self.sent(method=method, params=params, dice={
+                'emoji': params.get('emoji', '🎲'),
+                'value': self.random.randint(1, 6),
+            }))
+        if method == 'setwebhook':
+            self.webhook = params
+            return self.ok(True)
+        if method == 'getme':
+            return self.ok({'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'})
+        return self.ok(True)
+
+    async def get_updates(self, params: dict) -> List[dict]:
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+
+        # Подтверждённые обновления больше не нужны
+        if offset > 0:
+            self.updates = [u for u in self.updates if u['update_id'] >= offset]
+        if not self.updates and timeout > 0:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:limit]
+
+    @staticmethod
+    def markup(params: dict) -> dict:
+        if not params.get('reply_markup'):
+            return {}
+        return {'reply_markup': json.loads(params['reply_markup'])}
+
+    def sent(self, method: str, params: dict, message_id: int = None, **fields) -> dict:
+        if message_id is None:
+            self._message_id += 1
+            message_id = self._message_id
+        chat_id = int(params['chat_id'])
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'},
+            **fields,
+        }
+        if self.on_send is not None:
+            self.on_send(method, chat_id, message)
+        return message
+
+    @staticmethod
+    def ok(result) -> web.Response:
+        return web.json_response({'ok': True, 'result': result})
+
+    @staticmethod
+    def fail(status: int, description: str, parameters: dict = None) -> web.Response:
+        data = {'ok': False, 'error_code': status, 'description': description}
+        if parameters:
+            data['parameters'] = parameters
+        return web.json_response(data, status=status)
@@ -0,0 +1,298 @@
+""" Нагрузочный стенд ``LeaderBoard`` и ``Storage`` на синтетических игроках.
+
+    Для каждой операции и размера таблицы считает пропускную способность, перцентили времени
+    одной операции и пиковую память (отдельным прогоном под ``tracemalloc``). Подготовка данных
+    в замер не входит. Таблицы создаются с ``dry_run``, файлы пишутся во временный каталог,
+    поэтому стенд работает без сети и не трогает данные бота.
+
+    Результаты сохраняются в JSON, два таких файла можно сравнить::
+
+        python -m src.bench.leaderboard run --sizes 1000 10000 100000 --out base.json
+        python -m src.bench.leaderboard run --sizes 1000 10000 100000 --out new.json
+        python -m src.bench.leaderboard compare base.json new.json --threshold 0.1
+"""
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+from src.bench.utils import percentiles
+from src.leaderboard import BoardIndex, LeaderBoard, LeaderItem
+from src.utils.storage import FORMAT_BIN, FORMAT_JSON, Storage
+
+
+# Сколько запросов позиции делать в ``abs_stats``
+STATS_SAMPLE = 10000
+
+
+def make_items(size: int, seed: int = 0) -> List[LeaderItem]:
+    """Игроки с результатом как у трёх бросков кеглей."""
+    rnd = random.Random(seed)
+    now = time.time()
+    return [
+        LeaderItem(
+            chat_id=10 ** 9 + i,
+            full_name=f'User {i}',
+            score=rnd.randint(1, 6) * rnd.randint(1, 6) * rnd.randint(1, 6),
+            created_at=now - rnd.random() * 3600,
+        )
+        for i in range(size)
+    ]
+
+
+def fill_round(board: LeaderBoard, items: List[LeaderItem]):
+    for item in items:
+        board.add_result(chat_id=item.chat_id, full_name=item.full_name, score=item.score)
+
+
+def timed(func: Callable, *args) -> float:
+    t0 = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - t0
+
+
+# Операция: подготовка (размер -> состояние, не замеряется) и прогон (состояние -> время каждой операции)
+Operation = Tuple[Callable[[int], Any], Callable[[Any], List[float]]]
+
+
+def setup_board(size: int) -> Tuple[LeaderBoard, List[LeaderItem]]:
+    return LeaderBoard(dry_run=True), make_items(size=size)
+
+
+def run_add_result(state) -> List[float]:
+    board, items = state
+    res = []
+    for item in items:
+        t0 = time.perf_counter()
+        board.add_result(chat_id=item.chat_id, full_name=item.full_name, score=item.score)
+        res.append(time.perf_counter() - t0)
+    return res
+
+
+def setup_new_round(size: int) -> LeaderBoard:
+    """Суточная таблица и текущий раунд на ``size`` игроков."""
+    board, items = setup_board(size=size)
+    fill_round(board=board, items=items)
+    board.new_round()
+    fill_round(board=board, items=make_items(size=size, seed=1))
+    return board
+
+
+def run_new_round(board: LeaderBoard) -> List[float]:
+    return [timed(board.new_round)]
+
+
+def setup_abs_stats(size: int) -> Tuple[LeaderBoard, List[int]]:
+    board = setup_new_round(size=size)
+    board.new_round()
+    chat_ids = [item.chat_id for item in random.Random(2).sample(make_items(size=size), min(size, STATS_SAMPLE))]
+    return board, chat_ids
+
+
+def run_abs_stats(state) -> List[float]:
+    board, chat_ids = state
+    res = []
+    for chat_id in chat_ids:
+        t0 = time.perf_counter()
+        board.total_stats(chat_id=chat_id)
+        res.append(time.perf_counter() - t0)
+    return res
+
+
+def setup_dump_prepare(size: int):
+    """Таблицы на ``size`` игроков, которым пора сжимать журнал, то есть писать полный снимок."""
+    tmp = tempfile.TemporaryDirectory()
+    board = LeaderBoard(journal=True, base_path=tmp.name, fmt=FORMAT_BIN)
+    fill_round(board=board, items=make_items(size=size))
+    board.new_round()
+    fill_round(board=board, items=make_items(size=size, seed=1))
+    for storage in (board.last_game_storage, board.last_day_storage):
+        storage.compact_every = 1
+    return tmp, board
+
+
+def run_dump_prepare(state) -> List[float]:
+    """Только подготовка сохранения - то, что выполняется на event loop; запись уходит в executor."""
+    tmp, board = state
+    with tmp:
+        t0 = time.perf_counter()
+        job = board.begin_dump()
+        res = [time.perf_counter() - t0]
+        job()
+        board.close()
+        return res
+
+
+def make_storage_ops(fmt: str) -> Tuple[Operation, Operation]:
+    def setup_save(size: int):
+        tmp = tempfile.TemporaryDirectory()
+        storage = Storage(filename='bench', klass=LeaderItem, base_path=tmp.name, fmt=fmt)
+        return tmp, storage, make_items(size=size)
+
+    def run_save(state) -> List[float]:
+        tmp, storage, items = state
+        with tmp:
+            return [timed(storage.save, items)]
+
+    def setup_load(size: int):
+        tmp, storage, items = setup_save(size=size)
+        storage.save(objs=items)
+        return tmp, storage
+
+    def run_load(state) -> List[float]:
+        tmp, storage = state
+        with tmp:
+            # Бинарный снимок читается лениво, поэтому замеряется и построение таблицы из него
+            return [timed(lambda: BoardIndex(storage.load()))]
+
+    return (setup_save, run_save), (setup_load, run_load)
+
+
+_SAVE_JSON, _LOAD_JSON = make_storage_ops(fmt=FORMAT_JSON)
+_SAVE_BIN, _LOAD_BIN = make_storage_ops(fmt=FORMAT_BIN)
+
+OPERATIONS: Dict[str, Operation] = {
+    'add_result': (setup_board, run_add_result),
+    'new_round': (setup_new_round, run_new_round),
+    'abs_stats': (setup_abs_stats, run_abs_stats),
+    'dump_prepare': (setup_dump_prepare, run_dump_prepare),
+    'storage_save_json': _SAVE_JSON,
+    'storage_load_json': _LOAD_JSON,
+    'storage_save_bin': _SAVE_BIN,
+    'storage_load_bin': _LOAD_BIN,
+}
+
+
+def measure(name: str, size: int, repeat: int = 1, memory: bool = True) -> Dict[str, Any]:
+    setup, run = OPERATIONS[name]
+    durations = []
+    for _ in range(repeat):
+        state = setup(size)
+        gc.collect()
+        durations.extend(run(state))
+        del state
+
+    res = {
+        'op': name,
+        'size': size,
+        'ops': len(durations),
+        'seconds': sum(durations),
+        'throughput': len(durations) / sum(durations) if sum(durations) else 0.0,
+        **percentiles(durations),
+    }
+    if memory:
+        state = setup(size)
+        gc.collect()
+        tracemalloc.start()
+        run(state)
+        res['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return res
+
+
+def run_suite(sizes: List[int], ops: List[str], repeat: int = 1, memory: bool = True,
+              log: Callable[[str], None] = None) -> Dict[str, Any]:
+    results = []
+    for size in sizes:
+        for name in ops:
+            res = measure(name=name, size=size, repeat=repeat, memory=memory)
+            results.append(res)
+            if log is not None:
+                log(format_result(res))
+    return {
+        'meta': {
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'created_at': time.time(),
+        },
+        'results': results,
+    }
+
+
+def format_result(res: Dict[str, Any]) -> str:
+    peak = f'{res["peak_bytes"] / 2 ** 20:9.1f} MiB' if 'peak_bytes' in res else ''
+    return (
+        f'{res["op"]:>18} {res["size"]:>8} {res["throughput"]:>12.0f} ops/s '
+        f'p50 {res["p50"] * 1000:8.3f} p99 {res["p99"] * 1000:8.3f} max {res["max"] * 1000:8.3f} (ms) {peak}'
+    )
+
+
+# Метрика -> больше значит лучше
+METRICS = {
+    'throughput': True,
+    'p99': False,
+    'peak_bytes': False,
+}
+
+
+def compare(base: Dict[str, Any], new: Dict[str, Any], threshold: float = 0.1) -> List[Dict[str, Any]]:
+    """ Изменения метрик между двумя прогонами для совпадающих (op, size).
+        ``regression`` - метрика стала хуже больше чем на ``threshold``.
+    """
+    old = {(r['op'], r['size']): r for r in base['results']}
+    res = []
+    for r in new['results']:
+        prev = old.get((r['op'], r['size']))
+        if prev is None:
+            continue
+        for metric, higher_better in METRICS.items():
+            if metric not in r or metric not in prev or not prev[metric]:
+                continue
+            change = r[metric] / prev[metric] - 1
+            worse = -change if higher_better else change
+            res.append({
+                'op': r['op'],
+                'size': r['size'],
+                'metric': metric,
+                'base': prev[metric],
+                'new': r[metric],
+                'change': change,
+                'regression': worse > threshold,
+            })
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser(description='LeaderBoard and Storage benchmark.')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = sub.add_parser('run')
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=[10 ** 3, 10 ** 4, 10 ** 5])
+    run_parser.add_argument('--ops', nargs='+', choices=list(OPERATIONS), default=list(OPERATIONS))
+    run_parser.add_argument('--repeat', type=int, default=1, help='runs of single-call operations')
+    run_parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass')
+    run_parser.add_argument('--out', help='JSON file for results')
+
+    compare_parser = sub.add_parser('compare')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='allowed relative slowdown')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        report = run_suite(sizes=args.sizes, ops=args.ops, repeat=args.repeat, memory=not args.no_memory, log=print)
+        if args.out:
+            with open(args.out, 'w') as fp:
+                json.dump(report, fp, indent=2)
+        return
+
+    with open(args.base) as fp:
+        base = json.load(fp)
+    with open(args.new) as fp:
+        new = json.load(fp)
+    rows = compare(base=base, new=new, threshold=args.threshold)
+    for row in rows:
+        mark = 'REGRESSION' if row['regression'] else ''
+        print(f'{row["op"]:>18} {row["size"]:>8} {row["metric"]:>10} {row["change"] * 100:+8.1f}% {mark}')
+    if any(row['regression'] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+""" Сравнение памяти на одну запись таблицы рекордов для разных представлений.
+
+    - ``list``: список обычных ``@dataclass`` записей, как таблица хранилась изначально - базовый вариант,
+      с которым сравниваются остальные (хотя в нём нет ни поиска по chat_id, ни позиции за O(log n));
+    - ``tuple-index``: словарь chat_id -> (ключ-кортеж, запись) + ``RankIndex`` по кортежам,
+      первое представление ``BoardIndex``;
+    - ``columnar``: текущий ``BoardIndex``.
+
+    Строки ``full_name`` создаются заранее и общие для всех вариантов, поэтому в замер не входят.
+
+    Запуск::
+
+        python -m src.bench.memory --sizes 100000 1000000
+"""
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Callable, List
+
+from src.leaderboard import BoardIndex
+from src.utils.ranking import RankIndex
+
+
+@dataclass
+class PlainItem:
+    chat_id: int
+    full_name: str
+    score: int
+    created_at: float
+
+
+def plain_list(rows: List[tuple]):
+    return [PlainItem(chat_id=c, full_name=n, score=s, created_at=t) for c, n, s, t in rows]
+
+
+def tuple_index(rows: List[tuple]):
+    items = {}
+    order = RankIndex()
+    for seq, (chat_id, name, score, created_at) in enumerate(rows):
+        key = (-score, -created_at, seq, chat_id)
+        items[chat_id] = (key, PlainItem(chat_id=chat_id, full_name=name, score=score, created_at=created_at))
+        order.add(key)
+    return items, order
+
+
+def columnar(rows: List[tuple]):
+    board = BoardIndex()
+    for chat_id, name, score, created_at in rows:
+        board.insert(chat_id=chat_id, full_name=name, score=score, created_at=created_at)
+    return board
+
+
+LAYOUTS = {
+    'list': plain_list,
+    'tuple-index': tuple_index,
+    'columnar': columnar,
+}
+
+
+def make_rows(size: int, seed: int = 0) -> List[tuple]:
+    rnd = random.Random(seed)
+    now = time.time()
+    return [
+        (10 ** 9 + i, f'User {i}', rnd.randint(1, 216), now - rnd.random() * 86400)
+        for i in range(size)
+    ]
+
+
+def measure(build: Callable, rows: List[tuple]) -> float:
+    """Прирост памяти на одну запись, байт."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    obj = build(rows)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del obj
+    return (after - before) / len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Leader board memory per entry.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10 ** 5, 10 ** 6])
+    args = parser.parse_args()
+
+    print(f'{"entries":>10} {"layout":>12} {"bytes/entry":>12} {"vs list":>12}')
+    for size in args.sizes:
+        rows = make_rows(size=size)
+        res = {name: measure(build, rows) for name, build in LAYOUTS.items()}
+        for name, per_entry in res.items():
+            print(f'{size:>10} {name:>12} {per_entry:>12.1f} {per_entry / res["list"]:>11.2f}x')
+
+
+if __name__ == '__main__':
+    main()
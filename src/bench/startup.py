@@ -0,0 +1,137 @@
+""" Профиль холодного запуска бота.
+
+    Два замера:
+
+    - импорт ``src.bot`` в отдельном процессе под ``python -X importtime``: общее время
+      и самые дорогие модули;
+    - время до первого ответа: в каталоге с общей таблицей на ``--players`` игроков запускается
+      настоящий ``Manager`` против ``FakeTelegramServer``, команда отправлена ещё до запуска.
+      В отчёт попадают и этапы запуска, которые бот отмечает сам (``Manager.startup``).
+
+    Запуск::
+
+        python -m src.bench.startup --players 100000 --out startup.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+from src.bench.e2e import start_bot, stop_bot
+from src.bench.fake_telegram import FakeTelegramServer
+from src.bench.leaderboard import make_items
+from src.constants import COMMAND_GAME_LEADERS
+from src.leaderboard import LeaderBoard
+from src.utils.logs import format_startup
+from src.utils.storage import FORMAT_BIN
+
+
+def import_profile(module: str = 'src.bot', top: int = 10) -> Dict[str, Any]:
+    """Время импорта ``module`` в новом процессе и ``top`` модулей с наибольшим накопленным временем."""
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=root, capture_output=True, text=True, check=True,
+    )
+    modules = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        # import time: self (us) | cumulative | имя с отступом по вложенности
+        own, cumulative, name = line[len('import time:'):].split('|')
+        modules.append({
+            'module': name.strip(),
+            'self': int(own) / 10 ** 6,
+            'cumulative': int(cumulative) / 10 ** 6,
+            'depth': (len(name) - len(name.lstrip()) - 1) // 2,
+        })
+    total = next(m['cumulative'] for m in modules if m['module'] == module)
+    # Только модули верхнего уровня внутри ``module``, чтобы время не считалось дважды
+    children = [m for m in modules if m['depth'] == 1]
+    return {
+        'module': module,
+        'seconds': total,
+        'top': sorted(children, key=lambda m: m['cumulative'], reverse=True)[:top],
+    }
+
+
+def make_state(base_path: str, players: int):
+    """Общая таблица, как после суток игры: суточные рекорды и текущий раунд."""
+    board = LeaderBoard(journal=True, base_path=base_path, fmt=FORMAT_BIN)
+    for item in make_items(size=players):
+        board.add_result(chat_id=item.chat_id, full_name=item.full_name, score=item.score)
+    board.new_round()
+    for item in make_items(size=players // 10, seed=1):
+        board.add_result(chat_id=item.chat_id, full_name=item.full_name, score=item.score)
+    board.dump_data()
+    board.close()
+
+
+async def first_response(players: int, command: str = f'/{COMMAND_GAME_LEADERS}') -> Dict[str, Any]:
+    server = FakeTelegramServer()
+    await server.start()
+    replied = asyncio.get_event_loop().create_future()
+
+    def on_send(method: str, chat_id: int, message: dict):
+        if method == 'sendmessage' and not replied.done():
+            replied.set_result(None)
+
+    server.on_send = on_send
+
+    with tempfile.TemporaryDirectory() as tmp:
+        t0 = time.perf_counter()
+        make_state(base_path=tmp, players=players)
+        prepared = time.perf_counter() - t0
+
+        # Команда ждёт в очереди обновлений ещё до запуска бота
+        server.push_message(chat_id=1, text=command)
+        t0 = time.perf_counter()
+        m, polling = await start_bot(server=server, base_path=tmp)
+        await asyncio.wait_for(replied, timeout=60)
+        elapsed = time.perf_counter() - t0
+        await m.loading
+        await stop_bot(m=m, polling=polling)
+    await server.close()
+
+    return {
+        'players': players,
+        'prepare_seconds': prepared,
+        'first_response': elapsed,
+        'stages': m.startup,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bot cold start profile.')
+    parser.add_argument('--players', type=int, nargs='+', default=[10 ** 4, 10 ** 5], help='players in the global board')
+    parser.add_argument('--top', type=int, default=10, help='modules to show in the import profile')
+    parser.add_argument('--out', help='JSON file for results')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+
+    imports = import_profile(top=args.top)
+    print(f'import {imports["module"]}: {imports["seconds"] * 1000:.0f} ms')
+    for m in imports['top']:
+        print(f'  {m["module"]:>30} {m["cumulative"] * 1000:8.1f} ms')
+
+    runs: List[Dict[str, Any]] = []
+    for players in args.players:
+        res = asyncio.get_event_loop().run_until_complete(first_response(players=players))
+        runs.append(res)
+        print(f'{players} players: first response in {res["first_response"] * 1000:.0f} ms, '
+              f'stages: {format_startup(res["stages"])}')
+
+    if args.out:
+        with open(args.out, 'w') as fp:
+            json.dump({'imports': imports, 'runs': runs}, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+from typing import Dict, Iterable, List
+
+
+def percentiles(values: Iterable[float], ps: Iterable[float] = (50, 95, 99)) -> Dict[str, float]:
+    """Перцентили по ближайшему рангу и максимум."""
+    data: List[float] = sorted(values)
+    if not data:
+        return {}
+    res = {}
+    for p in ps:
+        inx = min(len(data) - 1, max(0, int(round(p / 100 * len(data))) - 1))
+        res[f'p{p:g}'] = data[inx]
+    res['max'] = data[-1]
+    return res
+
+
+def format_ms(stats: Dict[str, float]) -> str:
+    return ', '.join(f'{k} {v * 1000:.2f}' for k, v in stats.items()) + ' (ms)'
@@ -0,0 +1,121 @@
+""" Нагрузочный стенд webhook режима без выхода в сеть.
+
+    Поднимает ``WebhookServer`` на localhost с синтетическим обработчиком, который ``--work-ms``
+    миллисекунд «работает» на event loop, и отправляет ему ``--updates`` обновлений с
+    ``--concurrency`` одновременными запросами. Отчёт: время ответа webhook (ack), время от
+    отправки до конца обработки (e2e), пропускная способность и число отказов 503.
+
+    Запуск::
+
+        python -m src.bench.webhook --updates 20000 --concurrency 200 --work-ms 5
+"""
+import argparse
+import asyncio
+import time
+from typing import Dict
+
+from aiogram import Bot, Dispatcher, types
+from aiohttp import ClientSession, TCPConnector, web
+
+from src.bench.utils import format_ms, percentiles
+from src.webhook import SECRET_HEADER, WebhookServer
+
+
+def make_update(update_id: int, chat_id: int) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private', 'first_name': f'User {chat_id}'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': f'User {chat_id}'},
+            'text': '/roll3',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        },
+    }
+
+
+async def run(updates: int, concurrency: int, work_ms: float, server_concurrency: int, max_queue: int,
+              retry_delay: float) -> Dict[str, object]:
+    bot = Bot(token='123456:bench')
+    dispatcher = Dispatcher(bot=bot)
+    sent_at: Dict[int, float] = {}
+    e2e = []
+
+    async def handler(message: types.Message):
+        await asyncio.sleep(work_ms / 1000)
+        e2e.append(time.perf_counter() - sent_at[message.message_id])
+
+    dispatcher.register_message_handler(handler)
+
+    server = WebhookServer(dispatcher=dispatcher, secret_token='bench', concurrency=server_concurrency,
+                           max_queue=max_queue)
+    runner = web.AppRunner(server.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, host='127.0.0.1', port=0)
+    await site.start()
+    port = runner.addresses[0][1]
+    url = f'http://127.0.0.1:{port}{server.path}'
+
+    ack = []
+    rejected = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def post(session: ClientSession, update_id: int):
+        nonlocal rejected
+        payload = make_update(update_id=update_id, chat_id=update_id % 10000 + 1)
+        async with semaphore:
+            sent_at[update_id] = time.perf_counter()
+            while True:
+                t0 = time.perf_counter()
+                async with session.post(url, json=payload, headers={SECRET_HEADER: server.secret_token}) as resp:
+                    ack.append(time.perf_counter() - t0)
+                    if resp.status == 200:
+                        return
+                rejected += 1
+                # Как и Telegram, повторить позже
+                await asyncio.sleep(retry_delay)
+
+    t0 = time.perf_counter()
+    async with ClientSession(connector=TCPConnector(limit=concurrency)) as session:
+        await asyncio.gather(*[post(session=session, update_id=i) for i in range(1, updates + 1)])
+    await server.queue.join()
+    elapsed = time.perf_counter() - t0
+
+    await runner.cleanup()
+    return {
+        'updates': updates,
+        'elapsed': elapsed,
+        'throughput': updates / elapsed,
+        'rejected': rejected,
+        'ack': percentiles(ack),
+        'e2e': percentiles(e2e),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Webhook latency and throughput benchmark.')
+    parser.add_argument('--updates', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=100, help='simultaneous HTTP requests')
+    parser.add_argument('--work-ms', type=float, default=2.0, help='handler time per update')
+    parser.add_argument('--server-concurrency', type=int, default=64, help='webhook workers')
+    parser.add_argument('--max-queue', type=int, default=1024, help='webhook queue size before 503')
+    parser.add_argument('--retry-delay', type=float, default=0.05, help='client delay after 503')
+    args = parser.parse_args()
+
+    res = asyncio.get_event_loop().run_until_complete(run(
+        updates=args.updates,
+        concurrency=args.concurrency,
+        work_ms=args.work_ms,
+        server_concurrency=args.server_concurrency,
+        max_queue=args.max_queue,
+        retry_delay=args.retry_delay,
+    ))
+    print(f'{res["updates"]} updates in {res["elapsed"]:.2f} sec, {res["throughput"]:.0f} updates/sec')
+    print(f'rejected (503): {res["rejected"]}')
+    print(f'ack: {format_ms(res["ack"])}')
+    print(f'e2e: {format_ms(res["e2e"])}')
+
+
+if __name__ == '__main__':
+    main()
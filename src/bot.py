@@ -1,29 +1,51 @@
 import logging
+import signal
+import tempfile
 import time
 import os
 from collections import defaultdict
-from functools import wraps
-from typing import Callable
+from functools import partial, wraps
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 import asyncio
-import sentry_sdk
 from aiogram import Bot, Dispatcher, executor, types
+from aiogram.bot.api import TELEGRAM_PRODUCTION, Methods, TelegramAPIServer
 from aiogram.dispatcher.filters import Command, IDFilter
 from aiogram.dispatcher.filters.filters import AndFilter
+from aiogram.utils.exceptions import MessageNotModified
+from aiohttp import web
 
 from src.constants import (
     ADMIN_IDS,
+    COMMAND_EXPORT,
     COMMAND_HELP,
     COMMAND_ROLL,
     COMMAND_START,
     COMMAND_STATS,
     COMMAND_USER,
     COMMAND_GAME_LEADERS,
+    COMMAND_GAME_NEAR,
     COMMAND_ROUND_LEADERS,
+    COMMAND_ROUND_NEAR,
+    NEIGHBOURS_DEFAULT,
+    NEIGHBOURS_MAX,
+    PAGE_CALLBACK,
+    RANGE_MAX,
+    ROLL_ANIMATION_DELAY,
 )
-from src.leaderboard import LeaderBoard
-from src.utils.logs import async_log_exception, pretty_time_delta
+from src.leaderboard import LeaderBoard, LeaderItem, PageCursor
+from src.notifier import RoundNotifier
+from src.registry import BACKEND_MEMORY, GLOBAL_BOARD, BoardRegistry
+from src.utils.archive import RoundArchive, write_csv
+from src.utils.cardinality import WINDOW_DAY, WINDOW_HOUR, WINDOW_LIFETIME, SketchRecord, UniqueCounter
+from src.utils.latency import LatencyRecorder, format_percentiles, prometheus_text, prometheus_values
+from src.utils.logs import async_log_exception, format_startup, init_sentry, pretty_time_delta
 from src.utils.misc import prepare_str
+from src.utils.process import PidLock
+from src.utils.scheduler import DeferredScheduler
+from src.utils.sender import PRIORITY_DICE, PRIORITY_REPLY, PRIORITY_STATS, OutboundDispatcher
+from src.utils.storage import FORMAT_BIN, Storage
+from src.webhook import WebhookServer, secret_from_token
 
 
 logging.basicConfig(
@@ -34,51 +56,291 @@ log = logging.getLogger(__name__)
 
 class Manager:
 
-    def __init__(self, token: str, sentry_token: str = None):
+    def __init__(self, token: str, sentry_token: str = None, backend: str = BACKEND_MEMORY,
+                 api_server: TelegramAPIServer = TELEGRAM_PRODUCTION, base_path: str = None,
+                 roll_animation_delay: float = ROLL_ANIMATION_DELAY, traces_sample_rate: float = 0.1,
+                 notify_rounds: bool = False, checkpoint_interval: float = 1.0, handoff: bool = False):
+        # Время от создания бота до этапов запуска, секунды
+        self._created = time.perf_counter()
+        self.startup: Dict[str, float] = {}
+
         self.bot = Bot(
             token=token,
             timeout=3.0,
+            server=api_server,
         )
         self.dispatcher = Dispatcher(
             bot=self.bot,
         )
-        sentry_sdk.init(
-            dsn=sentry_token,
-            traces_sample_rate=1.0,
+        # Sentry подключается в фоне после запуска, см. ``load_state``
+        self.sentry_token = sentry_token
+        self.traces_sample_rate = traces_sample_rate
+
+        # Game rules: своя таблица для каждого группового чата
+        self.boards = BoardRegistry(
+            base_path=base_path,
+            backend=backend,
+            journal=True,
+            fmt=FORMAT_BIN,
+            archive=True,
         )
 
-        # Game rules
-        self.board = LeaderBoard()
+        # Журналы таблиц дописываются на диск не реже раза в ``checkpoint_interval`` секунд
+        self.checkpoint_interval = checkpoint_interval
+        # Принять работу у запущенного процесса, см. ``take_over``
+        self.handoff = handoff
+        # Сколько секунд при остановке дописывать отложенные ответы и очередь отправки,
+        # меньше TimeoutStopSec в systemd и таймаута передачи работы
+        self.shutdown_timeout = 10.0
+        # Сколько секунд при остановке ждать бросков, кубики которых уже отправляются.
+        # Всё это время следующий процесс ещё не принимает обновления
+        self.rolls_timeout = 2.0
+        self.pid_lock = PidLock(path=os.path.join(self.boards.base_path, 'bot.pid'))
+
+        # Отложенные ответы
+        self.scheduler = DeferredScheduler()
+        self.roll_animation_delay = roll_animation_delay
+        # Все исходящие сообщения
+        self.sender = OutboundDispatcher()
+        # Приём обновлений через webhook, если он включён
+        self.webhook: Optional[WebhookServer] = None
+        self.webhook_secret = secret_from_token(token)
+        # Рассылка итогов раунда участникам, если включена
+        self.notifier: Optional[RoundNotifier] = None
+        if notify_rounds:
+            self.notifier = RoundNotifier(
+                sender=self.sender,
+                send=partial(self.bot.send_message, parse_mode=types.ParseMode.MARKDOWN),
+                round_seconds=self.boards.round_duration.total_seconds(),
+            )
+            self.boards.on_round_closed = self.round_closed
 
         # Runtime stats
         self.counter = 0
-        self.unique_chats = set()
+        # Повторные /roll, отклонённые до отправки кубиков
+        self.rolls_rejected = 0
+        # Уникальные пользователи по часам и суткам, сохраняются вместе с таблицами
+        self.unique = UniqueCounter()
+        self.unique_storage = Storage(filename='unique_chats', klass=SketchRecord, base_path=self.boards.base_path)
         self.started_at = time.time()
         self.func_counter = defaultdict(int)
-        self.func_average_resp_time = defaultdict(float)  # milliseconds
-        self.func_resp_time = defaultdict(list)  # milliseconds
-        self.max_list_size = 1000
+        self.func_latency: Dict[str, LatencyRecorder] = defaultdict(LatencyRecorder)
+
+        # Смена раундов
+        self.rounds: Optional[asyncio.Task] = None
+        # Сохранение журналов между раундами
+        self.checkpoints: Optional[asyncio.Task] = None
+        # Загрузка состояния после запуска
+        self.loading: Optional[asyncio.Task] = None
+        self.mark_startup('init')
+
+    def mark_startup(self, stage: str):
+        """Запомнить, через сколько после создания бота наступил этап запуска (только первый раз)."""
+        if stage not in self.startup:
+            self.startup[stage] = time.perf_counter() - self._created
+
+    async def on_startup(self, dispatcher: Dispatcher):
+        if self.handoff:
+            await self.take_over()
+        elif not self.pid_lock.try_acquire() and self.boards.backend == BACKEND_MEMORY:
+            # Таблицы в памяти двух процессов разойдутся, общую базу SQLite процессы делят штатно
+            log.warning(f'Another bot process holds {self.pid_lock.path}')
+
+        # Обновления принимаются сразу, состояние догружается в фоне
+        self.rounds = asyncio.ensure_future(self.boards.run_rounds())
+        self.loading = asyncio.ensure_future(self.load_state())
+        if self.checkpoint_interval > 0:
+            self.checkpoints = asyncio.ensure_future(self.boards.run_checkpoints(interval=self.checkpoint_interval))
+        self.mark_startup('started')
+
+    async def take_over(self):
+        """ Передача работы при деплое: общая таблица загружается, пока прежний процесс ещё отвечает,
+            потом он останавливается, а то, что он успел записать, дочитывается из журналов.
+            Обновления новый процесс начинает забирать только после этого. Прежний процесс отпускает
+            блокировку сразу после сохранения таблиц, а очередь отправки дописывает уже параллельно
+            (см. ``on_shutdown``), поэтому перерыв - это сохранение и начатые броски, не больше ``rolls_timeout``.
+        """
+        loop = asyncio.get_event_loop()
+        if self.boards.backend == BACKEND_MEMORY:
+            await loop.run_in_executor(None, self.boards.preload, GLOBAL_BOARD)
+        self.mark_startup('warm')
+        await self.pid_lock.take_over()
+        await loop.run_in_executor(None, self.boards.refresh)
+        self.mark_startup('handoff')
+
+    async def load_state(self):
+        """ Медленная часть запуска: sentry и общая таблица. Команды, которым нужна таблица,
+            ждут её загрузки в ``board_for``, остальные отвечают сразу.
+        """
+        loop = asyncio.get_event_loop()
+        if self.sentry_token:
+            await loop.run_in_executor(None, init_sentry, self.sentry_token, self.traces_sample_rate)
+            self.mark_startup('sentry')
+        await self.boards.get_async(chat_id=GLOBAL_BOARD)
+        self.mark_startup('boards')
+
+        # Пользователи, пришедшие до загрузки, уже посчитаны: сохранённые окна добавляются к ним.
+        # Сохранять можно только после загрузки, иначе файл перезапишется без истории
+        records = await loop.run_in_executor(None, self.unique_storage.load)
+        self.unique.merge(UniqueCounter.from_records(records))
+        self.boards.attach(self.begin_dump_unique)
+
+    def begin_dump_unique(self) -> Callable[[], None]:
+        snapshot = self.unique.snapshot()
+
+        def inner():
+            # Файл общий для процессов с одним каталогом (sqlite): объединить с тем, что сохранили они.
+            # Объединение идемпотентно, поэтому свои прошлые сохранения не посчитаются дважды
+            snapshot.merge(UniqueCounter.from_records(self.unique_storage.load()))
+            self.unique_storage.save(objs=snapshot.records())
+
+        return inner
 
     async def on_shutdown(self, dispatcher: Dispatcher):
+        # Новые обновления заберёт следующий процесс
+        dispatcher.stop_polling()
+        if self.loading is not None:
+            await asyncio.gather(self.loading, return_exceptions=True)
+        for task in (self.rounds, self.checkpoints):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        await self.boards.wait_flushed()
+        await self.wait_rolls(timeout=self.rolls_timeout)
+
+        # Сначала таблицы: отправка в группы может занять больше, чем даст systemd до SIGKILL
         log.debug('Dump data')
-        self.board.dump_data()
-
-    def run(self):
+        await self.boards.flush()
+        # Таблицы больше не меняются, и следующий процесс может дочитывать файлы и принимать обновления,
+        # не дожидаясь отправки
+        self.boards.close()
+        self.pid_lock.release()
+
+        log.debug('Send deferred replies')
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.shutdown_timeout
+        try:
+            await asyncio.wait_for(self.drain(), timeout=self.shutdown_timeout)
+        except asyncio.TimeoutError:
+            log.warning('Deferred replies not sent before shutdown timeout')
+        await self.sender.close(timeout=max(0.0, deadline - loop.time()))
+
+    async def wait_rolls(self, timeout: float):
+        """Дождаться бросков, кубики которых уже отправляются, чтобы их результаты попали в сохранение."""
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while any(board.in_flight for board in self.boards.boards.values()):
+            if loop.time() > deadline:
+                log.warning('Rolls not finished before shutdown timeout')
+                return
+            await asyncio.sleep(0.05)
+
+    async def drain(self):
+        """Отправить отложенные ответы и текущую пачку итогов раунда."""
+        await self.scheduler.drain()
+        if self.notifier is not None:
+            await self.notifier.close()
+
+    def run(self, webhook_url: str = None, webhook_path: str = '/webhook', host: str = '0.0.0.0', port: int = 8080,
+            metrics_port: int = None, reuse_port: bool = False, webhook_secret: str = None):
         self.set_up_commands()
 
-        self.board.run_update()
-
+        if webhook_url:
+            return self.run_webhook(url=webhook_url, path=webhook_path, host=host, port=port, reuse_port=reuse_port,
+                                    secret_token=webhook_secret or self.webhook_secret)
+
+        async def on_startup(dispatcher: Dispatcher):
+            await self.on_startup(dispatcher=dispatcher)
+            if metrics_port:
+                # В режиме polling метрики отдаются отдельным http-сервером
+                runner = web.AppRunner(self.make_metrics_app())
+                await runner.setup()
+                await web.TCPSite(runner, host=host, port=metrics_port).start()
+
+        # systemctl stop и передача работы новому процессу: остановиться как по Ctrl+C, с сохранением
+        loop = asyncio.get_event_loop()
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        # Обновления, пришедшие пока бот не работал, не пропускаются: Telegram хранит их до 24 часов
         executor.start_polling(
             dispatcher=self.dispatcher,
-            skip_updates=True,
+            on_startup=on_startup,
             on_shutdown=self.on_shutdown,
         )
 
+    def run_webhook(self, url: str, path: str, host: str, port: int, secret_token: str, reuse_port: bool = False):
+        """ Принимать обновления через webhook вместо long polling.
+
+            С ``reuse_port`` несколько процессов слушают один порт, а ядро делит между ними соединения.
+            Процессам нужна общая таблица рекордов, то есть ``BACKEND_SQLITE``.
+        """
+        self.webhook = WebhookServer(
+            dispatcher=self.dispatcher,
+            secret_token=secret_token,
+            path=path,
+        )
+        app = self.webhook.make_app(app=self.make_metrics_app())
+
+        async def on_startup(app: web.Application):
+            await self.on_startup(dispatcher=self.dispatcher)
+            await self.set_webhook(url=f'{url}{path}', secret_token=secret_token)
+
+        async def on_shutdown(app: web.Application):
+            await self.on_shutdown(dispatcher=self.dispatcher)
+
+        app.on_startup.append(on_startup)
+        app.on_shutdown.append(on_shutdown)
+        web.run_app(app, host=host, port=port, reuse_port=reuse_port)
+
+    async def set_webhook(self, url: str, secret_token: str):
+        # В aiogram 2.11 у ``Bot.set_webhook`` ещё нет ``secret_token``, поэтому запрос собирается вручную
+        await self.bot.request(Methods.SET_WEBHOOK, {'url': url, 'secret_token': secret_token})
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        """Метрики в текстовом формате Prometheus."""
+        lag_changes, lag_seconds = self.boards.durable_lag()
+        text = prometheus_text(self.func_latency) + prometheus_values([
+            ('bot_durable_lag_changes', 'gauge', 'Board changes not yet fsynced to disk.', lag_changes),
+            ('bot_durable_lag_seconds', 'gauge', 'Age of the oldest change not yet fsynced to disk.', lag_seconds),
+            ('bot_flush_seconds', 'gauge', 'Duration of the last background save.', self.boards.flush_seconds),
+            ('bot_flush_waits_total', 'counter', 'Saves that waited for the previous one.', self.boards.flush_waits),
+            ('bot_checkpoint_seconds', 'gauge', 'Duration of the last journal checkpoint.', self.boards.checkpoint_seconds),
+            ('bot_rolls_rejected_total', 'counter', 'Repeated rolls rejected before sending dice.', self.rolls_rejected),
+        ])
+        if self.notifier is not None:
+            text += prometheus_values([
+                ('bot_round_notify_seconds', 'gauge', 'Duration of the last round results fan-out.',
+                 self.notifier.last_seconds),
+                ('bot_round_notify_ratio', 'gauge', 'Last round results fan-out duration as a share of the round.',
+                 self.notifier.last_ratio),
+                ('bot_round_notify_skipped_total', 'counter', 'Round results not sent to fit into the round.',
+                 self.notifier.skipped),
+            ])
+        return web.Response(text=text, content_type='text/plain')
+
+    def make_metrics_app(self, app: Optional[web.Application] = None) -> web.Application:
+        app = app or web.Application()
+        app.router.add_get('/metrics', self.metrics)
+        return app
+
+    async def answer(self, message: types.Message, priority: int = PRIORITY_REPLY, **kwargs) -> types.Message:
+        """Ответить в чат сообщения через общую очередь отправки."""
+        return await self.sender.send(
+            chat_id=message.chat.id,
+            call=partial(message.answer, **kwargs),
+            priority=priority,
+        )
+
+    async def board_for(self, message: types.Message) -> LeaderBoard:
+        """В группе играют в таблицу группы, в личке - в общую таблицу."""
+        if message.chat.type == types.ChatType.PRIVATE:
+            return await self.boards.get_async(chat_id=GLOBAL_BOARD)
+        return await self.boards.get_async(chat_id=message.chat.id)
+
     def increment_counter(self, f):
         """Wrap any important function with this."""
 
         @wraps(f)
-        async def inner(message: types.Message, *args, **kwargs):
+        async def inner(message: Union[types.Message, types.CallbackQuery], *args, **kwargs):
             fn = f.__name__
             self.counter += 1
             self.func_counter[fn] += 1
@@ -87,14 +349,12 @@ class Manager:
             t0 = time.time()
             res = await f(*args, message, **kwargs)
             dt = (time.time() - t0) * 1000
-            self.func_average_resp_time[fn] += dt
+            self.func_latency[fn].record(dt)
+            self.mark_startup('first_response')
 
-            # Store only last X values
-            self.func_resp_time[fn] = self.func_resp_time[fn][-(self.max_list_size - 1):]
-            self.func_resp_time[fn].append(dt)
-
-            chat_id = message.chat.id
-            self.unique_chats.add(chat_id)
+            # У нажатия кнопки чат - у сообщения с кнопкой
+            chat_id = message.message.chat.id if isinstance(message, types.CallbackQuery) else message.chat.id
+            self.unique.add(chat_id)
 
             return res
 
@@ -123,6 +383,18 @@ class Manager:
             self.increment_counter(self.roll_stats_total),
             Command(commands=[COMMAND_GAME_LEADERS]),
         )
+        self.dispatcher.register_callback_query_handler(
+            self.increment_counter(self.show_page),
+            lambda query: (query.data or '').startswith(f'{PAGE_CALLBACK}:'),
+        )
+        self.dispatcher.register_message_handler(
+            self.increment_counter(self.roll_near_round),
+            Command(commands=[COMMAND_ROUND_NEAR]),
+        )
+        self.dispatcher.register_message_handler(
+            self.increment_counter(self.roll_near_total),
+            Command(commands=[COMMAND_GAME_NEAR]),
+        )
 
         # Прочие вспомогательные команды, admin only
         self.dispatcher.register_message_handler(
@@ -139,6 +411,13 @@ class Manager:
                 IDFilter(chat_id=ADMIN_IDS),
             ),
         )
+        self.dispatcher.register_message_handler(
+            self.export_history,
+            AndFilter(
+                Command(commands=[COMMAND_EXPORT]),
+                IDFilter(chat_id=ADMIN_IDS),
+            ),
+        )
 
     @async_log_exception
     async def show_welcome(self, message: types.Message):
@@ -150,51 +429,80 @@ class Manager:
             '',
             f'Или нажми /{COMMAND_ROLL} чтобы сразу бросить шары.',
         ]
-        await message.answer(
+        await self.answer(
+            message=message,
             text=prepare_str(text=text),
             parse_mode=types.ParseMode.MARKDOWN,
         )
 
     @async_log_exception
     async def roll_once(self, message: types.Message):
-        chat_id = message.chat.id
+        board = await self.board_for(message=message)
+        user_id = message.from_user.id
 
-        if not self.board.can_add_result(chat_id=chat_id):
+        if board.is_reserved(chat_id=user_id):
+            # Бросок уже идёт, его результат придёт сам: повтор не стоит ни одного запроса к API
+            self.rolls_rejected += 1
+            return
+
+        if not board.reserve(chat_id=user_id):
+            self.rolls_rejected += 1
             text = [
-                f'*Нельзя бросать слишком часто!*',
+                '*Нельзя бросать слишком часто!*',
                 '',
             ]
             # Посчитать точное время
-            dt = self.board.time_left
-            if dt < 0:
-                # Что-то не так с обновлением!
+            dt = self.boards.time_left
+            if dt < 1:
+                # Раунд как раз сменяется
                 msg = 'Вы скоро сможете повторить!'
-                log.error('something wrong with update thread!')
             else:
                 msg = f'Вы сможете повторить в новом раунде через {pretty_time_delta(dt)}!'
             text.append(msg)
 
-            return await message.answer(
+            return await self.answer(
+                message=message,
                 text=prepare_str(text=text),
                 parse_mode=types.ParseMode.MARKDOWN,
             )
 
-        # Roll
-        rolls = [await message.answer_dice(emoji='🎳') for _ in range(3)]
+        # Бронь держит таблицу в памяти до ``add_result`` (см. ``BoardRegistry.insert``). Она не привязана
+        # к раунду: если раунд сменится, пока кубики отправляются, результат попадёт в новый раунд.
+        # Roll: все три броска уходят одновременно, от порядка произведение не зависит
+        try:
+            rolls = await asyncio.gather(*[
+                self.sender.send(
+                    chat_id=message.chat.id,
+                    call=partial(message.answer_dice, emoji='🎳'),
+                    priority=PRIORITY_DICE,
+                )
+                for _ in range(3)
+            ])
+        finally:
+            # Если бросок не удался, можно пробовать снова. Если удался, до ``add_result`` нет ``await``,
+            # и повторный бросок проверит уже результат
+            board.release(chat_id=user_id)
 
         score = 1
         for v in rolls:
             score *= v["dice"]["value"]
 
-        # Wait for animation
-        await asyncio.sleep(3)
+        if self.boards.closed:
+            # Кубики дошли уже после передачи таблиц следующему процессу, записать результат некуда
+            log.warning(f'Roll of {user_id} finished after shutdown, result dropped')
+            return
 
-        pos = self.board.add_result(
-            chat_id=chat_id,
-            full_name=message.chat.full_name,
+        pos = board.add_result(
+            chat_id=user_id,
+            full_name=message.from_user.full_name,
             score=score,
         )
 
+        # Ответ уйдёт после анимации, обработчик при этом уже свободен
+        self.scheduler.call_later(self.roll_animation_delay, self.send_roll_result, message, score, pos)
+
+    @async_log_exception
+    async def send_roll_result(self, message: types.Message, score: int, pos: int):
         text = [
             f'Ваш результат: *{score}*',
             f'Прямо сейчас вы на позиции *{pos}*',
@@ -202,16 +510,82 @@ class Manager:
             f'Посмотреть итоги раунда: /{COMMAND_ROUND_LEADERS}',
             f'Посмотреть лучшие результаты: /{COMMAND_GAME_LEADERS}',
         ]
-        await message.answer(
+        await self.answer(
+            message=message,
             text=prepare_str(text=text),
             parse_mode=types.ParseMode.MARKDOWN,
         )
 
-    async def abc_roll_stats_round(self, stats_func: Callable, header: str, message: types.Message):
-        chat_id = message.chat.id
-        stats = stats_func(chat_id=chat_id)
-        if not stats:
-            return await message.answer(
+    def round_closed(self, board_id: int, round_counter: int, items: List[LeaderItem]):
+        """ Итоги раунда: в личке каждому участнику его место, в группу - одно сообщение с лучшими.
+            ``items`` уже отсортированы, поэтому место - просто номер в списке.
+        """
+        if board_id != GLOBAL_BOARD:
+            text = [
+                '*Раунд завершён*',
+                '',
+                *[self.render_row(pos, item) for pos, item in enumerate(items[:RANGE_MAX], 1)],
+            ]
+            if len(items) > RANGE_MAX:
+                text.append(f'... и ещё {len(items) - RANGE_MAX}')
+            self.notifier.publish(round_counter=round_counter, messages=[(board_id, prepare_str(text=text))], total=1)
+            return
+
+        total = len(items)
+        messages = (
+            (item.chat_id, prepare_str(text=[
+                '*Раунд завершён*',
+                '',
+                f'Ваше место: *{pos}* из {total}, результат: *{item.score}*',
+                f'Посмотреть лучшие результаты: /{COMMAND_GAME_LEADERS}',
+            ]))
+            for pos, item in enumerate(items, 1)
+        )
+        self.notifier.publish(round_counter=round_counter, messages=messages, total=total)
+
+    @staticmethod
+    def render_row(pos: int, item: LeaderItem) -> str:
+        msg_pos = f'*{pos}*' if pos <= 3 else f'{pos}'
+        return f'{msg_pos}. {item}'
+
+    @staticmethod
+    def parse_ints(message: types.Message) -> List[int]:
+        """Числовые аргументы команды, например ``/rlead 11 30`` -> [11, 30]."""
+        try:
+            return [int(arg) for arg in (message.get_args() or '').split()]
+        except ValueError:
+            return []
+
+    async def abc_roll_stats_round(self, table: str, header: str, message: types.Message):
+        board = await self.board_for(message=message)
+        array = getattr(board, table)
+
+        args = self.parse_ints(message=message)
+        if len(args) == 2 and 1 <= args[0] <= args[1]:
+            # Диапазон позиций вместо лучших результатов
+            first, last = args[0], min(args[1], args[0] + RANGE_MAX - 1)
+            rows = board.ranked(array=array, first=first, last=last)
+            text = [
+                f'{header}, места {first}-{last}',
+                '',
+                *[self.render_row(pos, item) for pos, item in rows],
+            ]
+            return await self.answer(
+                message=message,
+                priority=PRIORITY_STATS,
+                text=prepare_str(text=text) if rows else 'Таких мест пока нет.',
+                parse_mode=types.ParseMode.MARKDOWN,
+            )
+
+        # Общая часть ответа одинакова для всех, пока таблица не изменилась
+        leaders = board.cached(
+            key=table,
+            render=lambda: prepare_str(text=[self.render_row(pos, item) for pos, item in board.leaders(array=array)]),
+        )
+        if not leaders:
+            return await self.answer(
+                message=message,
+                priority=PRIORITY_STATS,
                 text='Пока что ничего нет.',
                 parse_mode=types.ParseMode.MARKDOWN,
             )
@@ -219,29 +593,34 @@ class Manager:
         text = [
             header,
             '',
+            leaders,
         ]
 
-        for pos, item in stats:
-            msg_pos = f'*{pos}*' if pos <= 3 else f'{pos}'
-            msg = f'{msg_pos}. {item}'
-            text.append(msg)
+        own = board.user_position(array=array, chat_id=message.from_user.id)
+        if own is not None:
+            text.append(self.render_row(*own))
 
-        dt = self.board.time_left
+        dt = self.boards.time_left
         if dt > 0:
             text.extend([
                 '',
                 f'Следующий раунд через: {pretty_time_delta(dt)}',
             ])
 
-        await message.answer(
+        # Кнопка на следующие страницы, если рекордов больше, чем видно
+        _, keyboard = board.cached(key=f'{table}:page:0', render=partial(self.render_page, board, table, 0))
+        await self.answer(
+            message=message,
+            priority=PRIORITY_STATS,
             text=prepare_str(text=text),
             parse_mode=types.ParseMode.MARKDOWN,
+            reply_markup=keyboard,
         )
 
     @async_log_exception
     async def roll_stats_round(self, message: types.Message):
         return await self.abc_roll_stats_round(
-            stats_func=self.board.current_stats,
+            table='last_game',
             header='*Текущий раунд*',
             message=message,
         )
@@ -249,11 +628,163 @@ class Manager:
     @async_log_exception
     async def roll_stats_total(self, message: types.Message):
         return await self.abc_roll_stats_round(
-            stats_func=self.board.total_stats,
+            table='last_day',
             header='*Лучшие результаты за сутки*',
             message=message,
         )
 
+    # Таблицы, которые можно листать: код в ``callback_data`` -> (таблица, заголовок)
+    PAGE_TABLES = {
+        'r': ('last_game', '*Текущий раунд*'),
+        'd': ('last_day', '*Лучшие результаты за сутки*'),
+    }
+
+    def page_data(self, table: str, cursor: Optional[PageCursor]) -> str:
+        """``callback_data`` кнопки на страницу ``cursor``, без курсора - на первую страницу."""
+        code = next(code for code, (name, _) in self.PAGE_TABLES.items() if name == table)
+        return f'{PAGE_CALLBACK}:{code}:{cursor.encode() if cursor is not None else ""}'
+
+    def page_keyboard(self, table: str, prev_cursor: Optional[PageCursor],
+                      next_cursor: Optional[PageCursor]) -> Optional[types.InlineKeyboardMarkup]:
+        buttons = []
+        if prev_cursor is not None:
+            buttons.append(types.InlineKeyboardButton('« Назад', callback_data=self.page_data(table, prev_cursor)))
+        if next_cursor is not None:
+            buttons.append(types.InlineKeyboardButton('Дальше »', callback_data=self.page_data(table, next_cursor)))
+        if not buttons:
+            return None
+        return types.InlineKeyboardMarkup().row(*buttons)
+
+    def render_page(self, board: LeaderBoard, table: str,
+                    offset: int) -> Tuple[str, Optional[types.InlineKeyboardMarkup]]:
+        """Текст и кнопки страницы таблицы ``table``, которая начинается с позиции ``offset`` (с 0)."""
+        array = getattr(board, table)
+        header = next(header for name, header in self.PAGE_TABLES.values() if name == table)
+        rows, prev_cursor, next_cursor = board.page(array=array, offset=offset)
+        if not rows:
+            # Таблица успела сократиться, например начался новый раунд: вернуться в начало
+            if offset == 0:
+                return 'Пока что ничего нет.', None
+            first = types.InlineKeyboardButton('« В начало', callback_data=self.page_data(table, None))
+            return 'Таких мест пока нет.', types.InlineKeyboardMarkup().row(first)
+        text = [
+            f'{header}, места {rows[0][0]}-{rows[-1][0]} из {len(array)}',
+            '',
+            *[self.render_row(pos, item) for pos, item in rows],
+        ]
+        return prepare_str(text=text), self.page_keyboard(table=table, prev_cursor=prev_cursor, next_cursor=next_cursor)
+
+    @async_log_exception
+    async def show_page(self, query: types.CallbackQuery):
+        """ Нажатие кнопки листания: страница по курсору из ``callback_data``. Одна и та же страница
+            одной версии таблиц отрисовывается один раз.
+        """
+        _, code, data = query.data.split(':', 2)
+        table, _ = self.PAGE_TABLES[code]
+        board = await self.board_for(message=query.message)
+        offset = board.page_offset(array=getattr(board, table), cursor=PageCursor.decode(data))
+        text, keyboard = board.cached(
+            key=f'{table}:page:{offset}',
+            render=partial(self.render_page, board, table, offset),
+        )
+
+        await query.answer()
+        try:
+            await self.sender.send(
+                chat_id=query.message.chat.id,
+                call=partial(
+                    query.message.edit_text,
+                    text=text,
+                    parse_mode=types.ParseMode.MARKDOWN,
+                    reply_markup=keyboard,
+                ),
+                priority=PRIORITY_STATS,
+            )
+        except MessageNotModified:
+            # Страница не изменилась, например кнопку нажали дважды
+            pass
+
+    async def abc_roll_near(self, table: str, header: str, message: types.Message):
+        board = await self.board_for(message=message)
+        array = getattr(board, table)
+        chat_id = message.from_user.id
+
+        args = self.parse_ints(message=message)
+        k = min(max(args[0], 0), NEIGHBOURS_MAX) if args else NEIGHBOURS_DEFAULT
+        rows = board.neighbours(array=array, chat_id=chat_id, k=k)
+        if not rows:
+            return await self.answer(
+                message=message,
+                priority=PRIORITY_STATS,
+                text=f'Вас пока нет в таблице, нажмите /{COMMAND_ROLL} чтобы бросить шары.',
+            )
+
+        pos = array.rank(chat_id=chat_id)
+        percentile = board.percentile(array=array, chat_id=chat_id)
+        text = [
+            header,
+            '',
+            f'Ваше место: *{pos}* из {len(array)}, результат не хуже, чем у {percentile:.0f}% игроков',
+            '',
+        ]
+        for row_pos, item in rows:
+            row = self.render_row(row_pos, item)
+            text.append(f'{row} ⬅️' if row_pos == pos else row)
+
+        await self.answer(
+            message=message,
+            priority=PRIORITY_STATS,
+            text=prepare_str(text=text),
+            parse_mode=types.ParseMode.MARKDOWN,
+        )
+
+    @async_log_exception
+    async def roll_near_round(self, message: types.Message):
+        return await self.abc_roll_near(
+            table='last_game',
+            header='*Ваши соседи в текущем раунде*',
+            message=message,
+        )
+
+    @async_log_exception
+    async def roll_near_total(self, message: types.Message):
+        return await self.abc_roll_near(
+            table='last_day',
+            header='*Ваши соседи за сутки*',
+            message=message,
+        )
+
+    @staticmethod
+    def write_history(archive: RoundArchive, since: float, until: float, path: str) -> int:
+        with open(path, 'w', newline='') as fp:
+            return write_csv(results=archive.results(since=since, until=until), fp=fp)
+
+    @async_log_exception
+    async def export_history(self, message: types.Message):
+        """``/export [часов] [chat_id]`` - все результаты таблицы из архива раундов в CSV."""
+        args = self.parse_ints(message=message)
+        hours = args[0] if args else 24
+        chat_id = args[1] if len(args) > 1 else GLOBAL_BOARD
+        archive = self.boards.open_archive(chat_id=chat_id)
+        if archive is None:
+            return await self.answer(message=message, priority=PRIORITY_STATS, text='Архива раундов этой таблицы нет.')
+
+        until = time.time()
+        since = until - hours * 3600
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, f'history_{chat_id}.csv')
+            # Архив читается потоком, но с диска - поэтому не на event loop
+            count = await asyncio.get_event_loop().run_in_executor(
+                None, self.write_history, archive, since, until, path,
+            )
+            if not count:
+                return await self.answer(message=message, priority=PRIORITY_STATS, text='За это время результатов нет.')
+            await self.sender.send(
+                chat_id=message.chat.id,
+                call=partial(message.answer_document, document=types.InputFile(path), caption=f'Результатов: {count}'),
+                priority=PRIORITY_STATS,
+            )
+
     @async_log_exception
     async def show_user_info(self, message: types.Message):
         text = [
@@ -262,7 +793,8 @@ class Manager:
             f'Имя: `{message.chat.full_name}`',
             f'Идентификатор чата: `{message.chat.id}`',
         ]
-        await message.answer(
+        await self.answer(
+            message=message,
             text=prepare_str(text=text),
             parse_mode=types.ParseMode.MARKDOWN,
         )
@@ -275,6 +807,10 @@ class Manager:
             f'/{COMMAND_ROLL} -- бросить шары.',
             f'/{COMMAND_ROUND_LEADERS} -- итоги раунда.',
             f'/{COMMAND_GAME_LEADERS} -- лучшие результаты.',
+            f'/{COMMAND_ROUND_NEAR} -- ваше место и соседи в раунде.',
+            f'/{COMMAND_GAME_NEAR} -- ваше место и соседи за сутки.',
+            f'Например, `/{COMMAND_ROUND_LEADERS} 11 20` покажет места с 11 по 20, '
+            f'а `/{COMMAND_GAME_NEAR} 5` - по 5 соседей выше и ниже.',
             '',
             '*Помощь*',
             '',
@@ -288,8 +824,10 @@ class Manager:
                 '',
                 f'/{COMMAND_USER} -- посмотреть на себя.',
                 f'/{COMMAND_STATS} -- посмотреть статистику бота.',
+                f'/{COMMAND_EXPORT} -- выгрузить результаты за 24 часа, или `/{COMMAND_EXPORT} <часов> <chat_id>`.',
             ])
-        await message.answer(
+        await self.answer(
+            message=message,
             text=prepare_str(text=text),
             parse_mode=types.ParseMode.MARKDOWN,
         )
@@ -297,7 +835,9 @@ class Manager:
     @async_log_exception
     async def show_stats(self, message: types.Message):
         if not self.func_counter:
-            return await message.answer(
+            return await self.answer(
+                message=message,
+                priority=PRIORITY_STATS,
                 text='Сейчас тут ничего нет.',
             )
 
@@ -308,29 +848,83 @@ class Manager:
             '*Статистика бота*',
             '',
             f'- Всего запросов с момента старта: *{self.counter}*',
-            f'- Всего пользователей с момента старта: *{len(self.unique_chats)}*',
+            f'- Всего пользователей: *{self.unique.count(WINDOW_LIFETIME)}*',
             f'- Время жизни бота: {lifetime}',
             '',
             '*Статистика по функциям*',
             '',
         ]
-        total_resp_time = []
+        total = LatencyRecorder()
         sorted_requests = sorted(self.func_counter.items(), key=lambda i: (i[1], i[0]), reverse=True)
         for (fn, requests) in sorted_requests:
-            # AVG resp time
-            resp_time = self.func_resp_time[fn]
-            total_resp_time.extend(resp_time)
-            avg_resp = sum(resp_time) / len(resp_time)
+            latency = self.func_latency[fn]
+            total.merge(latency)
 
             text.append(f'`{fn}`')
-            text.append(f'{requests} requests, {avg_resp:.0f} avg resp time (ms)')
+            text.append(f'{requests} requests, {format_percentiles(latency.percentiles())}')
+            text.append(f'last {len(latency.last())}: {format_percentiles(latency.window_percentiles())}')
             text.append('')
 
         # Вставить после ``Всего запросов..``
-        total_avg = sum(total_resp_time) / len(total_resp_time)
-        text.insert(3, f'- Среднее время ответа: *{total_avg:.0f}* (ms)')
+        text.insert(3, f'- Время ответа: {format_percentiles(total.percentiles())}')
+        text.insert(4, f'- Повторных бросков отклонено: *{self.rolls_rejected}*')
+        text.insert(7, f'- Запуск: {format_startup(self.startup)}')
+
+        unique = self.unique
+        text.extend([
+            '*Пользователи* (оценка)',
+            '',
+            f'- За час: *{unique.count(WINDOW_HOUR, now=now)}*, за сутки: *{unique.count(WINDOW_DAY, now=now)}*, '
+            f'за 7 суток: *{unique.union(WINDOW_DAY, 7, now=now)}*',
+            f'- По часам: {" ".join(map(str, unique.trend(WINDOW_HOUR, 6, now=now)))}',
+            f'- По суткам: {" ".join(map(str, unique.trend(WINDOW_DAY, 7, now=now)))}',
+            '',
+        ])
+
+        sender = self.sender
+        text.extend([
+            '*Очередь отправки*',
+            '',
+            f'- В очереди: *{sender.depth}* ({", ".join(f"{k}: {v}" for k, v in sorted(sender.depth_by_priority.items()))})',
+            f'- Отправлено: *{sender.sent}*, повторов после 429: *{sender.retried}*, ошибок: *{sender.failed}*',
+            f'- Ожидание в очереди: {sender.wait_avg * 1000:.0f} avg, {sender.wait_max * 1000:.0f} max (ms)',
+        ])
+
+        boards = self.boards
+        lag_changes, lag_seconds = boards.durable_lag()
+        text.extend([
+            '',
+            '*Сохранение*',
+            '',
+            f'- Таблиц в памяти: *{len(boards)}*, сохранений: *{boards.flushes}*, ждали предыдущего: *{boards.flush_waits}*',
+            f'- Последнее сохранение: {boards.flush_seconds * 1000:.0f} ms',
+            f'- Журналов на диск: *{boards.checkpoints}*, последний {boards.checkpoint_seconds * 1000:.0f} ms',
+            f'- Не на диске: *{lag_changes}* изменений, {lag_seconds:.0f} sec',
+        ])
+        if self.notifier is not None:
+            notifier = self.notifier
+            text.extend([
+                '',
+                '*Итоги раундов*',
+                '',
+                f'- Раундов: *{notifier.rounds}*, отправлено: *{notifier.sent}*, ошибок: *{notifier.failed}*',
+                f'- Пропущено: *{notifier.skipped}*, не уложились в раунд: *{notifier.overruns}*',
+                f'- Последняя рассылка: {notifier.last_seconds:.1f} sec, {notifier.last_ratio * 100:.0f}% раунда',
+            ])
+        if self.webhook is not None:
+            webhook = self.webhook
+            text.extend([
+                '',
+                '*Webhook*',
+                '',
+                f'- Принято: *{webhook.accepted}*, отклонено (503): *{webhook.rejected}*, без секрета (403): *{webhook.forbidden}*',
+                f'- Обработано: *{webhook.processed}*, ошибок: *{webhook.failed}*',
+                f'- В очереди: *{webhook.queue.qsize()}*, в работе: *{webhook.busy}*',
+            ])
 
-        await message.answer(
+        await self.answer(
+            message=message,
+            priority=PRIORITY_STATS,
             text=prepare_str(text=text),
             parse_mode=types.ParseMode.MARKDOWN,
         )
@@ -341,8 +935,44 @@ if __name__ == '__main__':
     assert TG_TOKEN, 'TG_TOKEN env variable must be set!'
 
     SENTRY_TOKEN = os.getenv('SENTRY_TOKEN')
+    # Доля запросов с трассировкой производительности в sentry
+    SENTRY_TRACES_SAMPLE_RATE = float(os.getenv('SENTRY_TRACES_SAMPLE_RATE', '0.1'))
+
+    # Если задан WEBHOOK_URL - webhook, иначе long polling
+    WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+    WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+    WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+    WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+    # Порт /metrics в режиме polling, в режиме webhook метрики на порту webhook
+    METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+    WEBHOOK_REUSE_PORT = os.getenv('WEBHOOK_REUSE_PORT') == '1'
+    # По умолчанию выводится из токена
+    WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+
+    # memory или sqlite
+    BOARD_BACKEND = os.getenv('BOARD_BACKEND', BACKEND_MEMORY)
+    # Рассылать участникам итоги раунда
+    ROUND_NOTIFY = os.getenv('ROUND_NOTIFY') == '1'
+    # Сколько секунд результатов можно потерять при падении, 0 - только на границах раундов
+    CHECKPOINT_INTERVAL = float(os.getenv('CHECKPOINT_INTERVAL', '1.0'))
+    # Принять работу у уже запущенного процесса (деплой без простоя)
+    HANDOFF = os.getenv('BOT_HANDOFF') == '1'
 
     m = Manager(
         token=TG_TOKEN,
+        sentry_token=SENTRY_TOKEN,
+        backend=BOARD_BACKEND,
+        traces_sample_rate=SENTRY_TRACES_SAMPLE_RATE,
+        notify_rounds=ROUND_NOTIFY,
+        checkpoint_interval=CHECKPOINT_INTERVAL,
+        handoff=HANDOFF,
+    )
+    m.run(
+        webhook_url=WEBHOOK_URL,
+        webhook_path=WEBHOOK_PATH,
+        host=WEBHOOK_HOST,
+        port=WEBHOOK_PORT,
+        metrics_port=METRICS_PORT,
+        reuse_port=WEBHOOK_REUSE_PORT,
+        webhook_secret=WEBHOOK_SECRET,
     )
-    m.run()
@@ -3,11 +3,26 @@ COMMAND_START = 'start'
 COMMAND_HELP = 'help'
 COMMAND_STATS = 'stats'
 COMMAND_USER = 'user'
+COMMAND_EXPORT = 'export'
 
 # Game
 COMMAND_ROLL = 'roll3'
 COMMAND_ROUND_LEADERS = 'rlead'
 COMMAND_GAME_LEADERS = 'toplead'
+COMMAND_ROUND_NEAR = 'rnear'
+COMMAND_GAME_NEAR = 'topnear'
+
+# Сколько соседей выше и ниже показывать по умолчанию и не больше скольких по запросу
+NEIGHBOURS_DEFAULT = 3
+NEIGHBOURS_MAX = 10
+# Сколько строк можно запросить диапазоном позиций, например ``/rlead 11 30``
+RANGE_MAX = 50
+
+# Префикс ``callback_data`` кнопок листания таблиц
+PAGE_CALLBACK = 'page'
+
+# Сколько секунд идёт анимация броска
+ROLL_ANIMATION_DELAY = 3.0
 
 ADMIN_IDS = [
     50512389,
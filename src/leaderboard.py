@@ -1,12 +1,20 @@
+import base64
+import heapq
+import random
+import struct
+import sys
 import time
-import threading
-from collections import defaultdict
+from array import array
+from collections import deque
 from dataclasses import dataclass
 from datetime import datetime, timedelta
-from itertools import chain
-from typing import List, Tuple, Optional
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Tuple, Optional
 
-from src.utils.storage import Storage
+from src.utils.archive import RoundArchive
+from src.utils.ranking import KeyedRankIndex
+from src.utils.rowmap import RowMap
+from src.utils.snapshot import SnapshotReader, SnapshotRows
+from src.utils.storage import FORMAT_JSON, JOURNAL_CLEAR, JOURNAL_DELETE, JOURNAL_PUT, Storage
 
 
 class BoardException(Exception):
@@ -17,9 +25,17 @@ class BoardUserAlreadyExists(BoardException):
     """Нельзя добавлять юзера повторно когда он уже принял участие в раунде."""
 
 
+@dataclass
+class BoardMeta:
+    """Служебное состояние таблицы, которое переживает перезапуск."""
+    round_counter: int
+
+
 @dataclass
 class LeaderItem:
     """LeaderItem представляет одного пользователя в таблице рекордов."""
+    __slots__ = ('chat_id', 'full_name', 'score', 'created_at')
+
     chat_id: int
     full_name: str
     score: int
@@ -32,75 +48,589 @@ class LeaderItem:
 
 POS_NOT_FOUND = -1
 
+# version, offset, score, created_at, forward
+_CURSOR = struct.Struct('<IIqd?')
+
+
+@dataclass(frozen=True)
+class PageCursor:
+    """ Курсор страницы таблицы: версия таблиц, позиция первой записи страницы (с 0) и граница
+        ``(score, created_at)``, от которой страница отсчитывается, если таблицы уже изменились.
+        ``forward`` - страница сразу после границы, иначе страница, которая заканчивается перед ней.
+    """
+    version: int
+    offset: int
+    score: int
+    created_at: float
+    forward: bool
+
+    def encode(self) -> str:
+        """Непрозрачная строка для ``callback_data`` (до 64 байт)."""
+        data = _CURSOR.pack(self.version, self.offset, self.score, self.created_at, self.forward)
+        return base64.urlsafe_b64encode(data).decode('ascii')
 
-def find_user_pos(array: List[LeaderItem], chat_id: int) -> Tuple[int, Optional[LeaderItem]]:
-    for pos, item in enumerate(array):
-        if item.chat_id == chat_id:
-            return pos + 1, item
-    return POS_NOT_FOUND, None
+    @classmethod
+    def decode(cls, data: str) -> Optional['PageCursor']:
+        """Курсор из ``encode``, или None для пустой и испорченной строки (первая страница)."""
+        try:
+            return cls(*_CURSOR.unpack(base64.urlsafe_b64decode(data)))
+        except (ValueError, struct.error):
+            return None
 
 
-def sort_board(array: List[LeaderItem]) -> List[LeaderItem]:
+def sort_board(array: Iterable[LeaderItem]) -> List[LeaderItem]:
     return sorted(array, key=lambda i: (i.score, i.created_at), reverse=True)
 
 
+_FLOAT = struct.Struct('<d')
+_UINT64 = struct.Struct('<Q')
+_TS_MASK = (1 << 64) - 1
+# Номер строки больше любого настоящего: граница ``position`` после всех равных результатов
+_ROW_AFTER = sys.maxsize
+
+
+class BoardIndex:
+    """ BoardIndex хранит одну таблицу рекордов в колонках: chat_id и score в ``array('q')``,
+        created_at в ``array('d')``, имена в списке строк. chat_id -> номер строки
+        даёт ``RowMap`` за O(1), номера строк в ``KeyedRankIndex`` по ``(-score, -created_at, строка)`` -
+        вставку и позицию за O(log n). Ни на одну запись не держится отдельных объектов, кроме имени.
+
+        ``LeaderItem`` создаётся только при чтении записи. Таблица, загруженная из бинарного снимка,
+        не читает имена, пока запись не понадобится.
+    """
+
+    def __init__(self, items: Iterable[LeaderItem] = ()):
+        self.chat_ids = array('q')
+        self.scores = array('q')
+        self.created = array('d')
+        self.names: List[Optional[str]] = []
+        self._rows = RowMap(keys=self.chat_ids)
+        self._order = KeyedRankIndex(key=self._rank_key)
+        # Освободившиеся строки переиспользуются, чтобы колонки не росли от обновлений рекордов
+        self._free: List[int] = []
+        self._source: Optional[SnapshotReader] = None
+        self._source_rows: Optional[array] = None
+
+        if isinstance(items, SnapshotRows):
+            self._load(rows=items)
+        else:
+            for item in items:
+                self._append(chat_id=item.chat_id, full_name=item.full_name, score=item.score,
+                             created_at=item.created_at)
+            # Поиск и порядок строятся разом, а не вставками по одной
+            self._rows.extend(start=0)
+            self._order.update(range(len(self.chat_ids)))
+
+    def _rank_key(self, row: int) -> Tuple[int, float, int]:
+        """Порядок записей как в ``sort_board``: чем меньше, тем выше место, при равных очках выше более новый результат."""
+        return -self.scores[row], -self.created[row], row
+
+    def _load(self, rows: SnapshotRows):
+        self._source = rows.reader
+        self._source_rows = array('q')
+        if rows.entries is None and rows.reader is not None:
+            # Снимок без изменений из журнала: колонки копируются целиком, как есть
+            reader = rows.reader
+            self.chat_ids.frombytes(memoryview(reader.chat_ids).cast('B'))
+            self.scores.frombytes(memoryview(reader.scores).cast('B'))
+            self.created.frombytes(memoryview(reader.created_ats).cast('B'))
+            self.names.extend([None] * len(reader))
+            self._source_rows.extend(range(len(reader)))
+        for row in range(len(self.chat_ids), len(rows)):
+            entry = rows.entry(row)
+            chat_id, score, created_at = rows.fields(row)
+            if isinstance(entry, int):
+                self._append(chat_id=chat_id, full_name=None, score=score, created_at=created_at)
+                self._source_rows.append(entry)
+            else:
+                self._append(chat_id=chat_id, full_name=entry.full_name, score=score, created_at=created_at)
+                self._source_rows.append(-1)
+        self._rows.extend(start=0)
+        self._order.update(range(len(rows)))
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self._rows
+
+    def __iter__(self) -> Iterator[LeaderItem]:
+        """Записи в порядке убывания результата."""
+        for row in self._order:
+            yield self._item(row)
+
+    def _name(self, row: int) -> str:
+        name = self.names[row]
+        if name is None:
+            name = self.names[row] = self._source.full_name(self._source_rows[row])
+        return name
+
+    def _item(self, row: int) -> LeaderItem:
+        return LeaderItem(
+            chat_id=self.chat_ids[row],
+            full_name=self._name(row),
+            score=self.scores[row],
+            created_at=self.created[row],
+        )
+
+    def get(self, chat_id: int) -> Optional[LeaderItem]:
+        row = self._rows.get(chat_id)
+        return self._item(row) if row is not None else None
+
+    def score(self, chat_id: int) -> Optional[int]:
+        """Результат пользователя без создания ``LeaderItem``."""
+        row = self._rows.get(chat_id)
+        return self.scores[row] if row is not None else None
+
+    def created_at(self, chat_id: int) -> Optional[float]:
+        row = self._rows.get(chat_id)
+        return self.created[row] if row is not None else None
+
+    def add(self, item: LeaderItem):
+        self.insert(chat_id=item.chat_id, full_name=item.full_name, score=item.score, created_at=item.created_at)
+
+    def insert(self, chat_id: int, full_name: str, score: int, created_at: float):
+        if self._free:
+            row = self._free.pop()
+            self.chat_ids[row] = chat_id
+            self.scores[row] = score
+            self.created[row] = created_at
+            self.names[row] = full_name
+        else:
+            row = self._append(chat_id=chat_id, full_name=full_name, score=score, created_at=created_at)
+        self._rows.set(chat_id, row)
+        self._order.add(row)
+
+    def _append(self, chat_id: int, full_name: Optional[str], score: int, created_at: float) -> int:
+        """Новая строка колонок, ещё без поиска и порядка; вернуть её номер."""
+        row = len(self.chat_ids)
+        self.chat_ids.append(chat_id)
+        self.scores.append(score)
+        self.created.append(created_at)
+        self.names.append(full_name)
+        return row
+
+    def remove(self, chat_id: int) -> LeaderItem:
+        row = self._rows.pop(chat_id)
+        self._order.remove(row)
+        item = self._item(row)
+
+        self.names[row] = None
+        self._free.append(row)
+        return item
+
+    def rank(self, chat_id: int) -> int:
+        """Позиция пользователя начиная с 1, или POS_NOT_FOUND."""
+        row = self._rows.get(chat_id)
+        if row is None:
+            return POS_NOT_FOUND
+        return self._order.index(row) + 1
+
+    def position(self, score: int, created_at: float, after: bool = False) -> int:
+        """Сколько записей выше результата ``(score, created_at)``, с ``after`` - вместе с равными ему."""
+        return self._order.bisect_left((-score, -created_at, _ROW_AFTER if after else -1))
+
+    def top(self, n: int) -> List[LeaderItem]:
+        return self.ranked(first=1, last=n)
+
+    def ranked(self, first: int, last: int) -> List[LeaderItem]:
+        """Записи на позициях с ``first`` по ``last`` включительно (с 1), за O(log n + k)."""
+        return [self._item(row) for row in self._order.islice(first - 1, last)]
+
+    def rows(self) -> Iterator[int]:
+        """Номера занятых строк в порядке убывания результата."""
+        return iter(self._order)
+
+    def copy_columns(self) -> 'BoardColumns':
+        """ Копия таблицы для сохранения. Копирование полное, за O(n), но только плоских колонок,
+            без создания ``LeaderItem``.
+        """
+        return BoardColumns(
+            chat_ids=self.chat_ids[:],
+            scores=self.scores[:],
+            created=self.created[:],
+            names=self.names[:],
+            free=self._free[:],
+            source=self._source,
+            source_rows=self._source_rows[:] if self._source_rows is not None else None,
+        )
+
+
+class BoardColumns:
+    """ Копия колонок ``BoardIndex`` на момент ``BoardIndex.copy_columns()``.
+
+        Делается на event loop за копирование нескольких массивов, а строки и ``LeaderItem``
+        создаются уже при записи в executor, и изменения таблицы после копирования в них не попадают.
+    """
+
+    __slots__ = ('chat_ids', 'scores', 'created', 'names', 'free', 'source', 'source_rows')
+
+    def __init__(self, chat_ids: array, scores: array, created: array, names: List[Optional[str]],
+                 free: List[int], source: Optional[SnapshotReader], source_rows: Optional[array]):
+        self.chat_ids = chat_ids
+        self.scores = scores
+        self.created = created
+        self.names = names
+        self.free = free
+        self.source = source
+        self.source_rows = source_rows
+
+    def __len__(self) -> int:
+        return len(self.chat_ids) - len(self.free)
+
+    def rows(self) -> Iterator[Tuple[int, str, int, float]]:
+        """(chat_id, full_name, score, created_at) в порядке строк."""
+        free = set(self.free)
+        for row in range(len(self.chat_ids)):
+            if row in free:
+                continue
+            name = self.names[row]
+            if name is None:
+                name = self.source.full_name(self.source_rows[row])
+            yield self.chat_ids[row], name, self.scores[row], self.created[row]
+
+    def __iter__(self) -> Iterator[LeaderItem]:
+        for row in self.rows():
+            yield LeaderItem(*row)
+
+
+class DayWindow:
+    """ Скользящее окно результатов поверх суточной таблицы ``index``.
+
+        В ``index`` лежит лучший результат каждого пользователя, здесь - его запасные результаты:
+        очередь по времени с невозрастающими очками. Результат, который хуже более нового, лучшим
+        уже никогда не станет и сразу отбрасывается, поэтому когда лучший истекает, его место
+        занимает голова очереди. Время истечения лучших результатов лежит в куче, так что
+        истечение стоит O(log n) на результат и может выполняться частями.
+    """
+
+    def __init__(self, index: BoardIndex):
+        self.index = index
+        self.fallbacks: Dict[int, Deque[LeaderItem]] = {}
+        # Упакованные (created_at, chat_id) лучших результатов
+        self._heap = [_expiry_key(created_at=index.created[row], chat_id=index.chat_ids[row]) for row in index.rows()]
+        heapq.heapify(self._heap)
+
+    def offer(self, item: LeaderItem) -> bool:
+        """Добавить результат новее всех предыдущих; ``True``, если он стал лучшим результатом пользователя."""
+        best = self.index.score(chat_id=item.chat_id)
+        if best is not None and item.score <= best:
+            # При равных очках остаётся более ранний результат
+            queue = self.fallbacks.get(item.chat_id)
+            if queue is None:
+                queue = self.fallbacks[item.chat_id] = deque()
+            while queue and queue[-1].score < item.score:
+                queue.pop()
+            queue.append(item)
+            return False
+
+        if best is not None:
+            self.index.remove(chat_id=item.chat_id)
+            # Все запасные результаты старше и хуже нового
+            self.fallbacks.pop(item.chat_id, None)
+        self.index.add(item)
+        heapq.heappush(self._heap, _expiry_key(created_at=item.created_at, chat_id=item.chat_id))
+        return True
+
+    def expire(self, deadline: float, limit: int = None) -> Iterator[Tuple[LeaderItem, Optional[LeaderItem]]]:
+        """ Убрать результаты не новее ``deadline``, не больше ``limit`` за раз.
+            Для каждого истёкшего лучшего результата вернуть (его, следующий лучший или None).
+        """
+        heap = self._heap
+        deadline_key = _expiry_key(created_at=deadline, chat_id=-1)
+        while heap and heap[0] <= deadline_key and limit != 0:
+            created_at, chat_id = _expiry_unpack(heapq.heappop(heap))
+            if self.index.created_at(chat_id=chat_id) != created_at:
+                # Лучший результат уже сменился более сильным
+                continue
+            if limit is not None:
+                limit -= 1
+
+            expired = self.index.remove(chat_id=chat_id)
+            queue = self.fallbacks.get(chat_id)
+            while queue and queue[0].created_at <= deadline:
+                queue.popleft()
+            if not queue:
+                self.fallbacks.pop(chat_id, None)
+                yield expired, None
+                continue
+
+            item = queue.popleft()
+            if not queue:
+                del self.fallbacks[chat_id]
+            self.index.add(item)
+            heapq.heappush(heap, _expiry_key(created_at=item.created_at, chat_id=chat_id))
+            yield expired, item
+
+    def saved(self) -> List[LeaderItem]:
+        """Запасные результаты всех пользователей для сохранения."""
+        return [item for queue in self.fallbacks.values() for item in queue]
+
+    def load(self, items: Iterable[LeaderItem]):
+        """Восстановить запасные результаты из ``saved()``."""
+        for item in sorted(items, key=lambda i: i.created_at):
+            best = self.index.get(chat_id=item.chat_id)
+            if best is not None and item.created_at > best.created_at and item.score <= best.score:
+                self.offer(item)
+
+
+def _expiry_key(created_at: float, chat_id: int) -> int:
+    created_bits = _UINT64.unpack(_FLOAT.pack(created_at))[0]
+    return (created_bits << 64) | (chat_id & _TS_MASK)
+
+
+def _expiry_unpack(key: int) -> Tuple[float, int]:
+    chat_id = key & _TS_MASK
+    if chat_id >= 1 << 63:
+        chat_id -= 1 << 64
+    return _FLOAT.unpack(_UINT64.pack(key >> 64))[0], chat_id
+
+
 class LeaderBoard:
     """LeaderBoard представляет основную и единую логику таблицы рекордов."""
 
-    def __init__(self, round_duration: timedelta = None, expire_delta: timedelta = None, dry_run: bool = False):
-        self.last_game_storage = Storage(filename='last_game', klass=LeaderItem, dry_run=dry_run)
-        self.last_game: List[LeaderItem] = self.last_game_storage.load()
+    def __init__(self, round_duration: timedelta = None, expire_delta: timedelta = None, dry_run: bool = False,
+                 journal: bool = False, base_path: str = None, fmt: str = FORMAT_JSON, archive: bool = False,
+                 read_only: bool = False):
+        self._init_rules(round_duration=round_duration, expire_delta=expire_delta)
+        # Версия таблиц: растёт при каждом изменении, по ней проверяется кэш отрисовки
+        self.version = 0
+
+        self.last_game_storage = Storage(
+            filename='last_game',
+            klass=LeaderItem,
+            base_path=base_path,
+            dry_run=dry_run,
+            journal=journal,
+            fmt=fmt,
+            read_only=read_only,
+        )
+        self.last_game = BoardIndex(self.last_game_storage.load())
+
+        self.last_day_storage = Storage(
+            filename='last_day',
+            klass=LeaderItem,
+            base_path=base_path,
+            dry_run=dry_run,
+            journal=journal,
+            fmt=fmt,
+            read_only=read_only,
+        )
+        self.last_day = BoardIndex(self.last_day_storage.load())
+
+        # Запасные результаты суточной таблицы на случай, когда лучший результат истечёт
+        self.day_fallbacks_storage = Storage(
+            filename='day_fallbacks',
+            klass=LeaderItem,
+            base_path=base_path,
+            dry_run=dry_run,
+            fmt=fmt,
+        )
+        self.day_window = DayWindow(index=self.last_day)
+        self.day_window.load(self.day_fallbacks_storage.load())
+
+        self.meta_storage = Storage(
+            filename='meta',
+            klass=BoardMeta,
+            base_path=base_path,
+            dry_run=dry_run,
+        )
+        meta = self.meta_storage.load()
+        # Сколько раундов прошло
+        self.round_counter = meta[0].round_counter if meta else 0
 
-        self.last_day_storage = Storage(filename='last_day', klass=LeaderItem, dry_run=dry_run)
-        self.last_day: List[LeaderItem] = self.last_day_storage.load()
+        # Все результаты завершённых раундов, для аналитики
+        self.archive = RoundArchive(base_path=base_path, dry_run=dry_run) if archive else None
 
+    def _init_rules(self, round_duration: timedelta = None, expire_delta: timedelta = None):
+        """Правила игры и служебные поля, общие для всех способов хранения таблиц."""
         # Какое кол-во рекордов отображать в статистике
         self.visible_leader_board = 10
         # Длительность раунда
         self.round_duration = round_duration or timedelta(minutes=2)
         # Срок жизни результатов
         self.expire_delta = expire_delta or timedelta(hours=24)
+        # Сколько истёкших результатов убирать за раз в новом раунде и при добавлении результата
+        self.expire_round_batch = 10000
+        self.expire_add_batch = 16
         # Сколько раундов прошло
         self.round_counter = 0
         # Время последнего обновления
         self.last_update = time.time()
-
-    def run_update(self):
-        """Запустить фоновое обновление счётчиков."""
+        self.render_cache: Dict[str, Tuple[int, Any]] = {}
+        self.render_cache_max = 256
+        # ``version`` после перезапуска начинается заново: соль отличает курсоры прежнего процесса
+        self.page_salt = random.getrandbits(32)
+        # Версия, которая уже целиком на диске (fsync), и когда она туда попала
+        self.durable_version = 0
+        self.durable_at = time.time()
+        # Версия, которая сохранена целиком, вместе с запасными результатами, номером раунда и архивом
+        self.dumped_version = 0
+        # Архив завершённых раундов, если включён
+        self.archive: Optional[RoundArchive] = None
+        # Броски, которые уже начаты, но ещё не дали результат: chat_id -> когда бронь истекает
+        self.reservations: Dict[int, float] = {}
+        # Бронь держит обработчик броска до результата или ошибки, срок - только на случай, если он её потерял.
+        # Кубики в группу могут ждать в очереди отправки минуты (20 сообщений в минуту на чат)
+        self.reservation_ttl = 600.0
+        # Вызывается в конце раунда с его номером и результатами от лучшего к худшему
+        self.on_round_closed: Optional[Callable[[int, List[LeaderItem]], None]] = None
+
+    def begin_dump(self) -> Callable[[], None]:
+        """ Подготовить сохранение и вернуть его блокирующую часть, см. ``Storage.begin_flush``.
+
+            Таблицы попадают в сохранение копией колонок (``BoardIndex.copy_columns``), поэтому подготовка
+            дешёвая, а блокирующую часть можно выполнять в executor, пока таблицы меняются дальше.
+            После неё ``durable_version`` догоняет версию таблиц на момент подготовки.
+            Таблица, которая не менялась с прошлого сохранения, не пишется.
+        """
+        version = self.version
+        if version == self.dumped_version:
+            return lambda: None
+        jobs = [
+            self.last_game_storage.begin_flush(get_objs=self.last_game.copy_columns),
+            self.last_day_storage.begin_flush(get_objs=self.last_day.copy_columns),
+            self.day_fallbacks_storage.begin_flush(get_objs=self.day_window.saved),
+            self.meta_storage.begin_flush(get_objs=lambda: [BoardMeta(round_counter=self.round_counter)]),
+        ]
+        if self.archive is not None:
+            jobs.append(self.archive.begin_flush())
 
         def inner():
-            while True:
-                time.sleep(self.round_duration.total_seconds())
+            for job in jobs:
+                job()
+            self.dumped_version = max(self.dumped_version, version)
+            if version > self.durable_version:
+                self.durable_version = version
+                self.durable_at = time.time()
 
-                self.new_round()
-                self.dump_data()
-                self.last_update = time.time()
-
-        t = threading.Thread(target=inner, daemon=True)
-        t.start()
+        return inner
 
     def dump_data(self):
         """Сохранить промежуточные результаты."""
-        self.last_game_storage.save(objs=self.last_game)
-        self.last_day_storage.save(objs=self.last_day)
+        self.begin_dump()()
+
+    def begin_checkpoint(self) -> Callable[[], None]:
+        """ Как ``begin_dump``, но только журналы результатов, без снимков и архива: достаточно
+            дёшево, чтобы делать каждую секунду. Запасные результаты и архив пишет ``begin_dump``.
+        """
+        if not (self.last_game_storage.journaled and self.last_day_storage.journaled):
+            # Без журнала fsync нечего, изменения сохранит только ``begin_dump``
+            return lambda: None
+
+        version = self.version
+        jobs = [
+            self.last_game_storage.begin_sync(),
+            self.last_day_storage.begin_sync(),
+        ]
+
+        def inner():
+            for job in jobs:
+                job()
+            if version > self.durable_version:
+                self.durable_version = version
+                self.durable_at = time.time()
+
+        return inner
+
+    def refresh(self) -> bool:
+        """ Дочитать то, что после загрузки (``read_only=True``) в файлы таблицы дописал другой процесс,
+            например при передаче работы новому процессу. ``False``, если файлы переписаны целиком
+            и таблицу нужно загрузить заново.
+        """
+        game = self.last_game_storage.read_tail()
+        day = self.last_day_storage.read_tail()
+        if game is None or day is None:
+            return False
+
+        for op, item in game:
+            if op == JOURNAL_CLEAR:
+                self.last_game = BoardIndex()
+                continue
+            if item.chat_id in self.last_game:
+                self.last_game.remove(chat_id=item.chat_id)
+            if op == JOURNAL_PUT:
+                self.last_game.add(item)
+        for op, item in day:
+            if op == JOURNAL_CLEAR:
+                self.last_day = BoardIndex()
+                continue
+            if item.chat_id in self.last_day:
+                self.last_day.remove(chat_id=item.chat_id)
+            if op == JOURNAL_PUT:
+                self.last_day.add(item)
+
+        # Запасные результаты и номер раунда пишутся целиком, их проще перечитать
+        self.day_window = DayWindow(index=self.last_day)
+        self.day_window.load(self.day_fallbacks_storage.load())
+        meta = self.meta_storage.load()
+        if meta:
+            self.round_counter = max(self.round_counter, meta[0].round_counter)
+        for storage in (self.last_game_storage, self.last_day_storage):
+            storage.read_only = False
+        self.version += 1
+        return True
+
+    @property
+    def durable_lag(self) -> int:
+        """Сколько изменений таблиц ещё не сохранено на диск."""
+        return self.version - self.durable_version
+
+    def close(self):
+        """Закрыть файлы журналов."""
+        self.last_game_storage.close()
+        self.last_day_storage.close()
 
     @property
     def time_left(self) -> float:
         """Сколько времени осталось до начала нового раунда."""
         now = time.time()
-        return self.last_update + self.round_duration.total_seconds() - now
+        return max(0.0, self.last_update + self.round_duration.total_seconds() - now)
 
     def user_stats(self, chat_id: int) -> int:
         """Текущая позиция пользователя в этом раунде."""
-        pos, _ = find_user_pos(array=self.last_game, chat_id=chat_id)
-        return pos
+        return self.last_game.rank(chat_id=chat_id)
 
     def can_add_result(self, chat_id: int) -> bool:
         """Может ли пользователь участвовать в текущем раунде."""
-        return self.user_stats(chat_id=chat_id) == POS_NOT_FOUND
+        return chat_id not in self.last_game
+
+    def reserve(self, chat_id: int) -> bool:
+        """ Занять бросок пользователя до отправки кубиков. ``False``, если пользователь уже сыграл
+            в этом раунде или его бросок ещё идёт. Бронь снимает ``add_result`` или ``release``,
+            ``reservation_ttl`` - запасной вариант, если бросок так и не закончился.
+        """
+        now = time.time()
+        if self.reservations.get(chat_id, 0.0) > now or not self.can_add_result(chat_id=chat_id):
+            return False
+        # Бронь не привязана к раунду: результат начатого броска попадёт в тот раунд, в котором закончится
+        self.reservations[chat_id] = now + self.reservation_ttl
+        return True
+
+    def is_reserved(self, chat_id: int) -> bool:
+        return self.reservations.get(chat_id, 0.0) > time.time()
+
+    @property
+    def in_flight(self) -> int:
+        """Сколько начатых бросков ещё не дали результат."""
+        now = time.time()
+        return sum(deadline > now for deadline in self.reservations.values())
+
+    def release(self, chat_id: int):
+        """Снять бронь, если бросок не удался."""
+        self.reservations.pop(chat_id, None)
+
+    def expire_reservations(self) -> int:
+        """Убрать брони брошенных бросков, вернуть их число."""
+        now = time.time()
+        expired = [chat_id for chat_id, deadline in self.reservations.items() if deadline <= now]
+        for chat_id in expired:
+            del self.reservations[chat_id]
+        return len(expired)
 
     def add_result(self, chat_id: int, full_name: str, score: int) -> int:
         """Добавить результат в общую таблицу, и вернуть место пользователя в текущем раунде."""
+        self.release(chat_id=chat_id)
         if not self.can_add_result(chat_id=chat_id):
             raise BoardUserAlreadyExists
 
@@ -110,9 +640,11 @@ class LeaderBoard:
             score=score,
             created_at=time.time(),
         )
-        self.last_game.append(item)
-
-        self.last_game = sort_board(self.last_game)
+        self.last_game.add(item)
+        self.last_game_storage.append(op=JOURNAL_PUT, obj=item)
+        self.version += 1
+        # Понемногу убирать истёкшие результаты, которые не успел убрать новый раунд
+        self.expire_day(limit=self.expire_add_batch)
         return self.user_stats(chat_id=chat_id)
 
     def new_round(self):
@@ -120,30 +652,144 @@ class LeaderBoard:
             Учесть что пользователь уже может быть в рекордах, и нужно выбрать
             один максимальный результат от него.
         """
-        # Проверить пришло ли время обнулять все результаты.
-        count = int(self.expire_delta.total_seconds() / self.round_duration.seconds)
-        if self.round_counter % count == 0:
-            self.last_day = []
-
-        games_dict = defaultdict(list)
-        for i in chain(self.last_day, self.last_game):
-            games_dict[i.chat_id].append(i)
+        self.expire_day(limit=self.expire_round_batch)
+        self.expire_reservations()
+
+        # Стоимость зависит только от числа участников раунда: для каждого из них
+        # достаточно сравнить результат с лучшим за сутки и обновить индекс.
+        items = list(self.last_game)
+        for item in items:
+            if self.day_window.offer(item):
+                self.last_day_storage.append(op=JOURNAL_PUT, obj=item)
+        if self.archive is not None:
+            # Сжимается и пишется на диск вместе с остальным сохранением
+            self.archive.add_round(round_counter=self.round_counter, finished_at=time.time(), items=items)
+        if self.on_round_closed is not None and items:
+            self.on_round_closed(self.round_counter, items)
+        if items:
+            self.last_game = BoardIndex()
+            self.last_game_storage.append(op=JOURNAL_CLEAR)
+            self.version += 1
+        # Пустой раунд таблицу не меняет и не сохраняется, номер раунда на диске догонит ``catch_up``
+        self.round_counter += 1
 
-        self.last_day = sort_board([max(group, key=lambda i: i.score) for group in games_dict.values()])
-        self.last_game = []
+    def expire_day(self, limit: int = None) -> int:
+        """ Убрать из суточной таблицы результаты старше ``expire_delta``, на их место встают
+            следующие лучшие результаты тех же пользователей. Вернуть число истёкших результатов.
+        """
+        deadline = time.time() - self.expire_delta.total_seconds()
+        count = 0
+        for expired, item in self.day_window.expire(deadline=deadline, limit=limit):
+            if item is None:
+                self.last_day_storage.append(op=JOURNAL_DELETE, obj=expired)
+            else:
+                self.last_day_storage.append(op=JOURNAL_PUT, obj=item)
+            count += 1
+        if count:
+            self.version += 1
+        return count
 
-        self.round_counter += 1
+    @property
+    def rounds_to_expire(self) -> int:
+        """Сколько раундов помещается в ``expire_delta``."""
+        return int(self.expire_delta.total_seconds() / self.round_duration.total_seconds())
+
+    def catch_up(self, round_counter: int):
+        """Доиграть раунды, пропущенные пока таблица была выгружена из памяти."""
+        if self.round_counter >= round_counter:
+            return
+        # Остальные пропущенные раунды пустые, а устаревшие результаты убираются по времени
+        self.new_round()
+        self.round_counter = max(self.round_counter, round_counter)
+
+    def cached(self, key: str, render: Callable[[], Any]) -> Any:
+        """Результат ``render()``, который пересчитывается только после изменения таблиц."""
+        hit = self.render_cache.get(key)
+        if hit is not None and hit[0] == self.version:
+            return hit[1]
+        value = render()
+        if hit is None and len(self.render_cache) >= self.render_cache_max:
+            # Страницы из глубины таблицы: сначала убрать устаревшие, потом самые старые
+            version = self.version
+            self.render_cache = {k: v for k, v in self.render_cache.items() if v[0] == version}
+            while len(self.render_cache) >= self.render_cache_max:
+                del self.render_cache[next(iter(self.render_cache))]
+        self.render_cache[key] = (self.version, value)
+        return value
+
+    def leaders(self, array: BoardIndex) -> List[Tuple[int, LeaderItem]]:
+        """Видимые рекорды с позициями."""
+        return [(inx + 1, item) for inx, item in enumerate(array.top(self.visible_leader_board))]
+
+    def user_position(self, array: BoardIndex, chat_id: int) -> Optional[Tuple[int, LeaderItem]]:
+        """Позиция пользователя, если он не попал в видимые рекорды."""
+        pos = array.rank(chat_id=chat_id)
+        if pos != POS_NOT_FOUND and pos > self.visible_leader_board:
+            return pos, array.get(chat_id=chat_id)
+        return None
+
+    def ranked(self, array: BoardIndex, first: int, last: int) -> List[Tuple[int, LeaderItem]]:
+        """Рекорды на позициях с ``first`` по ``last`` включительно."""
+        first = max(first, 1)
+        return [(first + inx, item) for inx, item in enumerate(array.ranked(first=first, last=last))]
 
-    def abs_stats(self, array, chat_id: int = None) -> List[Tuple[int, LeaderItem]]:
+    @property
+    def page_version(self) -> int:
+        """``version`` числом для курсора страниц, своим в каждой загрузке таблицы."""
+        return hash((self.page_salt, self.version)) & 0xffffffff
+
+    def page_offset(self, array: BoardIndex, cursor: Optional[PageCursor], size: int = None) -> int:
+        """ Позиция первой записи страницы ``cursor`` (с 0) за O(log n). Пока таблицы не менялись,
+            это позиция из курсора, после изменений страница отсчитывается от границы курсора,
+            поэтому при листании записи не повторяются и не пропускаются.
+        """
+        size = size or self.visible_leader_board
+        if cursor is None:
+            return 0
+        if cursor.version == self.page_version:
+            return cursor.offset
+        if cursor.forward:
+            return array.position(score=cursor.score, created_at=cursor.created_at, after=True)
+        return max(0, array.position(score=cursor.score, created_at=cursor.created_at) - size)
+
+    def page(self, array: BoardIndex, offset: int, size: int = None) -> Tuple[
+            List[Tuple[int, LeaderItem]], Optional[PageCursor], Optional[PageCursor]]:
+        """Рекорды страницы с позиции ``offset`` (с 0) и курсоры на предыдущую и следующую страницы."""
+        size = size or self.visible_leader_board
+        rows = self.ranked(array=array, first=offset + 1, last=offset + size)
+        prev_cursor = next_cursor = None
+        if rows and offset > 0:
+            first = rows[0][1]
+            prev_cursor = PageCursor(version=self.page_version, offset=max(0, offset - size), score=first.score,
+                                     created_at=first.created_at, forward=False)
+        if rows and offset + len(rows) < len(array):
+            last = rows[-1][1]
+            next_cursor = PageCursor(version=self.page_version, offset=offset + len(rows), score=last.score,
+                                     created_at=last.created_at, forward=True)
+        return rows, prev_cursor, next_cursor
+
+    def neighbours(self, array: BoardIndex, chat_id: int, k: int) -> List[Tuple[int, LeaderItem]]:
+        """Пользователь и по ``k`` соседей выше и ниже него, пусто если его нет в таблице."""
+        pos = array.rank(chat_id=chat_id)
+        if pos == POS_NOT_FOUND:
+            return []
+        return self.ranked(array=array, first=pos - k, last=pos + k)
+
+    def percentile(self, array: BoardIndex, chat_id: int) -> Optional[float]:
+        """Доля игроков таблицы (в процентах, включая самого пользователя), которых он не хуже."""
+        pos = array.rank(chat_id=chat_id)
+        if pos == POS_NOT_FOUND:
+            return None
+        total = len(array)
+        return (total - pos + 1) / total * 100
+
+    def abs_stats(self, array: BoardIndex, chat_id: int = None) -> List[Tuple[int, LeaderItem]]:
         """Вернуть текущие рекорды + позицию пользователя."""
-        leaders = array[:self.visible_leader_board]
-        res = [(inx + 1, item) for inx, item in enumerate(leaders)]
-
+        res = self.leaders(array=array)
         if chat_id is not None:
-            pos, us = find_user_pos(array=array, chat_id=chat_id)
-            if pos != POS_NOT_FOUND and pos > self.visible_leader_board:
-                res.append((pos, us))
-
+            own = self.user_position(array=array, chat_id=chat_id)
+            if own is not None:
+                res.append(own)
         return res
 
     def total_stats(self, chat_id: int = None) -> List[Tuple[int, LeaderItem]]:
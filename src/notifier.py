@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from functools import partial
+from itertools import islice
+from typing import Awaitable, Callable, Deque, Iterable, Optional, Tuple
+
+from src.utils.sender import PRIORITY_STATS, OutboundDispatcher
+
+
+log = logging.getLogger(__name__)
+
+
+class RoundNotifier:
+    """ Рассылка итогов завершённого раунда его участникам.
+
+        Сообщения уходят через общую очередь отправки с самым низким приоритетом пачками
+        по ``batch_size``: следующая пачка ставится в очередь, когда отправлена предыдущая, поэтому
+        очередь не растёт, а ответы на команды обгоняют рассылку. За раунд отправляется не больше
+        ``share`` от лимита Bot API на длину раунда, остальные участники (с худшими местами)
+        пропускаются, чтобы рассылка успела закончиться до следующего раунда. Если не успела,
+        недоотправленные итоги прошлого раунда отбрасываются.
+    """
+
+    def __init__(self, sender: OutboundDispatcher, send: Callable[[int, str], Awaitable], round_seconds: float,
+                 share: float = 0.5, batch_size: int = 50):
+        self.sender = sender
+        self.send = send
+        self.round_seconds = round_seconds
+        self.share = share
+        self.batch_size = batch_size
+
+        self.pending: Deque[Tuple[int, str]] = deque()
+        self.worker: Optional[asyncio.Task] = None
+        # Раунд, который сейчас рассылается, и сколько ещё сообщений в него влезет
+        self.round_counter: Optional[int] = None
+        self.budget_left = 0
+        self.started_at = 0.0
+
+        # Метрики
+        self.rounds = 0
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+        self.overruns = 0
+        self.last_seconds = 0.0
+
+    @property
+    def budget(self) -> int:
+        """Сколько сообщений можно отправить за раунд."""
+        return int(self.round_seconds * self.sender.global_rate * self.share)
+
+    @property
+    def last_ratio(self) -> float:
+        """Длительность последней рассылки в долях длины раунда."""
+        return self.last_seconds / self.round_seconds
+
+    def publish(self, round_counter: int, messages: Iterable[Tuple[int, str]], total: int):
+        """ Разослать итоги раунда одной таблицы: ``messages`` - пары (chat_id, текст) от лучших мест
+            к худшим, ``total`` - их число. Тексты создаются лениво, только для тех, кто влезает в бюджет.
+        """
+        if round_counter != self.round_counter:
+            if self.pending:
+                # Прошлая рассылка не уложилась в раунд
+                self.overruns += 1
+                self.skipped += len(self.pending)
+                self.pending.clear()
+            self.round_counter = round_counter
+            self.budget_left = self.budget
+            self.rounds += 1
+            self.started_at = time.perf_counter()
+
+        count = min(total, self.budget_left)
+        self.pending.extend(islice(messages, count))
+        self.budget_left -= count
+        self.skipped += total - count
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while self.pending:
+            batch = [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+            results = await asyncio.gather(*[
+                self.sender.send(chat_id=chat_id, call=partial(self.send, chat_id, text), priority=PRIORITY_STATS)
+                for chat_id, text in batch
+            ], return_exceptions=True)
+            for res in results:
+                if isinstance(res, Exception):
+                    # Например, пользователь заблокировал бота
+                    self.failed += 1
+                    log.debug('Round result not sent: %r', res)
+                else:
+                    self.sent += 1
+        self.last_seconds = time.perf_counter() - self.started_at
+
+    async def close(self):
+        """Не начинать новые пачки и дождаться отправки текущей."""
+        self.skipped += len(self.pending)
+        self.pending.clear()
+        if self.worker is not None:
+            await asyncio.gather(self.worker, return_exceptions=True)
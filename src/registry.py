@@ -0,0 +1,370 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from functools import partial
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+from src.leaderboard import LeaderBoard, LeaderItem
+from src.utils.archive import RoundArchive
+from src.utils.scheduler import RoundClock
+
+if TYPE_CHECKING:
+    from src.sqlite_board import SqliteDatabase
+
+
+log = logging.getLogger(__name__)
+
+# Таблица для личных чатов: все игроки в личке соревнуются друг с другом
+GLOBAL_BOARD = 0
+
+# Где хранятся таблицы
+BACKEND_MEMORY = 'memory'
+BACKEND_SQLITE = 'sqlite'
+
+
+class BoardRegistry:
+    """ BoardRegistry хранит отдельную таблицу рекордов для каждого чата.
+
+        Таблица чата лежит в своём каталоге ``boards/<chat_id>`` и загружается при первом обращении.
+        В памяти держится не больше ``capacity`` последних использованных таблиц, остальные
+        сохраняются на диск и выгружаются. Раунды всех таблиц меняются одним общим таймером
+        на event loop, а выгруженная таблица догоняет пропущенные раунды при следующей загрузке.
+    """
+
+    def __init__(self, capacity: int = 1000, base_path: str = None, round_duration: timedelta = None,
+                 expire_delta: timedelta = None, dry_run: bool = False, backend: str = BACKEND_MEMORY, **board_kwargs):
+        self.capacity = capacity
+        self.base_path = base_path or os.path.abspath(os.path.dirname(__file__))
+        self.round_duration = round_duration or timedelta(minutes=2)
+        self.expire_delta = expire_delta
+        self.dry_run = dry_run
+        self.backend = backend
+        self.board_kwargs = board_kwargs
+        self.db: Optional['SqliteDatabase'] = None
+
+        self.boards: Dict[int, LeaderBoard] = OrderedDict()
+        # Таблицы, которые сейчас загружаются в executor
+        self.loading: Dict[int, asyncio.Future] = {}
+        # Сохранение, которое сейчас идёт в executor
+        self.flushing: Optional[asyncio.Future] = None
+        # Вытесненные таблицы, которые ещё сохраняются
+        self.evicting: Dict[int, asyncio.Future] = {}
+        # Другое состояние, которое сохраняется вместе с таблицами, см. ``attach``
+        self.dumps: List[Callable[[], Callable[[], None]]] = []
+        # Итоги раундов загруженных таблиц: (chat_id таблицы, номер раунда, результаты от лучшего к худшему)
+        self.on_round_closed: Optional[Callable[[int, int, List[LeaderItem]], None]] = None
+        # Файлы таблиц переданы следующему процессу, см. ``close``
+        self.closed = False
+
+        # Метрики сохранения
+        self.flushes = 0
+        self.flush_waits = 0
+        self.flush_seconds = 0.0
+        self.checkpoints = 0
+        self.checkpoint_seconds = 0.0
+
+        # Номер раунда считается от начала эпохи, поэтому он одинаков для всех таблиц и перезапусков
+        self.clock = RoundClock(period=self.round_duration.total_seconds())
+        self.round_counter = self.clock.current()
+
+    def __len__(self) -> int:
+        return len(self.boards)
+
+    def board_path(self, chat_id: int) -> str:
+        if chat_id == GLOBAL_BOARD:
+            # Общая таблица осталась на старом месте, чтобы не переносить данные
+            return self.base_path
+        return os.path.join(self.base_path, 'boards', str(chat_id))
+
+    def get(self, chat_id: int) -> LeaderBoard:
+        """Таблица чата; загружается с диска при первом обращении."""
+        board = self.boards.get(chat_id)
+        if board is not None:
+            self.boards.move_to_end(chat_id)
+            return board
+
+        board = self.load(chat_id=chat_id)
+        self.insert(chat_id=chat_id, board=board)
+        return board
+
+    async def get_async(self, chat_id: int) -> LeaderBoard:
+        """ Таблица чата, не блокируя event loop: с диска она читается в executor.
+            Запросы, пришедшие во время загрузки, ждут ту же загрузку.
+        """
+        board = self.boards.get(chat_id)
+        if board is not None:
+            self.boards.move_to_end(chat_id)
+            return board
+        if self.backend == BACKEND_SQLITE:
+            # Читать с диска нечего, а соединение с базой нельзя передавать в другой поток
+            return self.get(chat_id=chat_id)
+
+        future = self.loading.get(chat_id)
+        if future is None:
+            future = self.loading[chat_id] = asyncio.ensure_future(self._load_async(chat_id=chat_id))
+        # Отмена одного обработчика не должна отменять загрузку для остальных
+        return await asyncio.shield(future)
+
+    def open_archive(self, chat_id: int) -> Optional[RoundArchive]:
+        """ Архив раундов таблицы без её загрузки, чтобы не вытеснять живые таблицы.
+            ``None``, если архив выключен или такой таблицы нет на диске.
+        """
+        board = self.boards.get(chat_id)
+        if board is not None:
+            return board.archive
+        path = self.board_path(chat_id=chat_id)
+        if not self.board_kwargs.get('archive') or not os.path.isdir(path):
+            return None
+        return RoundArchive(base_path=path, dry_run=self.dry_run)
+
+    async def _load_async(self, chat_id: int) -> LeaderBoard:
+        try:
+            evicting = self.evicting.get(chat_id)
+            if evicting is not None:
+                # Таблицу только что вытеснили: читать файлы, когда она их допишет
+                await asyncio.gather(evicting, return_exceptions=True)
+            board = await asyncio.get_event_loop().run_in_executor(None, self.load, chat_id)
+        finally:
+            del self.loading[chat_id]
+        # Пока таблица загружалась, мог смениться раунд
+        board.catch_up(round_counter=self.round_counter)
+        board.last_update = self.round_counter * self.clock.period
+        self.insert(chat_id=chat_id, board=board)
+        return board
+
+    def insert(self, chat_id: int, board: LeaderBoard):
+        if self.on_round_closed is not None:
+            board.on_round_closed = partial(self.on_round_closed, chat_id)
+        self.boards[chat_id] = board
+        if len(self.boards) <= self.capacity:
+            return
+        for cold_id in list(self.boards):
+            if len(self.boards) <= self.capacity or cold_id == chat_id:
+                break
+            cold = self.boards[cold_id]
+            if cold.in_flight:
+                # Обработчик броска держит эту таблицу до ``add_result``: результат не должен попасть
+                # в закрытую копию. Таблица вытеснится позже, а пока их в памяти больше ``capacity``
+                continue
+            del self.boards[cold_id]
+            self.evict(chat_id=cold_id, board=cold)
+
+    def load(self, chat_id: int, read_only: bool = False) -> LeaderBoard:
+        """Загрузить таблицу с диска. С ``read_only`` ничего не пишется и пропущенные раунды не доигрываются."""
+        if self.backend == BACKEND_SQLITE:
+            return self.load_sqlite(chat_id=chat_id)
+
+        path = self.board_path(chat_id=chat_id)
+        if not self.dry_run:
+            os.makedirs(path, exist_ok=True)
+
+        board = LeaderBoard(
+            round_duration=self.round_duration,
+            expire_delta=self.expire_delta,
+            dry_run=self.dry_run,
+            base_path=path,
+            read_only=read_only,
+            **self.board_kwargs,
+        )
+        if not os.path.isfile(board.meta_storage.path) or self.dry_run:
+            # Новая таблица, или таблица сохранённая до появления номера раунда
+            board.round_counter = self.round_counter
+        elif not read_only:
+            board.catch_up(round_counter=self.round_counter)
+        board.last_update = self.round_counter * self.clock.period
+        return board
+
+    def load_sqlite(self, chat_id: int) -> LeaderBoard:
+        from src.sqlite_board import SqliteDatabase, SqliteLeaderBoard
+
+        if self.db is None:
+            if self.dry_run:
+                path = ':memory:'
+            else:
+                os.makedirs(self.base_path, exist_ok=True)
+                path = os.path.join(self.base_path, 'boards.sqlite3')
+            self.db = SqliteDatabase(path=path)
+
+        board = SqliteLeaderBoard(
+            db=self.db,
+            board=chat_id,
+            round_duration=self.round_duration,
+            expire_delta=self.expire_delta,
+        )
+        board.catch_up(round_counter=self.round_counter)
+        board.last_update = self.round_counter * self.clock.period
+        return board
+
+    def preload(self, chat_id: int):
+        """ Загрузить таблицу, файлы которой ещё пишет другой процесс, ничего не меняя на диске.
+            Когда он остановится, ``refresh`` дочитает его последние изменения.
+        """
+        self.insert(chat_id=chat_id, board=self.load(chat_id=chat_id, read_only=True))
+
+    def refresh(self):
+        """Дочитать изменения другого процесса во всех загруженных таблицах, переписанные таблицы загрузить заново."""
+        self.round_counter = max(self.round_counter, self.clock.current())
+        for chat_id, board in list(self.boards.items()):
+            if not board.refresh():
+                log.info(f'Reload board {chat_id} after handoff')
+                board.close()
+                board = self.load(chat_id=chat_id)
+                self.insert(chat_id=chat_id, board=board)
+            board.catch_up(round_counter=self.round_counter)
+            board.last_update = self.round_counter * self.clock.period
+
+    def evict(self, chat_id: int, board: LeaderBoard):
+        """ Сохранить и закрыть вытесненную таблицу. На event loop запись идёт в executor после
+            начатого сохранения, как в ``flush``, без event loop (загрузка в executor, тесты) - сразу.
+        """
+        log.debug(f'Evict board {chat_id}')
+        job = board.begin_dump()
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            job()
+            board.close()
+            return
+        self.flushing = self.evicting[chat_id] = asyncio.ensure_future(
+            self._evict_async(chat_id=chat_id, board=board, job=job, previous=self.flushing))
+
+    async def _evict_async(self, chat_id: int, board: LeaderBoard, job: Callable[[], None],
+                           previous: Optional[asyncio.Future]):
+        try:
+            if previous is not None:
+                await asyncio.gather(previous, return_exceptions=True)
+            await asyncio.get_event_loop().run_in_executor(None, job)
+        except Exception:
+            log.exception(f'Failed to save evicted board {chat_id}')
+        finally:
+            board.close()
+            if self.evicting.get(chat_id) is asyncio.current_task():
+                del self.evicting[chat_id]
+
+    def close(self):
+        """Закрыть журналы всех таблиц после последнего сохранения: дальше в них пишет следующий процесс."""
+        for board in self.boards.values():
+            board.close()
+        self.closed = True
+
+    def new_round(self):
+        """Новый раунд во всех загруженных таблицах."""
+        self.advance(round_counter=self.round_counter + 1)
+
+    def advance(self, round_counter: int):
+        """Довести все загруженные таблицы до раунда ``round_counter``."""
+        for board in self.boards.values():
+            board.catch_up(round_counter=round_counter)
+            board.last_update = round_counter * self.clock.period
+        self.round_counter = round_counter
+
+    def attach(self, begin_dump: Callable[[], Callable[[], None]]):
+        """Сохранять вместе с таблицами: ``begin_dump`` вызывается на event loop и возвращает запись."""
+        self.dumps.append(begin_dump)
+
+    def begin_dump(self) -> Callable[[], None]:
+        """Подготовить сохранение всех таблиц и вернуть его блокирующую часть."""
+        jobs = [board.begin_dump() for board in self.boards.values()]
+        jobs.extend(begin_dump() for begin_dump in self.dumps)
+
+        def inner():
+            for job in jobs:
+                job()
+
+        return inner
+
+    def dump_data(self):
+        self.begin_dump()()
+
+    async def flush(self):
+        """ Сохранить все таблицы в executor. Снимки таблиц делаются сразу, поэтому
+            обработчики не ждут записи. Если предыдущее сохранение ещё идёт, сначала дождаться его,
+            чтобы снимки не копились в памяти, а файлы не писались двумя потоками сразу.
+        """
+        if self.flushing is not None and not self.flushing.done():
+            self.flush_waits += 1
+            await asyncio.shield(self.flushing)
+
+        job = self.begin_dump()
+
+        def timed():
+            t0 = time.perf_counter()
+            job()
+            self.flush_seconds = time.perf_counter() - t0
+
+        self.flushing = asyncio.get_event_loop().run_in_executor(None, timed)
+        self.flushes += 1
+        await asyncio.shield(self.flushing)
+
+    async def wait_flushed(self):
+        """Дождаться начатого сохранения, например перед сохранением при остановке."""
+        if self.flushing is not None:
+            await asyncio.gather(self.flushing, return_exceptions=True)
+
+    async def checkpoint(self):
+        """ Дописать на диск журналы изменённых таблиц (групповой commit). Если идёт полное сохранение,
+            оно сделает то же самое, и ждать его не нужно.
+        """
+        if self.flushing is not None and not self.flushing.done():
+            return
+        jobs = [board.begin_checkpoint() for board in self.boards.values() if board.durable_lag > 0]
+        if not jobs:
+            return
+
+        def timed():
+            t0 = time.perf_counter()
+            for job in jobs:
+                job()
+            self.checkpoint_seconds = time.perf_counter() - t0
+
+        self.flushing = asyncio.get_event_loop().run_in_executor(None, timed)
+        self.checkpoints += 1
+        await asyncio.shield(self.flushing)
+
+    async def run_checkpoints(self, interval: float):
+        """ Каждые ``interval`` секунд дописывать журналы на диск: при падении процесса теряются
+            результаты не больше чем за ``interval`` и время одного fsync.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.checkpoint()
+            except asyncio.CancelledError:
+                await self.wait_flushed()
+                raise
+            except Exception:
+                log.exception('Checkpoint failed')
+
+    def durable_lag(self) -> Tuple[int, float]:
+        """Сколько изменений во всех таблицах ещё не на диске, и сколько секунд назад на диске было всё."""
+        changes = 0
+        oldest = None
+        for board in self.boards.values():
+            lag = board.durable_lag
+            if lag > 0:
+                changes += lag
+                oldest = board.durable_at if oldest is None else min(oldest, board.durable_at)
+        return changes, time.time() - oldest if oldest is not None else 0.0
+
+    async def run_rounds(self):
+        """ Менять раунды всех таблиц на границах раундов по настенным часам.
+
+            Раунды меняются на event loop, поэтому не пересекаются с обработчиками,
+            а на диск данные пишутся в executor.
+        """
+        async for round_counter in self.clock.ticks(last=self.round_counter):
+            self.advance(round_counter=round_counter)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                # Дописать начатое сохранение, иначе оно пересечётся с сохранением при остановке
+                await self.wait_flushed()
+                raise
+
+    @property
+    def time_left(self) -> float:
+        """Сколько времени осталось до начала нового раунда."""
+        return self.clock.time_left()
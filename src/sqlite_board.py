@@ -0,0 +1,232 @@
+import sqlite3
+import time
+from datetime import timedelta
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from src.leaderboard import POS_NOT_FOUND, BoardUserAlreadyExists, LeaderBoard, LeaderItem
+from src.utils.scheduler import RoundClock
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS results (
+    board INTEGER NOT NULL,
+    round INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    full_name TEXT NOT NULL,
+    score INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS results_chat ON results (board, chat_id, round);
+CREATE INDEX IF NOT EXISTS results_rank ON results (board, round, score, created_at);
+'''
+
+_COLUMNS = 'chat_id, full_name, score, created_at'
+# Лучший результат каждого пользователя: при равных очках остаётся более ранний, как в ``LeaderBoard.new_round``.
+# Без оконных функций: в SQLite они с 3.25, а в Ubuntu 18.04 - 3.22
+_BEST = f'''
+WITH w AS (SELECT round, {_COLUMNS} FROM results WHERE board = ? AND round >= ? AND round < ?)
+SELECT {_COLUMNS} FROM w AS r WHERE NOT EXISTS (
+    SELECT 1 FROM w AS b WHERE b.chat_id = r.chat_id AND (
+        b.score > r.score OR b.score = r.score AND (
+            b.created_at < r.created_at OR b.created_at = r.created_at AND b.round < r.round
+        )
+    )
+)
+'''
+_RESULTS = f'SELECT {_COLUMNS} FROM results WHERE board = ? AND round >= ? AND round < ?'
+
+
+class SqliteDatabase:
+    """ Общий файл SQLite в режиме WAL: читатели не блокируют писателя, поэтому одну таблицу
+        рекордов могут обслуживать несколько процессов бота.
+    """
+
+    def __init__(self, path: str, timeout: float = 5.0):
+        self.path = path
+        # Автокоммит: каждая запись сразу видна остальным процессам
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        # Свои записи не меняют ``data_version`` этого соединения, их считаем отдельно
+        self.writes = 0
+
+    def version(self) -> Tuple[int, int]:
+        """Меняется после каждой записи в базу из этого или другого процесса."""
+        return self.conn.execute('PRAGMA data_version').fetchone()[0], self.writes
+
+    def execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        cursor = self.conn.execute(sql, params)
+        if cursor.rowcount > 0:
+            self.writes += 1
+        return cursor
+
+    def close(self):
+        self.conn.close()
+
+
+class SqliteTable:
+    """ Одна таблица рекордов поверх ``results`` с тем же интерфейсом чтения, что у ``BoardIndex``.
+
+        Таблица - это результаты раундов из ``rounds()``; если ``unique=False``, у пользователя
+        может быть несколько результатов и в таблицу попадает лучший. Прочитанное кэшируется,
+        пока не изменилась версия базы или набор раундов.
+    """
+
+    def __init__(self, db: SqliteDatabase, board: int, rounds: Callable[[], Tuple[int, int]], unique: bool = True):
+        self.db = db
+        self.board = board
+        self.rounds = rounds
+        self.source = _RESULTS if unique else _BEST
+        self._cache: Dict[Any, Any] = {}
+        self._cache_key = None
+
+    def _params(self) -> tuple:
+        lo, hi = self.rounds()
+        return self.board, lo, hi
+
+    def _cached(self, key: Any, read: Callable[[], Any]) -> Any:
+        version = (self.db.version(), self.rounds())
+        if version != self._cache_key:
+            self._cache = {}
+            self._cache_key = version
+        if key not in self._cache:
+            self._cache[key] = read()
+        return self._cache[key]
+
+    def _query(self, sql: str, params: tuple = ()) -> List[tuple]:
+        return self.db.execute(sql, self._params() + params).fetchall()
+
+    def __len__(self) -> int:
+        return self._cached('len', lambda: self._query(f'SELECT COUNT(*) FROM ({self.source})')[0][0])
+
+    def __contains__(self, chat_id: int) -> bool:
+        return self.get(chat_id=chat_id) is not None
+
+    def __iter__(self) -> Iterator[LeaderItem]:
+        """Записи в порядке убывания результата."""
+        for row in self._query(f'{self.source} ORDER BY score DESC, created_at DESC'):
+            yield LeaderItem(*row)
+
+    def get(self, chat_id: int) -> Optional[LeaderItem]:
+        def read():
+            rows = self._query(f'{_RESULTS} AND chat_id = ? ORDER BY score DESC, created_at LIMIT 1', (chat_id,))
+            return LeaderItem(*rows[0]) if rows else None
+
+        return self._cached(('get', chat_id), read)
+
+    def score(self, chat_id: int) -> Optional[int]:
+        item = self.get(chat_id=chat_id)
+        return item.score if item is not None else None
+
+    def rank(self, chat_id: int) -> int:
+        """Позиция пользователя начиная с 1, или POS_NOT_FOUND."""
+        item = self.get(chat_id=chat_id)
+        if item is None:
+            return POS_NOT_FOUND
+
+        def read():
+            rows = self._query(
+                f'SELECT COUNT(*) FROM ({self.source}) WHERE score > ? OR (score = ? AND created_at > ?)',
+                (item.score, item.score, item.created_at),
+            )
+            return rows[0][0] + 1
+
+        return self._cached(('rank', chat_id), read)
+
+    def position(self, score: int, created_at: float, after: bool = False) -> int:
+        """Сколько записей выше результата ``(score, created_at)``, с ``after`` - вместе с равными ему."""
+        op = '>=' if after else '>'
+        return self._cached(('position', score, created_at, after), lambda: self._query(
+            f'SELECT COUNT(*) FROM ({self.source}) WHERE score > ? OR (score = ? AND created_at {op} ?)',
+            (score, score, created_at),
+        )[0][0])
+
+    def top(self, n: int) -> List[LeaderItem]:
+        return self.ranked(first=1, last=n)
+
+    def ranked(self, first: int, last: int) -> List[LeaderItem]:
+        """Записи на позициях с ``first`` по ``last`` включительно (с 1)."""
+        first = max(first, 1)
+        if last < first:
+            return []
+        return self._cached(('ranked', first, last), lambda: [
+            LeaderItem(*row) for row in self._query(
+                f'{self.source} ORDER BY score DESC, created_at DESC LIMIT ? OFFSET ?',
+                (last - first + 1, first - 1),
+            )
+        ])
+
+
+class SqliteLeaderBoard(LeaderBoard):
+    """ LeaderBoard, который хранит результаты в общей базе SQLite вместо памяти процесса.
+
+        Результат раунда - строка ``(board, round, chat_id)``, уникальность которой проверяет сама база,
+        поэтому результат нельзя добавить дважды даже из разных процессов. Суточная таблица не переносится
+        в конце раунда, а читается как лучшие результаты последних ``rounds_to_expire`` раундов. Номер раунда
+        считается от начала эпохи и одинаков во всех процессах.
+    """
+
+    def __init__(self, db: SqliteDatabase, board: int = 0, round_duration: timedelta = None,
+                 expire_delta: timedelta = None):
+        self._init_rules(round_duration=round_duration, expire_delta=expire_delta)
+        self.db = db
+        self.board = board
+        self.round_counter = RoundClock(period=self.round_duration.total_seconds()).current()
+
+        self.last_game = SqliteTable(db=db, board=board, rounds=lambda: (self.round_counter, self.round_counter + 1))
+        self.last_day = SqliteTable(db=db, board=board, rounds=lambda: (self.day_start, self.round_counter), unique=False)
+
+    @property
+    def version(self) -> Any:
+        """Меняется вместе с базой и номером раунда."""
+        return self.db.version(), self.round_counter
+
+    @property
+    def day_start(self) -> int:
+        """Первый раунд, который входит в суточную таблицу: окно из последних ``rounds_to_expire`` раундов."""
+        return self.round_counter - self.rounds_to_expire
+
+    def begin_dump(self) -> Callable[[], None]:
+        # Каждая запись сразу попадает в базу
+        return lambda: None
+
+    def begin_checkpoint(self) -> Callable[[], None]:
+        return lambda: None
+
+    @property
+    def durable_lag(self) -> int:
+        return 0
+
+    def refresh(self) -> bool:
+        # Другие процессы пишут в ту же базу, дочитывать нечего
+        return True
+
+    def close(self):
+        pass
+
+    def add_result(self, chat_id: int, full_name: str, score: int) -> int:
+        """Добавить результат в общую таблицу, и вернуть место пользователя в текущем раунде."""
+        self.release(chat_id=chat_id)
+        cursor = self.db.execute(
+            'INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+            (self.board, self.round_counter, chat_id, full_name, score, time.time()),
+        )
+        if cursor.rowcount == 0:
+            raise BoardUserAlreadyExists
+        return self.user_stats(chat_id=chat_id)
+
+    def new_round(self):
+        """Новый раунд: переносить нечего, остаётся удалить результаты, выпавшие из суточной таблицы."""
+        self.round_counter += 1
+        self.prune(before=self.day_start)
+        self.expire_reservations()
+
+    def catch_up(self, round_counter: int):
+        if self.round_counter < round_counter:
+            self.round_counter = round_counter
+            self.prune(before=self.day_start)
+
+    def prune(self, before: int):
+        """Удалить результаты раундов до ``before``. Другие процессы могут сделать то же самое - это не страшно."""
+        self.db.execute('DELETE FROM results WHERE board = ? AND round < ?', (self.board, before))
@@ -0,0 +1,211 @@
+import asyncio
+import tempfile
+import time
+from functools import partial
+from unittest import IsolatedAsyncioTestCase
+
+from src.bench import e2e
+from src.bench.fake_telegram import FakeTelegramServer
+from src.bot import Manager
+from src.constants import COMMAND_ROLL, COMMAND_ROUND_LEADERS
+from src.registry import GLOBAL_BOARD, BoardRegistry
+from src.utils.process import PidLock
+from src.utils.storage import FORMAT_BIN
+
+
+class EndToEndTestCase(IsolatedAsyncioTestCase):
+
+    async def test_fake_api(self):
+        res = await e2e.run(
+            users=5,
+            duration=0.5,
+            commands=e2e.DEFAULT_COMMANDS,
+            latency_ms=1,
+            jitter_ms=0,
+            error_rate=0,
+            flood_rate=0,
+            timeout=5,
+            roll_delay=0,
+            chat_rate=100,
+        )
+        self.assertEqual(res['timeouts'], 0)
+        self.assertGreater(res['completed'], 5)
+        self.assertEqual(set(res['by_command']), set(e2e.DEFAULT_COMMANDS))
+        self.assertEqual(set(res['handlers']), {'roll_once', 'roll_stats_round', 'roll_stats_total'})
+        # Три кубика на каждый бросок
+        self.assertEqual(res['calls']['senddice'] % 3, 0)
+        self.assertEqual(res['sender']['failed'], 0)
+
+    async def test_round_notify(self):
+        server = FakeTelegramServer()
+        await server.start()
+        results = []
+
+        def on_send(method: str, chat_id: int, message: dict):
+            if method == 'sendmessage' and 'Раунд завершён' in message['text']:
+                results.append((chat_id, message['text']))
+
+        server.on_send = on_send
+        with tempfile.TemporaryDirectory() as tmp:
+            m, polling = await e2e.start_bot(server=server, base_path=tmp, roll_animation_delay=0, notify_rounds=True)
+            await m.loading
+            board = m.boards.get(chat_id=GLOBAL_BOARD)
+            for chat_id, score in [(1, 10), (2, 30), (3, 20)]:
+                board.add_result(chat_id=chat_id, full_name=f'User {chat_id}', score=score)
+
+            # Бюджет на раунд - два сообщения, худший участник пропускается
+            m.notifier.share = 2 / m.notifier.round_seconds / m.sender.global_rate
+            m.boards.advance(round_counter=m.boards.round_counter + 1)
+            await m.notifier.worker
+            await e2e.stop_bot(m=m, polling=polling)
+        await server.close()
+
+        self.assertEqual([chat_id for chat_id, _ in results], [2, 3])
+        self.assertIn('Ваше место: *1* из 3', results[0][1])
+        self.assertEqual((m.notifier.sent, m.notifier.skipped, m.notifier.rounds), (2, 1, 1))
+
+    async def test_roll_reserved_while_sending(self):
+        # Кубики отправляются медленно, повторная команда приходит, пока первая их ждёт
+        server = FakeTelegramServer(latency=0.3)
+        await server.start()
+        with tempfile.TemporaryDirectory() as tmp:
+            m, polling = await e2e.start_bot(server=server, base_path=tmp, roll_animation_delay=0)
+            await m.loading
+            server.push_message(chat_id=1, text=f'/{COMMAND_ROLL}')
+            await asyncio.sleep(0.1)
+            server.push_message(chat_id=1, text=f'/{COMMAND_ROLL}')
+            while not server.calls['sendmessage']:
+                await asyncio.sleep(0.05)
+            await e2e.stop_bot(m=m, polling=polling)
+        await server.close()
+
+        self.assertEqual(server.calls['senddice'], 3)
+        self.assertEqual(m.rolls_rejected, 1)
+        self.assertEqual(m.boards.get(chat_id=GLOBAL_BOARD).reservations, {})
+
+    async def test_roll_survives_eviction(self):
+        # Пока кубики отправляются, другая группа вытесняет таблицу броска из памяти
+        server = FakeTelegramServer(latency=0.3)
+        await server.start()
+        with tempfile.TemporaryDirectory() as tmp:
+            m, polling = await e2e.start_bot(server=server, base_path=tmp, roll_animation_delay=0)
+            await m.loading
+            m.boards.capacity = 1
+            server.push_message(chat_id=-10, text=f'/{COMMAND_ROLL}', chat_type='group')
+            while not m.boards.boards.get(-10, None) or not m.boards.boards[-10].in_flight:
+                await asyncio.sleep(0.01)
+            server.push_message(chat_id=-20, text=f'/{COMMAND_ROUND_LEADERS}', chat_type='group')
+            while server.calls['sendmessage'] < 2:
+                await asyncio.sleep(0.05)
+            self.assertEqual(list(m.boards.boards), [-10, -20])
+
+            # Следующая загрузка вытесняет таблицу, когда бросок уже записан
+            await m.boards.get_async(chat_id=-30)
+            self.assertEqual(list(m.boards.boards), [-30])
+            board = await m.boards.get_async(chat_id=-10)
+            self.assertIsNotNone(board.last_game.get(-10))
+            await e2e.stop_bot(m=m, polling=polling)
+        await server.close()
+
+    async def test_shutdown_timeout(self):
+        server = FakeTelegramServer()
+        await server.start()
+        with tempfile.TemporaryDirectory() as tmp:
+            m, polling = await e2e.start_bot(server=server, base_path=tmp)
+            await m.loading
+            m.boards.get(chat_id=GLOBAL_BOARD).add_result(chat_id=1, full_name='User 1', score=10)
+
+            # Очередь в группу отправлялась бы несколько минут
+            sends = [
+                asyncio.ensure_future(m.sender.send(chat_id=-1, call=partial(m.bot.send_message, -1, f'Message {i}')))
+                for i in range(40)
+            ]
+            m.shutdown_timeout = 0.3
+            t0 = time.perf_counter()
+            await e2e.stop_bot(m=m, polling=polling)
+            elapsed = time.perf_counter() - t0
+            await asyncio.gather(*sends, return_exceptions=True)
+
+            board = BoardRegistry(base_path=tmp, journal=True, fmt=FORMAT_BIN).get(chat_id=GLOBAL_BOARD)
+        await server.close()
+
+        self.assertLess(elapsed, 3)
+        self.assertEqual(m.sender.dropped, 20)
+        self.assertEqual(board.current_stats()[0][1].score, 10)
+
+    async def test_shutdown_releases_lock_before_drain(self):
+        server = FakeTelegramServer(latency=0.2)
+        await server.start()
+        with tempfile.TemporaryDirectory() as tmp:
+            m, polling = await e2e.start_bot(server=server, base_path=tmp, roll_animation_delay=0)
+            await m.loading
+            board = m.boards.get(chat_id=GLOBAL_BOARD)
+            server.push_message(chat_id=1, text=f'/{COMMAND_ROLL}')
+            while not board.in_flight:
+                await asyncio.sleep(0.01)
+            sends = [
+                asyncio.ensure_future(m.sender.send(chat_id=-1, call=partial(m.bot.send_message, -1, f'Message {i}')))
+                for i in range(40)
+            ]
+            m.shutdown_timeout = 1.0
+            lock = PidLock(path=m.pid_lock.path)
+            self.assertIsNotNone(lock.owner())
+            stopping = asyncio.ensure_future(e2e.stop_bot(m=m, polling=polling))
+
+            # Блокировку отпускают сразу после сохранения, очередь в группу ещё отправляется
+            while lock.owner() is not None:
+                await asyncio.sleep(0.01)
+            self.assertFalse(stopping.done())
+            # Начатый бросок дождались и сохранили
+            restored = BoardRegistry(base_path=tmp, journal=True, fmt=FORMAT_BIN).get(chat_id=GLOBAL_BOARD)
+            self.assertIsNotNone(restored.last_game.get(1))
+            await stopping
+            await asyncio.gather(*sends, return_exceptions=True)
+        await server.close()
+
+    async def test_pages(self):
+        server = FakeTelegramServer()
+        await server.start()
+        replies = asyncio.Queue()
+        server.on_send = lambda method, chat_id, message: replies.put_nowait((method, message))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            m, polling = await e2e.start_bot(server=server, base_path=tmp)
+            await m.loading
+            board = m.boards.get(chat_id=GLOBAL_BOARD)
+            for chat_id in range(1, 26):
+                board.add_result(chat_id=chat_id, full_name=f'User {chat_id}', score=chat_id)
+
+            server.push_message(chat_id=1, text=f'/{COMMAND_ROUND_LEADERS}')
+            _, message = await asyncio.wait_for(replies.get(), timeout=5)
+            buttons = message['reply_markup']['inline_keyboard'][0]
+            self.assertEqual([b['text'] for b in buttons], ['Дальше »'])
+
+            # Вторая страница, потом третья - последняя
+            server.push_callback(chat_id=1, message_id=message['message_id'], data=buttons[0]['callback_data'])
+            method, page = await asyncio.wait_for(replies.get(), timeout=5)
+            self.assertEqual(method, 'editmessagetext')
+            self.assertIn('места 11-20 из 25', page['text'])
+            buttons = page['reply_markup']['inline_keyboard'][0]
+            self.assertEqual([b['text'] for b in buttons], ['« Назад', 'Дальше »'])
+
+            server.push_callback(chat_id=1, message_id=message['message_id'], data=buttons[1]['callback_data'])
+            _, page = await asyncio.wait_for(replies.get(), timeout=5)
+            self.assertIn('места 21-25 из 25', page['text'])
+            self.assertIn('User 5', page['text'])
+            await e2e.stop_bot(m=m, polling=polling)
+        await server.close()
+
+        self.assertEqual(server.calls['answercallbackquery'], 2)
+        self.assertEqual(m.func_counter['show_page'], 2)
+
+    async def test_set_webhook(self):
+        server = FakeTelegramServer()
+        await server.start()
+        with tempfile.TemporaryDirectory() as tmp:
+            m = Manager(token='123456:e2e', api_server=server.api_server, base_path=tmp)
+            await m.set_webhook(url='https://example.com/webhook', secret_token=m.webhook_secret)
+            await (await m.bot.get_session()).close()
+        await server.close()
+
+        self.assertEqual(server.webhook, {'url': 'https://example.com/webhook', 'secret_token': m.webhook_secret})
@@ -1,11 +1,24 @@
+import os
+import random
+import tempfile
 import time
 from dataclasses import asdict
-from datetime import timedelta
+from datetime import datetime, timedelta
 from unittest import TestCase
 
 from freezegun import freeze_time
 
-from src.leaderboard import LeaderBoard, LeaderItem, BoardUserAlreadyExists
+from src.leaderboard import (
+    BoardIndex,
+    BoardUserAlreadyExists,
+    LeaderBoard,
+    LeaderItem,
+    PageCursor,
+    POS_NOT_FOUND,
+    sort_board,
+)
+from src.sqlite_board import SqliteDatabase, SqliteLeaderBoard
+from src.utils.storage import FORMAT_BIN
 
 
 class LeaderBoardTestCase(TestCase):
@@ -84,23 +97,75 @@ class LeaderBoardTestCase(TestCase):
         self.assertEqual(board.time_left, 120.0)
 
     def test_result_expire(self):
-        board = LeaderBoard(
-            round_duration=timedelta(seconds=10),
-            expire_delta=timedelta(seconds=20),
-            dry_run=True,
-        )
-        board.add_result(chat_id=1, full_name='FUU', score=10)
+        with freeze_time('2020-12-19T12:00:00') as frozen:
+            board = LeaderBoard(
+                round_duration=timedelta(seconds=10),
+                expire_delta=timedelta(seconds=20),
+                dry_run=True,
+            )
+            frozen.tick(5)
+            board.add_result(chat_id=1, full_name='FUU', score=10)
 
-        # Обновить результаты
-        for _ in range(2):
+            # Обновить результаты
+            for delta in (5, 10):
+                frozen.tick(delta)
+                board.new_round()
+                stats = board.total_stats()
+                self.assertEqual(len(stats), 1)
+
+            # Снова обновить результаты, в этот раз результат старше 20 секунд
+            frozen.tick(10)
             board.new_round()
             stats = board.total_stats()
-            self.assertEqual(len(stats), 1)
+            self.assertEqual(len(stats), 0)
 
-        # Снова обновить результаты, в этот раз пришло время очищать результаты
-        board.new_round()
-        stats = board.total_stats()
-        self.assertEqual(len(stats), 0)
+    def test_result_expire_fallback(self):
+        with freeze_time('2020-12-19T12:00:00') as frozen:
+            board = LeaderBoard(
+                round_duration=timedelta(seconds=10),
+                expire_delta=timedelta(seconds=35),
+                dry_run=True,
+            )
+            for score in (10, 5, 7, 3):
+                frozen.tick(10)
+                board.add_result(chat_id=1, full_name='F1', score=score)
+                if score == 5:
+                    board.add_result(chat_id=2, full_name='F2', score=6)
+                board.new_round()
+            self.assertEqual([(i.chat_id, i.score) for _, i in board.total_stats()], [(1, 10), (2, 6)])
+            # 5 хуже более нового 7 и уже никогда не станет лучшим
+            self.assertEqual([i.score for i in board.day_window.fallbacks[1]], [7, 3])
+
+            # Истёк лучший результат - на его место встаёт следующий лучший из окна
+            frozen.tick(10)
+            self.assertEqual(board.expire_day(), 1)
+            self.assertEqual([(i.chat_id, i.score) for _, i in board.total_stats()], [(1, 7), (2, 6)])
+
+            frozen.tick(20)
+            self.assertEqual(board.expire_day(limit=1), 1)
+            self.assertEqual([(i.chat_id, i.score) for _, i in board.total_stats()], [(1, 7)])
+            self.assertEqual(board.expire_day(), 1)
+            self.assertEqual([(i.chat_id, i.score) for _, i in board.total_stats()], [(1, 3)])
+
+            frozen.tick(10)
+            board.expire_day()
+            self.assertEqual(board.total_stats(), [])
+            self.assertEqual(board.day_window.fallbacks, {})
+
+    def test_day_fallbacks_restore(self):
+        with tempfile.TemporaryDirectory() as path, freeze_time('2020-12-19T12:00:00') as frozen:
+            board = LeaderBoard(journal=True, base_path=path, fmt=FORMAT_BIN, expire_delta=timedelta(minutes=10))
+            for score in (10, 7):
+                frozen.tick(120)
+                board.add_result(chat_id=1, full_name='F1', score=score)
+                board.new_round()
+            board.dump_data()
+            board.close()
+
+            restored = LeaderBoard(journal=True, base_path=path, fmt=FORMAT_BIN, expire_delta=timedelta(minutes=10))
+            frozen.tick(9 * 60)
+            restored.expire_day()
+            self.assertEqual(restored.total_stats()[0][1].score, 7)
 
     @freeze_time('2020-12-19T12:00:00.0000')
     def test_leader_item(self):
@@ -111,3 +176,381 @@ class LeaderBoardTestCase(TestCase):
             created_at=time.time(),
         )
         self.assertEqual(str(item), '[[Vladimir Kasatkin]] - *123* - 12:00 19.12.2020')
+
+    def test_reserve(self):
+        with freeze_time('2020-12-19T12:00:00') as frozen:
+            board = LeaderBoard(dry_run=True)
+            self.assertTrue(board.reserve(chat_id=1))
+            # Пока бросок идёт, второй не начинается
+            self.assertFalse(board.reserve(chat_id=1))
+            self.assertTrue(board.is_reserved(chat_id=1))
+            self.assertTrue(board.reserve(chat_id=2))
+
+            board.add_result(chat_id=1, full_name='F1', score=1)
+            self.assertFalse(board.is_reserved(chat_id=1))
+            self.assertFalse(board.reserve(chat_id=1))
+
+            # Неудачный бросок можно повторить сразу
+            board.release(chat_id=2)
+            self.assertTrue(board.reserve(chat_id=2))
+
+            # Брошенная бронь истекает
+            frozen.tick(board.reservation_ttl)
+            self.assertFalse(board.is_reserved(chat_id=2))
+            board.new_round()
+            self.assertEqual(board.reservations, {})
+            self.assertTrue(board.reserve(chat_id=1))
+
+    def test_rank_matches_sort(self):
+        board = LeaderBoard(
+            dry_run=True,
+        )
+        board.last_game._order.load = 8
+        rnd = random.Random(1)
+        items = []
+        for chat_id in range(300):
+            board.add_result(chat_id=chat_id, full_name=f'F{chat_id}', score=rnd.randint(1, 216))
+            items.append(board.last_game.get(chat_id=chat_id))
+
+        expected = sort_board(items)
+        self.assertEqual(list(board.last_game), expected)
+        for pos, item in enumerate(expected):
+            self.assertEqual(board.user_stats(chat_id=item.chat_id), pos + 1)
+        self.assertEqual(board.user_stats(chat_id=1000), POS_NOT_FOUND)
+
+        # Свою позицию видно даже вне первой десятки
+        last = expected[-1]
+        stats = board.current_stats(chat_id=last.chat_id)
+        self.assertEqual(len(stats), 11)
+        self.assertEqual(stats[-1], (300, last))
+
+    def test_rank_queries(self):
+        board = LeaderBoard(
+            dry_run=True,
+        )
+        board.last_game._order.load = 8
+        rnd = random.Random(2)
+        for chat_id in range(100):
+            board.add_result(chat_id=chat_id, full_name=f'F{chat_id}', score=rnd.randint(1, 216))
+        expected = list(enumerate(board.last_game, start=1))
+        array = board.last_game
+
+        self.assertEqual(board.ranked(array=array, first=11, last=20), expected[10:20])
+        self.assertEqual(board.ranked(array=array, first=95, last=200), expected[94:])
+        self.assertEqual(board.ranked(array=array, first=0, last=1), expected[:1])
+        self.assertEqual(board.ranked(array=array, first=5, last=4), [])
+
+        for pos, item in expected:
+            self.assertEqual(
+                board.neighbours(array=array, chat_id=item.chat_id, k=2),
+                expected[max(pos - 3, 0):pos + 2],
+            )
+        self.assertEqual(board.neighbours(array=array, chat_id=1000, k=2), [])
+
+        self.assertEqual(board.percentile(array=array, chat_id=expected[0][1].chat_id), 100)
+        self.assertEqual(board.percentile(array=array, chat_id=expected[-1][1].chat_id), 1)
+        self.assertEqual(board.percentile(array=array, chat_id=expected[49][1].chat_id), 51)
+        self.assertIsNone(board.percentile(array=array, chat_id=1000))
+
+    def test_new_round_merge(self):
+        board = LeaderBoard(
+            dry_run=True,
+        )
+        rnd = random.Random(2)
+        results = []
+        for _ in range(5):
+            for chat_id in rnd.sample(range(100), 40):
+                board.add_result(chat_id=chat_id, full_name=f'F{chat_id}', score=rnd.randint(1, 216))
+                results.append(board.last_game.get(chat_id=chat_id))
+            board.new_round()
+
+        # Лучший результат каждого пользователя, как при полном пересчёте
+        best = {}
+        for item in results:
+            if item.chat_id not in best or item.score > best[item.chat_id].score:
+                best[item.chat_id] = item
+        self.assertEqual(list(board.last_day), sort_board(best.values()))
+        self.assertEqual(len(board.last_game), 0)
+
+    def test_journal_restore(self):
+        with tempfile.TemporaryDirectory() as path:
+            board = LeaderBoard(journal=True, base_path=path)
+            board.add_result(chat_id=1, full_name='F1', score=5)
+            board.new_round()
+            board.add_result(chat_id=1, full_name='F1', score=7)
+            board.add_result(chat_id=2, full_name='F2', score=3)
+            board.dump_data()
+
+            restored = LeaderBoard(journal=True, base_path=path)
+            self.assertEqual(list(restored.last_game), list(board.last_game))
+            self.assertEqual(list(restored.last_day), list(board.last_day))
+
+    def test_round_archive(self):
+        with tempfile.TemporaryDirectory() as path:
+            board = LeaderBoard(journal=True, base_path=path, archive=True)
+            played = []
+            for n in range(3):
+                for chat_id in range(5):
+                    board.add_result(chat_id=chat_id, full_name=f'F{chat_id}', score=n + chat_id)
+                played.extend((n, item.chat_id, item.score) for item in board.last_game)
+                board.new_round()
+            board.new_round()
+            # На диск раунды попадают вместе с остальным сохранением
+            self.assertEqual(list(board.archive.results()), [])
+
+            board.dump_data()
+            # Пустой раунд в архив не попадает
+            self.assertEqual(sum(len(board.archive.index(day=day)) for day in board.archive.days()), 3)
+            self.assertEqual([(r.round_counter, r.chat_id, r.score) for r in board.archive.results()], played)
+            # Суточная таблица хранит только лучшие результаты, архив - все
+            self.assertEqual(len(board.last_day), 5)
+
+    def test_dump_copies_columns(self):
+        with tempfile.TemporaryDirectory() as path:
+            board = LeaderBoard(journal=True, base_path=path, fmt=FORMAT_BIN)
+            board.last_game_storage.compact_every = 1
+            for chat_id in range(10):
+                board.add_result(chat_id=chat_id, full_name=f'F{chat_id}', score=chat_id)
+            expected = list(board.last_game)
+            self.assertEqual(board.durable_lag, 10)
+
+            # Снимок сделан при подготовке, изменения до записи в него не попадают
+            job = board.begin_dump()
+            board.add_result(chat_id=100, full_name='F100', score=1)
+            job()
+            self.assertEqual(board.durable_lag, 1)
+            self.assertEqual(list(BoardIndex(board.last_game_storage._load_snapshot())), expected)
+
+            board.dump_data()
+            self.assertEqual(board.durable_lag, 0)
+
+            columns = board.last_game.copy_columns()
+            self.assertEqual(sort_board(columns), list(board.last_game))
+
+    def test_dump_skips_idle_board(self):
+        with tempfile.TemporaryDirectory() as path:
+            board = LeaderBoard(journal=True, base_path=path, fmt=FORMAT_BIN)
+            board.add_result(chat_id=1, full_name='F1', score=1)
+            board.new_round()
+            board.dump_data()
+            stat = os.stat(board.meta_storage.path)
+
+            # Пустые раунды ничего не меняют, и таблица не переписывается
+            board.new_round()
+            board.new_round()
+            board.dump_data()
+            self.assertEqual(os.stat(board.meta_storage.path).st_ino, stat.st_ino)
+            self.assertEqual(board.round_counter, 3)
+
+            board.add_result(chat_id=2, full_name='F2', score=2)
+            board.dump_data()
+            self.assertEqual(board.meta_storage.load()[0].round_counter, 3)
+
+    def test_checkpoint_durable_lag(self):
+        with tempfile.TemporaryDirectory() as path:
+            board = LeaderBoard(journal=True, base_path=path, fmt=FORMAT_BIN)
+            board.add_result(chat_id=1, full_name='F1', score=1)
+            board.begin_checkpoint()()
+            self.assertEqual(board.durable_lag, 0)
+
+        # Без журнала checkpoint ничего не пишет и не должен считать изменения сохранёнными
+        with tempfile.TemporaryDirectory() as path:
+            board = LeaderBoard(base_path=path, fmt=FORMAT_BIN)
+            board.add_result(chat_id=1, full_name='F1', score=1)
+            board.begin_checkpoint()()
+            self.assertEqual(board.durable_lag, 1)
+            board.dump_data()
+            self.assertEqual(board.durable_lag, 0)
+
+            # Имена строк из загруженного снимка дочитываются при записи
+            restored = LeaderBoard(journal=True, base_path=path, fmt=FORMAT_BIN)
+            restored.last_game_storage.save(objs=restored.last_game.copy_columns())
+            self.assertEqual(list(LeaderBoard(journal=True, base_path=path, fmt=FORMAT_BIN).last_game),
+                             list(board.last_game))
+
+    def test_binary_snapshot_restore(self):
+        with tempfile.TemporaryDirectory() as path:
+            board = LeaderBoard(journal=True, base_path=path, fmt=FORMAT_BIN)
+            board.last_day_storage.compact_every = 1
+            for chat_id in range(20):
+                board.add_result(chat_id=chat_id, full_name=f'F{chat_id}', score=chat_id % 7)
+            board.new_round()
+            board.add_result(chat_id=3, full_name='F3', score=100)
+            board.dump_data()
+
+            restored = LeaderBoard(journal=True, base_path=path, fmt=FORMAT_BIN)
+            self.assertEqual(list(restored.last_game), list(board.last_game))
+            self.assertEqual(list(restored.last_day), list(board.last_day))
+            self.assertEqual(restored.total_stats(chat_id=0), board.total_stats(chat_id=0))
+
+            restored.new_round()
+            self.assertEqual(restored.user_stats(chat_id=3), POS_NOT_FOUND)
+            self.assertEqual(restored.total_stats()[0][1].score, 100)
+
+    def test_board_index_columns(self):
+        board = BoardIndex()
+        board.insert(chat_id=1, full_name='F1', score=3, created_at=1.0)
+        board.insert(chat_id=2, full_name='F2', score=5, created_at=1.0)
+        self.assertEqual(board.remove(chat_id=1), LeaderItem(chat_id=1, full_name='F1', score=3, created_at=1.0))
+
+        # Строка удалённой записи переиспользуется
+        board.insert(chat_id=3, full_name='F3', score=9, created_at=2.0)
+        self.assertEqual(len(board.chat_ids), 2)
+        self.assertEqual([i.chat_id for i in board], [3, 2])
+        self.assertEqual(board.score(chat_id=3), 9)
+        self.assertIsNone(board.get(chat_id=1))
+
+        # Время сравнивается точно, при равных очках выше более новый результат
+        board.insert(chat_id=4, full_name='F4', score=9, created_at=2.0 - 1e-9)
+        board.insert(chat_id=5, full_name='F5', score=5, created_at=0.5)
+        self.assertEqual([i.chat_id for i in board], [3, 4, 2, 5])
+        self.assertEqual(board.get(chat_id=3).created_at, 2.0)
+        self.assertEqual((board.position(score=9, created_at=2.0), board.position(score=9, created_at=2.0, after=True)), (0, 1))
+        self.assertEqual([board.rank(chat_id=c) for c in (2, 3, 4, 5, 6)], [3, 1, 2, 4, POS_NOT_FOUND])
+
+    def test_pages(self):
+        with freeze_time('2020-12-19T12:00:00') as frozen:
+            board = LeaderBoard(dry_run=True)
+            for chat_id in range(1, 26):
+                board.add_result(chat_id=chat_id, full_name=f'F{chat_id}', score=chat_id)
+                frozen.tick(1)
+            array = board.last_game
+
+            rows, prev_cursor, next_cursor = board.page(array=array, offset=0)
+            version = board.version
+            self.assertEqual([pos for pos, _ in rows], list(range(1, 11)))
+            self.assertIsNone(prev_cursor)
+
+            # Курсор переживает кодирование, пока таблица не менялась - просто позиция
+            cursor = PageCursor.decode(next_cursor.encode())
+            self.assertEqual(cursor, next_cursor)
+            self.assertEqual(board.page_offset(array=array, cursor=cursor), 10)
+            self.assertIsNone(PageCursor.decode('broken'))
+
+            # Новые результаты выше страницы не сдвигают следующую: она начинается после последней показанной записи
+            for chat_id in range(100, 105):
+                board.add_result(chat_id=chat_id, full_name=f'F{chat_id}', score=chat_id)
+            offset = board.page_offset(array=array, cursor=cursor)
+            self.assertEqual(offset, 15)
+            rows, prev_cursor, next_cursor = board.page(array=array, offset=offset)
+            self.assertEqual([item.chat_id for _, item in rows], list(range(15, 5, -1)))
+            self.assertEqual(board.page_offset(array=array, cursor=prev_cursor), 5)
+
+            # Последняя страница неполная и без курсора дальше
+            rows, _, next_cursor = board.page(array=array, offset=25)
+            self.assertEqual([item.chat_id for _, item in rows], [5, 4, 3, 2, 1])
+            self.assertIsNone(next_cursor)
+
+            # После перезапуска счётчик версий дошёл до той же версии, но курсор прежнего процесса
+            # всё равно отсчитывается от своей границы, а не от позиции
+            restarted = LeaderBoard(dry_run=True)
+            for chat_id in range(1, 4):
+                restarted.add_result(chat_id=chat_id, full_name=f'F{chat_id}', score=chat_id)
+            restarted.version = version
+            self.assertEqual(restarted.page_offset(array=restarted.last_game, cursor=cursor), 0)
+
+    def test_render_cache(self):
+        board = LeaderBoard(dry_run=True)
+        calls = []
+
+        def render():
+            calls.append(board.version)
+            return [i.chat_id for _, i in board.leaders(array=board.last_game)]
+
+        self.assertEqual(board.cached(key='last_game', render=render), [])
+        board.add_result(chat_id=1, full_name='F1', score=5)
+        self.assertEqual(board.cached(key='last_game', render=render), [1])
+        self.assertEqual(board.cached(key='last_game', render=render), [1])
+        self.assertEqual(len(calls), 2)
+
+        for chat_id in range(2, 13):
+            board.add_result(chat_id=chat_id, full_name=f'F{chat_id}', score=10 + chat_id)
+        self.assertEqual(board.user_position(array=board.last_game, chat_id=1)[0], 12)
+        self.assertIsNone(board.user_position(array=board.last_game, chat_id=12))
+
+        board.new_round()
+        self.assertEqual(board.cached(key='last_game', render=render), [])
+        self.assertEqual(len(calls), 3)
+
+        # Кэш страниц ограничен
+        board.render_cache_max = 4
+        for offset in range(10):
+            board.cached(key=f'last_game:page:{offset}', render=render)
+        self.assertLessEqual(len(board.render_cache), 4)
+        self.assertIn('last_game:page:9', board.render_cache)
+
+
+class SqliteLeaderBoardTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = f'{self.tmp.name}/boards.sqlite3'
+
+    def make_board(self, **kwargs) -> SqliteLeaderBoard:
+        db = SqliteDatabase(path=self.path)
+        self.addCleanup(db.close)
+        return SqliteLeaderBoard(db=db, board=-1, **kwargs)
+
+    def test_same_as_memory(self):
+        rules = dict(round_duration=timedelta(seconds=10), expire_delta=timedelta(seconds=30))
+        start = datetime(2020, 12, 19, 12, 0, 0)
+
+        def table(stats):
+            return [(pos, item.chat_id, item.score) for pos, item in stats]
+
+        with freeze_time(start) as frozen:
+            memory = LeaderBoard(dry_run=True, **rules)
+            board = self.make_board(**rules)
+            board.round_counter = memory.round_counter
+
+            rnd = random.Random(3)
+            for k in range(8):
+                for j, chat_id in enumerate(rnd.sample(range(50), 20)):
+                    frozen.move_to(start + timedelta(seconds=k * 10 + (j + 1) / 100))
+                    score = rnd.randint(1, 216)
+                    self.assertEqual(
+                        board.add_result(chat_id=chat_id, full_name=f'F{chat_id}', score=score),
+                        memory.add_result(chat_id=chat_id, full_name=f'F{chat_id}', score=score),
+                    )
+                for chat_id in range(50):
+                    self.assertEqual(table(board.current_stats(chat_id=chat_id)),
+                                     table(memory.current_stats(chat_id=chat_id)))
+                    self.assertEqual(
+                        table(board.neighbours(array=board.last_game, chat_id=chat_id, k=2)),
+                        table(memory.neighbours(array=memory.last_game, chat_id=chat_id, k=2)),
+                    )
+                    self.assertEqual(board.percentile(array=board.last_game, chat_id=chat_id),
+                                     memory.percentile(array=memory.last_game, chat_id=chat_id))
+
+                # Суточная таблица - последние три раунда
+                frozen.move_to(start + timedelta(seconds=(k + 1) * 10))
+                memory.new_round()
+                board.new_round()
+                for chat_id in range(50):
+                    self.assertEqual(table(board.total_stats(chat_id=chat_id)), table(memory.total_stats(chat_id=chat_id)))
+                self.assertEqual(len(board.last_day), len(memory.last_day))
+                for item in memory.last_day.top(5):
+                    for after in (False, True):
+                        self.assertEqual(
+                            board.last_day.position(score=item.score, created_at=item.created_at, after=after),
+                            memory.last_day.position(score=item.score, created_at=item.created_at, after=after),
+                        )
+
+    def test_shared_between_processes(self):
+        first = self.make_board()
+        second = self.make_board()
+        self.assertEqual(first.round_counter, second.round_counter)
+
+        # Прочитать таблицу, чтобы она попала в кэш второго процесса
+        self.assertTrue(second.can_add_result(chat_id=1))
+        version = second.version
+
+        first.add_result(chat_id=1, full_name='F1', score=5)
+        self.assertNotEqual(second.version, version)
+        self.assertFalse(second.can_add_result(chat_id=1))
+        with self.assertRaises(BoardUserAlreadyExists):
+            second.add_result(chat_id=1, full_name='F1', score=7)
+
+        second.add_result(chat_id=2, full_name='F2', score=7)
+        self.assertEqual([i.chat_id for _, i in first.current_stats()], [2, 1])
@@ -0,0 +1,253 @@
+import asyncio
+import os
+import tempfile
+from datetime import timedelta
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from freezegun import freeze_time
+
+from src.registry import BACKEND_SQLITE, GLOBAL_BOARD, BoardRegistry
+from src.utils.storage import FORMAT_BIN
+
+
+class BoardRegistryTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def make_registry(self, **kwargs) -> BoardRegistry:
+        return BoardRegistry(base_path=self.tmp.name, journal=True, fmt=FORMAT_BIN, **kwargs)
+
+    def test_separate_boards(self):
+        registry = self.make_registry()
+        registry.get(chat_id=-100).add_result(chat_id=1, full_name='F1', score=5)
+        registry.get(chat_id=-200).add_result(chat_id=1, full_name='F1', score=7)
+
+        self.assertEqual(registry.get(chat_id=-100).current_stats()[0][1].score, 5)
+        self.assertEqual(registry.get(chat_id=-200).current_stats()[0][1].score, 7)
+        self.assertEqual(registry.board_path(chat_id=GLOBAL_BOARD), self.tmp.name)
+        self.assertTrue(os.path.isdir(os.path.join(self.tmp.name, 'boards', '-100')))
+
+    def test_lru_eviction(self):
+        registry = self.make_registry(capacity=2)
+        registry.get(chat_id=-1).add_result(chat_id=1, full_name='F1', score=5)
+        registry.get(chat_id=-2)
+        registry.get(chat_id=-1)
+        registry.get(chat_id=-3)
+
+        # Вытеснена самая давно использованная таблица
+        self.assertEqual(list(registry.boards), [-1, -3])
+        registry.get(chat_id=-3)
+        registry.get(chat_id=-4)
+        self.assertNotIn(-1, registry.boards)
+
+        # И загружена обратно с диска
+        board = registry.get(chat_id=-1)
+        self.assertFalse(board.can_add_result(chat_id=1))
+
+    def test_reserved_board_not_evicted(self):
+        registry = self.make_registry(capacity=1)
+        self.assertTrue(registry.get(chat_id=-1).reserve(chat_id=1))
+        registry.get(chat_id=-2)
+
+        # Бронь не теряется: бросок закончится в той же таблице, в раунде, в котором придёт результат
+        self.assertEqual(list(registry.boards), [-1, -2])
+        registry.new_round()
+        registry.boards[-1].add_result(chat_id=1, full_name='F1', score=5)
+        self.assertEqual(registry.boards[-1].round_counter, registry.round_counter)
+
+        registry.get(chat_id=-3)
+        self.assertEqual(list(registry.boards), [-3])
+        self.assertEqual(registry.get(chat_id=-1).last_game.get(1).score, 5)
+
+    def test_open_archive(self):
+        registry = self.make_registry(capacity=1, archive=True)
+        registry.get(chat_id=-1)
+
+        # Неизвестная таблица не создаётся и не вытесняет загруженную
+        self.assertIsNone(registry.open_archive(chat_id=-2))
+        self.assertFalse(os.path.exists(registry.board_path(chat_id=-2)))
+        self.assertEqual(list(registry.boards), [-1])
+
+        self.assertIs(registry.open_archive(chat_id=-1), registry.boards[-1].archive)
+        registry.get(chat_id=-3)
+        archive = registry.open_archive(chat_id=-1)
+        self.assertEqual(archive.path, os.path.join(registry.board_path(chat_id=-1), 'archive'))
+        self.assertEqual(list(registry.boards), [-3])
+
+    def test_cold_board_catch_up(self):
+        with freeze_time('2020-12-19T12:00:00') as frozen:
+            registry = self.make_registry(capacity=1, round_duration=timedelta(seconds=10),
+                                          expire_delta=timedelta(seconds=30))
+            registry.round_counter = 30
+            registry.get(chat_id=-1).add_result(chat_id=1, full_name='F1', score=5)
+            registry.get(chat_id=-2)
+
+            # Таблица выгружена, но её раунд всё равно закрылся
+            frozen.tick(10)
+            registry.new_round()
+            board = registry.get(chat_id=-1)
+            self.assertEqual(board.round_counter, 31)
+            self.assertTrue(board.can_add_result(chat_id=1))
+            self.assertEqual(board.total_stats()[0][1].score, 5)
+
+            # Пока таблица выгружена, результат истёк
+            registry.get(chat_id=-2)
+            for _ in range(3):
+                frozen.tick(10)
+                registry.new_round()
+            board = registry.get(chat_id=-1)
+        self.assertEqual(board.round_counter, 34)
+        self.assertEqual(board.total_stats(), [])
+
+    def test_handoff(self):
+        with freeze_time('2020-12-19T12:00:00') as frozen:
+            old = self.make_registry(round_duration=timedelta(seconds=10))
+            board = old.get(chat_id=GLOBAL_BOARD)
+            board.add_result(chat_id=1, full_name='F1', score=5)
+            frozen.tick(10)
+            old.new_round()
+            board.add_result(chat_id=1, full_name='F1', score=3)
+            board.add_result(chat_id=2, full_name='F2', score=6)
+            board.dump_data()
+
+            # Новый процесс загружает таблицу, пока старый ещё работает
+            new = self.make_registry(round_duration=timedelta(seconds=10))
+            new.preload(chat_id=GLOBAL_BOARD)
+            preloaded = new.boards[GLOBAL_BOARD]
+            board.add_result(chat_id=3, full_name='F3', score=4)
+            frozen.tick(10)
+            old.new_round()
+            board.add_result(chat_id=2, full_name='F2', score=1)
+            # Остановка старого процесса: журналы дописаны, снимки не переписаны
+            board.dump_data()
+            board.close()
+
+            new.refresh()
+            handed = new.get(chat_id=GLOBAL_BOARD)
+        # Таблица дочитана из журналов, а не загружена заново
+        self.assertIs(handed, preloaded)
+        self.assertEqual(handed.round_counter, board.round_counter)
+        self.assertEqual(handed.current_stats(), board.current_stats())
+        self.assertEqual(handed.total_stats(), board.total_stats())
+        self.assertFalse(handed.can_add_result(chat_id=2))
+        self.assertTrue(handed.can_add_result(chat_id=3))
+
+    def test_sqlite_backend(self):
+        first = BoardRegistry(base_path=self.tmp.name, backend=BACKEND_SQLITE)
+        second = BoardRegistry(base_path=self.tmp.name, backend=BACKEND_SQLITE)
+        first.get(chat_id=-1).add_result(chat_id=1, full_name='F1', score=5)
+
+        self.assertFalse(second.get(chat_id=-1).can_add_result(chat_id=1))
+        self.assertTrue(second.get(chat_id=-2).can_add_result(chat_id=1))
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp.name, 'boards.sqlite3')))
+
+        first.new_round()
+        second.new_round()
+        self.assertTrue(second.get(chat_id=-1).can_add_result(chat_id=1))
+        self.assertEqual(second.get(chat_id=-1).total_stats()[0][1].score, 5)
+
+
+class BoardRegistryRoundsTestCase(IsolatedAsyncioTestCase):
+
+    async def test_run_rounds(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        registry = BoardRegistry(base_path=tmp.name, journal=True, fmt=FORMAT_BIN,
+                                 round_duration=timedelta(seconds=1))
+        start = registry.round_counter
+        board = registry.get(chat_id=-1)
+        board.add_result(chat_id=1, full_name='F1', score=5)
+
+        task = asyncio.ensure_future(registry.run_rounds())
+
+        async def next_round():
+            while registry.round_counter == start:
+                await asyncio.sleep(0.01)
+
+        await asyncio.wait_for(next_round(), timeout=2)
+        self.assertTrue(board.can_add_result(chat_id=1))
+        self.assertGreater(board.round_counter, start)
+        self.assertLessEqual(registry.time_left, 1)
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        registry.dump_data()
+        self.assertEqual(BoardRegistry(base_path=tmp.name).load(chat_id=-1).round_counter, board.round_counter)
+
+    async def test_get_async(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        registry = BoardRegistry(base_path=tmp.name, journal=True, fmt=FORMAT_BIN)
+        registry.get(chat_id=-1).add_result(chat_id=1, full_name='F1', score=5)
+        registry.dump_data()
+
+        registry = BoardRegistry(base_path=tmp.name, journal=True, fmt=FORMAT_BIN)
+        start = registry.round_counter
+        # Все запросы во время загрузки получают одну и ту же таблицу
+        first = asyncio.ensure_future(registry.get_async(chat_id=-1))
+        await asyncio.sleep(0)
+        self.assertIn(-1, registry.loading)
+        # Раунд сменился, пока таблица загружалась
+        registry.advance(round_counter=start + 1)
+        second = await registry.get_async(chat_id=-1)
+        self.assertIs(await first, second)
+        self.assertEqual(registry.loading, {})
+        self.assertEqual(second.round_counter, start + 1)
+        self.assertEqual(second.total_stats()[0][1].score, 5)
+        self.assertIs(await registry.get_async(chat_id=-1), second)
+
+    async def test_evict_in_executor(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        registry = BoardRegistry(base_path=tmp.name, journal=True, fmt=FORMAT_BIN, capacity=1)
+        (await registry.get_async(chat_id=-1)).add_result(chat_id=1, full_name='F1', score=5)
+        flushing = asyncio.ensure_future(registry.flush())
+        await asyncio.sleep(0)
+
+        # Вытесненная таблица сохраняется после начатого сохранения, а не на event loop
+        await registry.get_async(chat_id=-2)
+        evicting = registry.evicting[-1]
+        self.assertIs(registry.flushing, evicting)
+        self.assertFalse(evicting.done())
+
+        # И загружается обратно, когда допишет файлы
+        board = await registry.get_async(chat_id=-1)
+        self.assertTrue(evicting.done())
+        self.assertEqual(registry.evicting, {-2: registry.flushing})
+        self.assertFalse(board.can_add_result(chat_id=1))
+        await flushing
+        await registry.wait_flushed()
+        self.assertEqual(registry.evicting, {})
+
+    async def test_flush_backpressure(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        registry = BoardRegistry(base_path=tmp.name, journal=True, fmt=FORMAT_BIN)
+        board = registry.get(chat_id=-1)
+        board.add_result(chat_id=1, full_name='F1', score=5)
+        self.assertEqual(registry.durable_lag()[0], 1)
+
+        # Второе сохранение ждёт первое
+        await asyncio.gather(registry.flush(), registry.flush())
+        self.assertEqual((registry.flushes, registry.flush_waits), (2, 1))
+        self.assertEqual(registry.durable_lag(), (0, 0.0))
+
+    async def test_checkpoint(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        registry = BoardRegistry(base_path=tmp.name, journal=True, fmt=FORMAT_BIN)
+        registry.get(chat_id=-1).add_result(chat_id=1, full_name='F1', score=5)
+        registry.get(chat_id=-2)
+
+        # Только журналы изменённых таблиц, без снимков
+        await registry.checkpoint()
+        self.assertEqual((registry.checkpoints, registry.durable_lag()[0]), (1, 0))
+        board = registry.get(chat_id=-1)
+        self.assertFalse(os.path.exists(board.last_game_storage.path))
+        await registry.checkpoint()
+        self.assertEqual(registry.checkpoints, 1)
+
+        restored = BoardRegistry(base_path=tmp.name, journal=True, fmt=FORMAT_BIN).get(chat_id=-1)
+        self.assertEqual(restored.current_stats(), board.current_stats())
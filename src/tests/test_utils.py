@@ -1,7 +1,41 @@
-from unittest import TestCase
+import asyncio
+import os
+import random
+import tempfile
+import threading
+from array import array
+from dataclasses import dataclass
+from unittest import IsolatedAsyncioTestCase, TestCase
 
+from aiogram.utils.exceptions import RetryAfter
+
+from src.bench.leaderboard import compare, run_suite
+from src.utils.archive import INDEX, RoundArchive
+from src.utils.cardinality import WINDOW_DAY, WINDOW_HOUR, WINDOW_LIFETIME, HyperLogLog, SketchRecord, UniqueCounter
+from src.utils.latency import LatencyRecorder, bucket_index, bucket_value, prometheus_text
 from src.utils.logs import pretty_time_delta
 from src.utils.misc import prepare_str
+from src.utils.process import PidLock
+from src.utils.ranking import KeyedRankIndex, RankIndex
+from src.utils.rowmap import RowMap
+from src.utils.scheduler import DeferredScheduler, RoundClock
+from src.utils.sender import PRIORITY_DICE, PRIORITY_STATS, OutboundDispatcher, TokenBucket
+from src.utils.snapshot import SnapshotReader, json_to_snapshot, snapshot_to_json, write_snapshot
+from src.utils.storage import FORMAT_BIN, JOURNAL_CLEAR, JOURNAL_DELETE, JOURNAL_PUT, Storage
+
+
+@dataclass
+class Item:
+    chat_id: int
+    score: int
+
+
+@dataclass
+class Row:
+    chat_id: int
+    full_name: str
+    score: int
+    created_at: float
 
 
 class MiscTestCase(TestCase):
@@ -22,3 +56,599 @@ class MiscTestCase(TestCase):
     def test_prepare_str(self):
         res = prepare_str([1, 2])
         self.assertEqual(res, '1\n2')
+
+
+class RankIndexTestCase(TestCase):
+
+    def test_matches_sorted_list(self):
+        rnd = random.Random(42)
+        index = RankIndex(load=4)
+        expected = []
+        for _ in range(500):
+            key = rnd.randint(0, 10 ** 6)
+            if key in expected:
+                continue
+            index.add(key)
+            expected.append(key)
+        expected.sort()
+        self.assertEqual(list(index), expected)
+
+        # Удалить половину ключей
+        for key in rnd.sample(expected, 250):
+            index.remove(key)
+            expected.remove(key)
+        self.assertEqual(list(index), expected)
+        self.assertEqual(len(index), len(expected))
+
+        for pos, key in enumerate(expected):
+            self.assertEqual(index.index(key), pos)
+            self.assertEqual(index[pos], key)
+        self.assertEqual(index[-1], expected[-1])
+        self.assertEqual(list(index.islice(10, 20)), expected[10:20])
+        self.assertEqual(index.bisect_left(expected[5]), 5)
+
+    def test_update(self):
+        index = RankIndex(load=4)
+        index.update([5, 3, 9, 1, 7, 2, 8, 4, 6, 0])
+        self.assertEqual(list(index), list(range(10)))
+        self.assertEqual(index.index(6), 6)
+        index.update([11, 10])
+        self.assertEqual(index[-1], 11)
+        self.assertEqual(len(index), 12)
+
+    def test_missing_key(self):
+        index = RankIndex()
+        with self.assertRaises(ValueError):
+            index.remove(1)
+        with self.assertRaises(IndexError):
+            index[0]
+        index.add(1)
+        with self.assertRaises(ValueError):
+            index.index(2)
+        self.assertEqual(list(index.islice(5)), [])
+
+    def test_keyed(self):
+        scores = [5, 3, 9, 1, 7, 3]
+        index = KeyedRankIndex(key=lambda row: (-scores[row], row), load=2)
+        for row in range(len(scores)):
+            index.add(row)
+        self.assertEqual(list(index), [2, 4, 0, 1, 5, 3])
+        self.assertEqual(index.index(5), 4)
+        self.assertEqual(index.bisect_left((-3, -1)), 3)
+        index.remove(0)
+        self.assertEqual(list(index.islice(1, 3)), [4, 1])
+
+        index = KeyedRankIndex(key=lambda row: (-scores[row], row), load=2)
+        index.update(range(len(scores)))
+        self.assertEqual(list(index), [2, 4, 0, 1, 5, 3])
+
+
+class RowMapTestCase(TestCase):
+
+    def test_matches_dict(self):
+        rnd = random.Random(7)
+        keys = array('q')
+        rows = RowMap(keys=keys)
+        expected = {}
+        for _ in range(3000):
+            key = rnd.randint(-10 ** 12, 10 ** 12)
+            if key in expected and rnd.random() < 0.5:
+                row = rows.pop(key)
+                self.assertEqual(row, expected.pop(key))
+                continue
+            if key in expected:
+                continue
+            keys.append(key)
+            rows.set(key, len(keys) - 1)
+            expected[key] = len(keys) - 1
+        for key in rnd.sample(list(expected), 500):
+            self.assertEqual(rows.pop(key), expected.pop(key))
+
+        self.assertEqual(len(rows), len(expected))
+        for key, row in expected.items():
+            self.assertEqual(rows.get(key), row)
+        self.assertIsNone(rows.get(10 ** 13))
+        self.assertNotIn(10 ** 13, rows)
+        with self.assertRaises(KeyError):
+            rows.pop(10 ** 13)
+
+
+class StorageTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def make_storage(self, **kwargs) -> Storage:
+        return Storage(filename='items', klass=Item, base_path=self.tmp.name, **kwargs)
+
+    def test_save_load(self):
+        storage = self.make_storage()
+        storage.save(objs=[Item(chat_id=1, score=2)])
+        self.assertEqual(storage.load(), [Item(chat_id=1, score=2)])
+        self.assertFalse(os.path.exists(f'{storage.path}.tmp'))
+
+    def test_journal_replay(self):
+        storage = self.make_storage(journal=True)
+        storage.save(objs=[Item(chat_id=1, score=1)])
+        storage.append(op=JOURNAL_PUT, obj=Item(chat_id=2, score=2))
+        storage.append(op=JOURNAL_PUT, obj=Item(chat_id=1, score=3))
+        storage.append(op=JOURNAL_DELETE, obj=Item(chat_id=2, score=2))
+        storage.append(op=JOURNAL_PUT, obj=Item(chat_id=4, score=4))
+        storage.flush(objs=[])
+        storage.close()
+
+        storage = self.make_storage(journal=True)
+        self.assertEqual(storage.load(), [Item(chat_id=1, score=3), Item(chat_id=4, score=4)])
+        self.assertEqual(storage.journal_size, 4)
+
+        storage.append(op=JOURNAL_CLEAR)
+        storage.append(op=JOURNAL_PUT, obj=Item(chat_id=5, score=5))
+        storage.close()
+        self.assertEqual(self.make_storage(journal=True).load(), [Item(chat_id=5, score=5)])
+
+    def test_journal_compaction(self):
+        storage = self.make_storage(journal=True, compact_every=2)
+        storage.append(op=JOURNAL_PUT, obj=Item(chat_id=1, score=1))
+        storage.flush(objs=[Item(chat_id=1, score=1)])
+        self.assertFalse(os.path.exists(storage.path))
+
+        storage.append(op=JOURNAL_PUT, obj=Item(chat_id=2, score=2))
+        storage.flush(objs=[Item(chat_id=1, score=1), Item(chat_id=2, score=2)])
+        self.assertTrue(os.path.exists(storage.path))
+        self.assertEqual(os.path.getsize(storage.journal_path), 0)
+        self.assertEqual(storage.journal_size, 0)
+        self.assertEqual(len(self.make_storage(journal=True).load()), 2)
+
+    def test_background_compaction(self):
+        storage = self.make_storage(journal=True, compact_every=1)
+        storage.append(op=JOURNAL_PUT, obj=Item(chat_id=1, score=1))
+        job = storage.begin_flush(get_objs=lambda: [Item(chat_id=1, score=1)])
+
+        # Запись, сделанная пока снимок ещё не записан, не теряется ни до, ни после записи
+        storage.append(op=JOURNAL_PUT, obj=Item(chat_id=2, score=2))
+        storage.close()
+        self.assertEqual(len(self.make_storage(journal=True).load()), 2)
+        self.assertFalse(os.path.exists(storage.compact_path))
+
+        storage = self.make_storage(journal=True, compact_every=1)
+        self.assertEqual(len(storage.load()), 2)
+        job = storage.begin_flush(get_objs=lambda: [Item(chat_id=1, score=1), Item(chat_id=2, score=2)])
+        storage.append(op=JOURNAL_PUT, obj=Item(chat_id=3, score=3))
+        job()
+        storage.close()
+        self.assertFalse(os.path.exists(storage.compact_path))
+        self.assertEqual(len(self.make_storage(journal=True).load()), 3)
+
+    def test_broken_journal_tail(self):
+        storage = self.make_storage(journal=True)
+        storage.append(op=JOURNAL_PUT, obj=Item(chat_id=1, score=1))
+        storage.close()
+        with open(storage.journal_path, 'a') as fp:
+            fp.write('{"op":"put","obj":{"chat_')
+
+        storage = self.make_storage(journal=True)
+        self.assertEqual(storage.load(), [Item(chat_id=1, score=1)])
+        storage.append(op=JOURNAL_PUT, obj=Item(chat_id=2, score=2))
+        storage.close()
+        self.assertEqual(len(self.make_storage(journal=True).load()), 2)
+
+    def test_concurrent_snapshots(self):
+        storage = self.make_storage()
+        snapshots = [[Item(chat_id=i, score=n) for i in range(1000)] for n in range(2)]
+        errors = []
+
+        def write(objs):
+            try:
+                for _ in range(20):
+                    storage.save(objs=objs)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write, args=(objs,)) for objs in snapshots]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertIn(self.make_storage().load(), snapshots)
+        self.assertFalse(os.path.exists(f'{storage.path}.tmp'))
+
+    def test_read_tail(self):
+        writer = self.make_storage(journal=True)
+        writer.save(objs=[Item(chat_id=1, score=1)])
+        writer.append(op=JOURNAL_PUT, obj=Item(chat_id=2, score=2))
+        writer.flush(objs=[])
+        with open(writer.journal_path, 'a') as fp:
+            fp.write('{"op":"put","obj":{"chat_')
+
+        # Недописанная запись чужого журнала не отрезается
+        reader = self.make_storage(journal=True, read_only=True)
+        self.assertEqual(reader.load(), [Item(chat_id=1, score=1), Item(chat_id=2, score=2)])
+        self.assertIsNone(reader.read_tail())
+        os.truncate(writer.journal_path, reader.journal_offset)
+
+        writer.append(op=JOURNAL_DELETE, obj=Item(chat_id=1, score=1))
+        writer.append(op=JOURNAL_PUT, obj=Item(chat_id=3, score=3))
+        writer.flush(objs=[])
+        self.assertEqual(reader.read_tail(), [(JOURNAL_DELETE, Item(chat_id=1, score=1)),
+                                              (JOURNAL_PUT, Item(chat_id=3, score=3))])
+        self.assertEqual(reader.read_tail(), [])
+
+        # Снимок переписан: дочитывать нечего, нужна полная загрузка
+        writer.save(objs=[Item(chat_id=3, score=3)])
+        self.assertIsNone(reader.read_tail())
+
+
+class PidLockTestCase(IsolatedAsyncioTestCase):
+
+    async def test_take_over(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'bot.pid')
+        first, second = PidLock(path=path), PidLock(path=path)
+
+        self.assertIsNone(second.owner())
+        self.assertTrue(first.try_acquire())
+        self.assertEqual(second.owner(), os.getpid())
+        self.assertFalse(second.try_acquire())
+
+        # Брошенный pid-файл без блокировки никому не мешает
+        first.release()
+        self.assertIsNone(second.owner())
+        self.assertIsNone(await second.take_over(timeout=1))
+        self.assertFalse(first.try_acquire())
+        second.release()
+
+
+class SnapshotTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.rows = [
+            Row(chat_id=10 ** 12, full_name='Владимир', score=216, created_at=1608379200.5),
+            Row(chat_id=-5, full_name='', score=1, created_at=0.0),
+            Row(chat_id=3, full_name='F3', score=8, created_at=1608379300.25),
+        ]
+
+    def test_roundtrip(self):
+        path = os.path.join(self.tmp.name, 'rows.bin')
+        write_snapshot(path=path, rows=[(i.chat_id, i.full_name, i.score, i.created_at) for i in self.rows])
+
+        reader = SnapshotReader(path=path, klass=Row)
+        self.assertEqual(len(reader), 3)
+        self.assertEqual(list(reader.scores), [216, 1, 8])
+        self.assertEqual(reader[-1], self.rows[-1])
+        self.assertEqual(list(reader), self.rows)
+        reader.close()
+
+    def test_json_converter(self):
+        json_path = os.path.join(self.tmp.name, 'rows.json')
+        bin_path = os.path.join(self.tmp.name, 'rows.bin')
+        storage = Storage(filename='rows', klass=Row, base_path=self.tmp.name)
+        storage.save(objs=self.rows)
+
+        json_to_snapshot(json_path=json_path, snapshot_path=bin_path)
+        os.remove(json_path)
+        snapshot_to_json(snapshot_path=bin_path, json_path=json_path)
+        self.assertEqual(storage.load(), self.rows)
+
+    def test_storage_migrates_json(self):
+        Storage(filename='rows', klass=Row, base_path=self.tmp.name).save(objs=self.rows)
+
+        storage = Storage(filename='rows', klass=Row, base_path=self.tmp.name, fmt=FORMAT_BIN, journal=True)
+        self.assertEqual(list(storage.load()), self.rows)
+        self.assertTrue(os.path.isfile(storage.path))
+
+        storage.append(op=JOURNAL_DELETE, obj=self.rows[1])
+        storage.append(op=JOURNAL_PUT, obj=Row(chat_id=7, full_name='F7', score=2, created_at=1.0))
+        storage.close()
+        rows = Storage(filename='rows', klass=Row, base_path=self.tmp.name, fmt=FORMAT_BIN, journal=True).load()
+        self.assertEqual([i.chat_id for i in rows], [10 ** 12, 3, 7])
+        self.assertEqual(rows.fields(2), (7, 2, 1.0))
+
+
+class RoundArchiveTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.archive = RoundArchive(base_path=self.tmp.name)
+        # Раунды по часу с 2020-12-19 22:00 UTC, последний заканчивается уже в следующих сутках
+        self.start = 1608415200.0
+        self.rounds = []
+        for n in range(3):
+            rows = [
+                Row(chat_id=i, full_name=f'Игрок {i}', score=n * 10 + i, created_at=self.start + n * 3600 + i * 60)
+                for i in range(5)
+            ]
+            self.rounds.append(rows)
+            self.archive.add_round(round_counter=n, finished_at=self.start + (n + 1) * 3600, items=rows)
+        self.archive.flush()
+
+    def results(self, **kwargs):
+        return [(r.round_counter, r.chat_id, r.full_name, r.score, r.created_at) for r in self.archive.results(**kwargs)]
+
+    def expected(self, rounds):
+        return [(n, i.chat_id, i.full_name, i.score, i.created_at) for n in rounds for i in self.rounds[n]]
+
+    def test_segments_and_range(self):
+        self.assertEqual(self.archive.days(), ['2020-12-19', '2020-12-20'])
+        self.assertEqual([e.round_counter for e in self.archive.index(day='2020-12-19')], [0])
+        self.assertEqual(self.results(), self.expected(rounds=[0, 1, 2]))
+
+        # Второй раунд записан в сегмент следующих суток, но найдётся по времени результатов
+        self.assertEqual(self.results(since=self.start + 3600, until=self.start + 7200), self.expected(rounds=[1]))
+        self.assertEqual(self.results(since=self.start + 60, until=self.start + 180), self.expected(rounds=[0])[1:3])
+        self.assertEqual(self.results(since=self.start + 3 * 3600), [])
+
+    def test_recover_broken_tail(self):
+        self.archive.add_round(round_counter=3, finished_at=self.start + 4 * 3600, items=self.rounds[0])
+        self.archive.flush()
+        seg_path = self.archive.segment_path(day='2020-12-20')
+        idx_path = self.archive.index_path(day='2020-12-20')
+        entries = self.archive.index(day='2020-12-20')
+
+        # Последний кадр записан наполовину, индекс на него не успел
+        with open(seg_path, 'r+b') as fp:
+            fp.truncate(entries[-1].offset + 10)
+        with open(idx_path, 'r+b') as fp:
+            fp.truncate(len(entries[:-2]) * INDEX.size + 7)
+
+        self.archive.add_round(round_counter=4, finished_at=self.start + 5 * 3600, items=self.rounds[1])
+        self.archive.flush()
+        self.assertEqual([e.round_counter for e in self.archive.index(day='2020-12-20')], [1, 2, 4])
+        self.assertEqual([r.round_counter for r in self.archive.results()], [0] * 5 + [1] * 5 + [2] * 5 + [4] * 5)
+
+
+class UniqueCounterTestCase(TestCase):
+
+    def test_hyperloglog(self):
+        a = HyperLogLog()
+        b = HyperLogLog()
+        for i in range(20000):
+            a.add(i)
+            b.add(i + 10000)
+        self.assertAlmostEqual(a.count(), 20000, delta=20000 * 0.05)
+
+        # Объединение - оценка для объединения множеств, повторы не считаются
+        a.merge(b)
+        self.assertAlmostEqual(a.count(), 30000, delta=30000 * 0.05)
+        a.add(1)
+        self.assertAlmostEqual(a.count(), 30000, delta=30000 * 0.05)
+
+        small = HyperLogLog()
+        for i in range(10):
+            small.add(i)
+        self.assertEqual(len(small), 10)
+        with self.assertRaises(ValueError):
+            small.merge(HyperLogLog(p=10))
+
+    def test_windows(self):
+        unique = UniqueCounter(keep_hours=3)
+        now = 1608415200.0
+        for hour in range(5):
+            for chat_id in range(hour * 10, hour * 10 + 20):
+                unique.add(chat_id=chat_id, now=now + hour * 3600)
+
+        end = now + 4 * 3600
+        self.assertEqual(unique.count(WINDOW_HOUR, now=end), 20)
+        # Хранятся только последние ``keep_hours`` часов
+        self.assertEqual(len(unique.windows[WINDOW_HOUR]), 3)
+        self.assertEqual(unique.trend(WINDOW_HOUR, 4, now=end), [0, 20, 20, 20])
+        self.assertEqual(unique.union(WINDOW_HOUR, 2, now=end), 30)
+        # Сутки сменились после второго часа
+        self.assertEqual(unique.count(WINDOW_DAY, now=end), 40)
+        self.assertEqual(unique.trend(WINDOW_DAY, 2, now=end), [30, 40])
+        self.assertEqual(unique.count(WINDOW_LIFETIME), 60)
+
+    def test_records(self):
+        unique = UniqueCounter()
+        now = 1608415200.0
+        for chat_id in range(100):
+            unique.add(chat_id=chat_id, now=now)
+
+        # Сохранённое состояние объединяется с посчитанным после перезапуска
+        restored = UniqueCounter.from_records([SketchRecord(**vars(r)) for r in unique.snapshot().records()])
+        restored.add(chat_id=1000, now=now)
+        restored.merge(unique)
+        self.assertAlmostEqual(restored.count(WINDOW_DAY, now=now), 101, delta=3)
+        self.assertAlmostEqual(restored.count(WINDOW_LIFETIME), 101, delta=3)
+        self.assertEqual(UniqueCounter.from_records(unique.records()).lifetime.registers, unique.lifetime.registers)
+
+    def test_merge_keeps_time_order(self):
+        now = 1608415200.0
+        saved = UniqueCounter(keep_hours=3)
+        for hour in range(3):
+            for chat_id in range(hour * 100, hour * 100 + 50):
+                saved.add(chat_id=chat_id, now=now + hour * 3600)
+
+        # После перезапуска сохранённые окна добавляются к уже начатому текущему часу
+        live = UniqueCounter(keep_hours=3)
+        live.add(chat_id=1000, now=now + 2 * 3600)
+        live.merge(saved)
+        self.assertEqual(list(live.windows[WINDOW_HOUR]), sorted(live.windows[WINDOW_HOUR]))
+
+        # Через час вытесняется самое старое окно, а не самое новое
+        live.add(chat_id=2000, now=now + 3 * 3600)
+        self.assertEqual(live.trend(WINDOW_HOUR, 3, now=now + 3 * 3600), [50, 51, 1])
+
+
+class DeferredSchedulerTestCase(IsolatedAsyncioTestCase):
+
+    async def test_order(self):
+        scheduler = DeferredScheduler()
+        done = []
+
+        async def job(name):
+            done.append(name)
+
+        scheduler.call_later(0.03, job, 'c')
+        scheduler.call_later(0.01, job, 'a')
+        scheduler.call_later(0.02, job, 'b')
+        self.assertEqual(len(scheduler), 3)
+
+        await asyncio.sleep(0.1)
+        self.assertEqual(done, ['a', 'b', 'c'])
+        self.assertEqual(len(scheduler), 0)
+
+    async def test_drain(self):
+        scheduler = DeferredScheduler()
+        done = []
+
+        async def job(name):
+            await asyncio.sleep(0)
+            done.append(name)
+
+        scheduler.call_later(60, job, 'late')
+        await scheduler.drain()
+        self.assertEqual(done, ['late'])
+
+
+class RoundClockTestCase(IsolatedAsyncioTestCase):
+
+    async def test_ticks(self):
+        clock = RoundClock(period=0.02)
+        self.assertLessEqual(clock.time_left(), 0.02)
+
+        seen = []
+        async for round_counter in clock.ticks():
+            # Тик приходит уже в новом раунде
+            self.assertEqual(round_counter, clock.current())
+            seen.append(round_counter)
+            if len(seen) == 3:
+                break
+        self.assertEqual(seen, [seen[0], seen[0] + 1, seen[0] + 2])
+
+
+class OutboundDispatcherTestCase(IsolatedAsyncioTestCase):
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=2, capacity=2, now=0)
+        bucket.take(now=0)
+        bucket.take(now=0)
+        self.assertEqual(bucket.delay(now=0), 0.5)
+        self.assertEqual(bucket.delay(now=0.5), 0)
+        bucket.block(until=10)
+        self.assertEqual(bucket.delay(now=1), 9)
+        self.assertFalse(bucket.is_full(now=10.5))
+        self.assertTrue(bucket.is_full(now=11))
+
+    async def test_priority_and_chat_limit(self):
+        sender = OutboundDispatcher(global_rate=1000, chat_rate=20, chat_burst=1)
+        sent = []
+
+        def call(name):
+            async def inner():
+                sent.append(name)
+                return name
+            return inner
+
+        # Все сообщения в очереди до запуска обработчика: чат 1 отдаёт их по приоритету и по одному на токен
+        res = await asyncio.gather(
+            sender.send(chat_id=1, call=call('stats-1'), priority=PRIORITY_STATS),
+            sender.send(chat_id=1, call=call('stats-2'), priority=PRIORITY_STATS),
+            sender.send(chat_id=1, call=call('dice'), priority=PRIORITY_DICE),
+            sender.send(chat_id=2, call=call('other'), priority=PRIORITY_STATS),
+        )
+        self.assertEqual(res, ['stats-1', 'stats-2', 'dice', 'other'])
+        self.assertEqual(sent, ['dice', 'other', 'stats-1', 'stats-2'])
+        self.assertEqual(sender.sent, 4)
+        self.assertEqual(sender.depth, 0)
+        self.assertGreater(sender.wait_max, 0.04)
+        await sender.close()
+
+    async def test_retry_after(self):
+        sender = OutboundDispatcher(global_rate=1000, chat_rate=1000, max_retries=1)
+        attempts = []
+
+        async def flaky():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise RetryAfter(0)
+            return 'ok'
+
+        self.assertEqual(await sender.send(chat_id=1, call=flaky), 'ok')
+        self.assertEqual(sender.retried, 1)
+
+        async def flood():
+            raise RetryAfter(0)
+
+        with self.assertRaises(RetryAfter):
+            await sender.send(chat_id=1, call=flood)
+        self.assertEqual(sender.failed, 1)
+        await sender.close()
+
+    async def test_close_timeout(self):
+        sender = OutboundDispatcher(global_rate=1000, group_rate=1 / 60, group_burst=1)
+
+        async def call():
+            return 'ok'
+
+        sends = [asyncio.ensure_future(sender.send(chat_id=-1, call=call)) for _ in range(3)]
+        await asyncio.sleep(0)
+
+        # В группу уходит одно сообщение, остальные ждали бы минуту
+        await asyncio.wait_for(sender.close(timeout=0.2), timeout=1)
+        res = await asyncio.gather(*sends, return_exceptions=True)
+        self.assertEqual(res[0], 'ok')
+        self.assertTrue(all(isinstance(r, asyncio.CancelledError) for r in res[1:]))
+        self.assertEqual((sender.sent, sender.dropped, sender.depth), (1, 2, 0))
+
+
+class LatencyRecorderTestCase(TestCase):
+
+    def test_buckets(self):
+        for value in (0, 1, 63, 64, 65, 1000, 123456, 10 ** 9):
+            inx = bucket_index(value)
+            self.assertLessEqual(value, bucket_value(inx))
+            # Ошибка не больше ширины корзины
+            self.assertLessEqual(bucket_value(inx) - value, max(1, value) / 32)
+            self.assertGreater(value, bucket_value(inx - 1) if inx else -1)
+
+    def test_percentiles(self):
+        rec = LatencyRecorder(window=100)
+        data = [random.expovariate(1 / 50) for _ in range(10000)]
+        for v in data:
+            rec.record(v)
+
+        exact = sorted(data)
+        for p, value in rec.percentiles().items():
+            if p == 'max':
+                self.assertEqual(value, exact[-1])
+                continue
+            expected = exact[int(float(p[1:]) / 100 * len(exact)) - 1]
+            self.assertAlmostEqual(value, expected, delta=expected * 0.05 + 0.002)
+
+        self.assertEqual(rec.last(), data[-100:])
+        self.assertEqual(rec.window_percentiles()['max'], max(data[-100:]))
+
+        total = LatencyRecorder()
+        total.merge(rec)
+        total.merge(rec)
+        self.assertEqual(total.count, 20000)
+        self.assertEqual(total.percentiles(), rec.percentiles())
+
+    def test_prometheus_text(self):
+        rec = LatencyRecorder()
+        for ms in (1, 20, 300, 20000):
+            rec.record(ms)
+        text = prometheus_text({'roll_once': rec})
+        self.assertIn('bot_handler_latency_seconds_bucket{handler="roll_once",le="0.005"} 1', text)
+        self.assertIn('bot_handler_latency_seconds_bucket{handler="roll_once",le="0.5"} 3', text)
+        self.assertIn('bot_handler_latency_seconds_bucket{handler="roll_once",le="+Inf"} 4', text)
+        self.assertIn('bot_handler_latency_seconds_count{handler="roll_once"} 4', text)
+
+
+class BenchTestCase(TestCase):
+
+    def test_suite_and_compare(self):
+        report = run_suite(sizes=[50], ops=['add_result', 'storage_load_bin'])
+        self.assertEqual([(r['op'], r['ops']) for r in report['results']], [('add_result', 50), ('storage_load_bin', 1)])
+        self.assertTrue(all(r['peak_bytes'] > 0 for r in report['results']))
+
+        slower = {'results': [dict(r, throughput=r['throughput'] / 2) for r in report['results']]}
+        rows = compare(base=report, new=slower, threshold=0.1)
+        self.assertEqual({row['op'] for row in rows if row['regression']}, {'add_result', 'storage_load_bin'})
+        self.assertFalse(any(row['regression'] for row in compare(base=report, new=report)))
@@ -0,0 +1,67 @@
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+
+from aiogram import Bot, Dispatcher, types
+from aiohttp.test_utils import TestClient, TestServer
+
+from src.bench.webhook import make_update
+from src.webhook import SECRET_HEADER, WebhookServer
+
+
+class WebhookServerTestCase(IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.dispatcher = Dispatcher(bot=Bot(token='123456:test'))
+        self.release = asyncio.Event()
+        self.seen = []
+
+        async def handler(message: types.Message):
+            await self.release.wait()
+            self.seen.append(message.message_id)
+
+        self.dispatcher.register_message_handler(handler)
+        self.server = WebhookServer(dispatcher=self.dispatcher, secret_token='secret', concurrency=1, max_queue=1)
+        self.client = TestClient(TestServer(self.server.make_app()))
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        self.release.set()
+        await self.client.close()
+
+    def post(self, update_id: int, secret: str = 'secret'):
+        return self.client.post(self.server.path, json=make_update(update_id=update_id, chat_id=1),
+                                headers={SECRET_HEADER: secret})
+
+    async def test_ack_and_backpressure(self):
+        # Ответ приходит сразу, хотя обработчик ещё ждёт
+        resp = await self.post(update_id=1)
+        self.assertEqual(resp.status, 200)
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.server.busy, 1)
+
+        resp = await self.post(update_id=2)
+        self.assertEqual(resp.status, 200)
+        # Очередь заполнена
+        resp = await self.post(update_id=3)
+        self.assertEqual(resp.status, 503)
+
+        self.release.set()
+        await self.server.queue.join()
+        self.assertEqual(self.seen, [1, 2])
+        self.assertEqual((self.server.accepted, self.server.rejected, self.server.processed), (2, 1, 2))
+
+    async def test_secret_and_bad_request(self):
+        # Обновление без секрета или с чужим секретом не попадает в очередь
+        resp = await self.client.post(self.server.path, json=make_update(update_id=1, chat_id=1))
+        self.assertEqual(resp.status, 403)
+        resp = await self.post(update_id=2, secret='guess')
+        self.assertEqual(resp.status, 403)
+
+        headers = {SECRET_HEADER: 'secret'}
+        resp = await self.client.post(self.server.path, data='{"update_id": ', headers=headers)
+        self.assertEqual(resp.status, 400)
+        resp = await self.client.post(self.server.path, json=[1, 2], headers=headers)
+        self.assertEqual(resp.status, 400)
+
+        self.assertEqual((self.server.forbidden, self.server.accepted), (2, 0))
+        self.assertEqual(self.server.queue.qsize(), 0)
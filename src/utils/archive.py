@@ -0,0 +1,273 @@
+""" Архив завершённых раундов: все результаты, а не только лучшие за сутки.
+
+    Раунды дописываются в сегмент своих суток (UTC, по времени завершения раунда)::
+
+        archive/2020-12-19.seg  кадры подряд: заголовок FRAME + zlib(строки ROW + имя в utf-8)
+        archive/2020-12-19.idx  на каждый кадр запись INDEX: раунд, время первого и последнего
+                                результата, смещение и длина кадра в сегменте
+
+    Файлы только дописываются. Чтение по диапазону времени открывает только подходящие сутки,
+    пропускает кадры по индексу и распаковывает по одному раунду за раз.
+
+    Выгрузка в CSV::
+
+        python -m src.utils.archive export src --since 2020-12-19 --until 2020-12-20 > history.csv
+"""
+import argparse
+import csv
+import os
+import struct
+import sys
+import threading
+import zlib
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import IO, Callable, Iterable, Iterator, List, Optional, Tuple
+
+# round, first_at, last_at, count, length, crc32
+FRAME = struct.Struct('<qddIII')
+# round, first_at, last_at, offset, length
+INDEX = struct.Struct('<qddQI')
+# chat_id, score, created_at, len(full_name)
+ROW = struct.Struct('<qqdH')
+
+SEGMENT_EXT = '.seg'
+INDEX_EXT = '.idx'
+
+
+@dataclass
+class ArchivedResult:
+    round_counter: int
+    chat_id: int
+    full_name: str
+    score: int
+    created_at: float
+
+
+@dataclass
+class IndexEntry:
+    round_counter: int
+    first_at: float
+    last_at: float
+    offset: int
+    length: int
+
+
+def day_of(ts: float) -> str:
+    return datetime.fromtimestamp(ts, tz=timezone.utc).strftime('%Y-%m-%d')
+
+
+def encode_round(items: Iterable[Tuple[int, str, int, float]]) -> Tuple[bytes, int, float, float]:
+    """Строки (chat_id, full_name, score, created_at) одного раунда -> (payload, count, first_at, last_at)."""
+    buf = bytearray()
+    count = 0
+    first_at = float('inf')
+    last_at = float('-inf')
+    for chat_id, full_name, score, created_at in items:
+        name = full_name.encode('utf-8')[:0xffff]
+        buf += ROW.pack(chat_id, score, created_at, len(name))
+        buf += name
+        count += 1
+        first_at = min(first_at, created_at)
+        last_at = max(last_at, created_at)
+    return zlib.compress(bytes(buf)), count, first_at, last_at
+
+
+def decode_round(round_counter: int, payload: bytes) -> Iterator[ArchivedResult]:
+    data = zlib.decompress(payload)
+    pos = 0
+    while pos < len(data):
+        chat_id, score, created_at, size = ROW.unpack_from(data, pos)
+        pos += ROW.size
+        yield ArchivedResult(
+            round_counter=round_counter,
+            chat_id=chat_id,
+            full_name=data[pos:pos + size].decode('utf-8'),
+            score=score,
+            created_at=created_at,
+        )
+        pos += size
+
+
+class RoundArchive:
+    """ Архив раундов одной таблицы рекордов.
+
+        ``add_round`` только запоминает раунд, запись делает ``flush`` - её можно выполнять в executor,
+        как и остальное сохранение таблицы (см. ``begin_flush``).
+    """
+
+    def __init__(self, base_path: str = None, dry_run: bool = False):
+        base_path = base_path or os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+        self.path = os.path.join(base_path, 'archive')
+        self.dry_run = dry_run
+        self.pending: List[Tuple[int, float, list]] = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def segment_path(self, day: str) -> str:
+        return os.path.join(self.path, f'{day}{SEGMENT_EXT}')
+
+    def index_path(self, day: str) -> str:
+        return os.path.join(self.path, f'{day}{INDEX_EXT}')
+
+    def add_round(self, round_counter: int, finished_at: float, items: list):
+        """Запомнить завершённый раунд до следующего ``flush``."""
+        if self.dry_run or not items:
+            return
+        with self._lock:
+            self.pending.append((round_counter, finished_at, items))
+
+    def begin_flush(self) -> Callable[[], None]:
+        """Как ``Storage.begin_flush``: подготовка не нужна, раунды забирает сама запись."""
+        return self.flush
+
+    def flush(self):
+        """Дописать накопленные раунды в сегменты их суток."""
+        with self._write_lock:
+            with self._lock:
+                pending, self.pending = self.pending, []
+            if not pending:
+                return
+
+            os.makedirs(self.path, exist_ok=True)
+            by_day = {}
+            for round_counter, finished_at, items in pending:
+                by_day.setdefault(day_of(finished_at), []).append((round_counter, items))
+            for day, rounds in by_day.items():
+                self._append(day=day, rounds=rounds)
+
+    def _append(self, day: str, rounds: List[Tuple[int, list]]):
+        self._recover(day=day)
+        with open(self.segment_path(day), 'ab') as seg, open(self.index_path(day), 'ab') as idx:
+            offset = seg.tell()
+            for round_counter, items in rounds:
+                payload, count, first_at, last_at = encode_round(
+                    (i.chat_id, i.full_name, i.score, i.created_at) for i in items
+                )
+                frame = FRAME.pack(round_counter, first_at, last_at, count, len(payload), zlib.crc32(payload))
+                seg.write(frame + payload)
+                idx.write(INDEX.pack(round_counter, first_at, last_at, offset, len(frame) + len(payload)))
+                offset += len(frame) + len(payload)
+            # Индекс не должен указывать на кадры, которых нет на диске
+            seg.flush()
+            os.fsync(seg.fileno())
+            idx.flush()
+            os.fsync(idx.fileno())
+
+    def _recover(self, day: str):
+        """ После падения посреди записи: отрезать недописанный кадр и дописать
+            в индекс кадры, которые успели попасть в сегмент.
+        """
+        seg_path = self.segment_path(day)
+        if not os.path.isfile(seg_path):
+            return
+        entries = self.index(day=day)
+        end = entries[-1].offset + entries[-1].length if entries else 0
+        size = os.path.getsize(seg_path)
+        if end == size:
+            return
+
+        with open(seg_path, 'rb') as seg:
+            missing = []
+            while end + FRAME.size <= size:
+                seg.seek(end)
+                round_counter, first_at, last_at, _, length, crc = FRAME.unpack(seg.read(FRAME.size))
+                payload = seg.read(length)
+                if len(payload) != length or zlib.crc32(payload) != crc:
+                    break
+                missing.append(INDEX.pack(round_counter, first_at, last_at, end, FRAME.size + length))
+                end += FRAME.size + length
+        with open(self.index_path(day), 'r+b' if os.path.isfile(self.index_path(day)) else 'wb') as idx:
+            idx.truncate(len(entries) * INDEX.size)
+            idx.seek(0, os.SEEK_END)
+            idx.write(b''.join(missing))
+        with open(seg_path, 'r+b') as seg:
+            seg.truncate(end)
+
+    def days(self) -> List[str]:
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(name[:-len(SEGMENT_EXT)] for name in os.listdir(self.path) if name.endswith(SEGMENT_EXT))
+
+    def index(self, day: str) -> List[IndexEntry]:
+        path = self.index_path(day)
+        if not os.path.isfile(path):
+            return []
+        with open(path, 'rb') as fp:
+            data = fp.read()
+        # Недописанная последняя запись индекса не считается
+        usable = len(data) - len(data) % INDEX.size
+        return [IndexEntry(*fields) for fields in INDEX.iter_unpack(data[:usable])]
+
+    def results(self, since: float = None, until: float = None) -> Iterator[ArchivedResult]:
+        """ Результаты с ``since <= created_at < until`` в порядке записи раундов.
+            В памяти одновременно только один распакованный раунд.
+        """
+        # Раунд, начатый до полуночи, мог попасть в сегмент следующих суток
+        first_day = day_of(since) if since is not None else None
+        last_day = day_of(until + timedelta(days=1).total_seconds()) if until is not None else None
+        for day in self.days():
+            if (first_day is not None and day < first_day) or (last_day is not None and day > last_day):
+                continue
+            yield from self._day_results(day=day, since=since, until=until)
+
+    def _day_results(self, day: str, since: Optional[float], until: Optional[float]) -> Iterator[ArchivedResult]:
+        entries = self.index(day=day)
+        if not entries:
+            return
+        with open(self.segment_path(day), 'rb') as seg:
+            for entry in entries:
+                if (since is not None and entry.last_at < since) or (until is not None and entry.first_at >= until):
+                    continue
+                seg.seek(entry.offset)
+                frame = seg.read(entry.length)
+                _, _, _, _, length, crc = FRAME.unpack_from(frame)
+                payload = frame[FRAME.size:FRAME.size + length]
+                if zlib.crc32(payload) != crc:
+                    raise ValueError(f'Broken frame of round {entry.round_counter} in {day}{SEGMENT_EXT}')
+                for res in decode_round(round_counter=entry.round_counter, payload=payload):
+                    if (since is None or res.created_at >= since) and (until is None or res.created_at < until):
+                        yield res
+
+
+CSV_HEADER = ['round', 'chat_id', 'full_name', 'score', 'created_at']
+
+
+def write_csv(results: Iterable[ArchivedResult], fp: IO[str]) -> int:
+    """Записать результаты в CSV по мере чтения, вернуть их число."""
+    writer = csv.writer(fp)
+    writer.writerow(CSV_HEADER)
+    count = 0
+    for res in results:
+        writer.writerow([res.round_counter, res.chat_id, res.full_name, res.score, f'{res.created_at:.3f}'])
+        count += 1
+    return count
+
+
+def parse_time(value: str) -> float:
+    """Unix time или дата ISO 8601 (без часового пояса - UTC)."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Round archive tools.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    export = sub.add_parser('export', help='stream archived results as CSV to stdout')
+    export.add_argument('path', help='board directory, e.g. src or src/boards/<chat_id>')
+    export.add_argument('--since', type=parse_time)
+    export.add_argument('--until', type=parse_time)
+    args = parser.parse_args()
+
+    archive = RoundArchive(base_path=os.path.abspath(args.path))
+    write_csv(archive.results(since=args.since, until=args.until), sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
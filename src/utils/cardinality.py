@@ -0,0 +1,193 @@
+""" Число уникальных пользователей в фиксированной памяти.
+
+    ``HyperLogLog`` оценивает число различных значений с ошибкой около ``1.04 / sqrt(2 ** p)``
+    (p=12: 4 КБ и ~1.6%). Два скетча с одинаковым ``p`` объединяются поэлементным максимумом,
+    поэтому окна можно складывать между собой и между процессами. ``UniqueCounter`` держит
+    скетчи по часам, по суткам (UTC) и за всё время.
+"""
+import base64
+import math
+import time
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterable, List
+
+_MASK64 = (1 << 64) - 1
+
+# Окна
+WINDOW_HOUR = 'hour'
+WINDOW_DAY = 'day'
+WINDOW_LIFETIME = 'lifetime'
+WINDOW_SECONDS = {
+    WINDOW_HOUR: 3600,
+    WINDOW_DAY: 86400,
+}
+
+
+def mix64(value: int) -> int:
+    """64-битный хэш (splitmix64): одинаковый во всех процессах, в отличие от ``hash``."""
+    z = (value + 0x9E3779B97F4A7C15) & _MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return z ^ (z >> 31)
+
+
+class HyperLogLog:
+    __slots__ = ('p', 'registers')
+
+    def __init__(self, p: int = 12, registers: bytes = None):
+        self.p = p
+        self.registers = bytearray(registers) if registers is not None else bytearray(1 << p)
+        if len(self.registers) != 1 << p:
+            raise ValueError(f'Expected {1 << p} registers, got {len(self.registers)}')
+
+    def add(self, value: int):
+        self.add_hash(mix64(value & _MASK64))
+
+    def add_hash(self, x: int):
+        """Добавить уже посчитанный ``mix64``, чтобы не хэшировать одно значение для нескольких скетчей."""
+        inx = x >> (64 - self.p)
+        rest = x & ((1 << (64 - self.p)) - 1)
+        # Номер первой единицы в оставшихся битах
+        rank = 64 - self.p - rest.bit_length() + 1
+        if rank > self.registers[inx]:
+            self.registers[inx] = rank
+
+    def merge(self, other: 'HyperLogLog'):
+        if other.p != self.p:
+            raise ValueError(f'Cannot merge sketches with p={self.p} and p={other.p}')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def copy(self) -> 'HyperLogLog':
+        return HyperLogLog(p=self.p, registers=self.registers)
+
+    def __len__(self) -> int:
+        return round(self.count())
+
+    def count(self) -> float:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Мало значений: точнее считать по пустым регистрам
+            return m * math.log(m / zeros)
+        return estimate
+
+
+@dataclass
+class SketchRecord:
+    """Один скетч для ``Storage``: регистры сжаты и в base64."""
+    window: str
+    start: int
+    p: int
+    registers: str
+
+
+def encode_registers(registers: bytes) -> str:
+    return base64.b64encode(zlib.compress(bytes(registers))).decode('ascii')
+
+
+def decode_registers(data: str) -> bytes:
+    return zlib.decompress(base64.b64decode(data))
+
+
+class UniqueCounter:
+    """ Скетчи уникальных пользователей по часам, суткам и за всё время.
+
+        Хранятся последние ``keep_hours`` часов и ``keep_days`` суток, поэтому память не зависит
+        от числа пользователей и времени работы. Ключ окна - номер часа или суток от начала эпохи.
+    """
+
+    def __init__(self, p: int = 12, lifetime_p: int = 14, keep_hours: int = 48, keep_days: int = 30):
+        self.p = p
+        self.keep = {
+            WINDOW_HOUR: keep_hours,
+            WINDOW_DAY: keep_days,
+        }
+        self.windows: Dict[str, 'OrderedDict[int, HyperLogLog]'] = {
+            WINDOW_HOUR: OrderedDict(),
+            WINDOW_DAY: OrderedDict(),
+        }
+        self.lifetime = HyperLogLog(p=lifetime_p)
+
+    def _window(self, window: str, start: int) -> HyperLogLog:
+        sketches = self.windows[window]
+        sketch = sketches.get(start)
+        if sketch is None:
+            out_of_order = bool(sketches) and start < next(reversed(sketches))
+            sketch = sketches[start] = HyperLogLog(p=self.p)
+            if out_of_order:
+                # Окно из прошлого, например при объединении: сохранить порядок по времени
+                self.windows[window] = sketches = OrderedDict(sorted(sketches.items()))
+            while len(sketches) > self.keep[window]:
+                sketches.popitem(last=False)
+        return sketch
+
+    def add(self, chat_id: int, now: float = None):
+        now = time.time() if now is None else now
+        x = mix64(chat_id & _MASK64)
+        for window, seconds in WINDOW_SECONDS.items():
+            self._window(window=window, start=int(now // seconds)).add_hash(x)
+        self.lifetime.add_hash(x)
+
+    def count(self, window: str, now: float = None, ago: int = 0) -> int:
+        """Оценка уникальных пользователей в окне ``window``, ``ago`` окон назад от текущего."""
+        if window == WINDOW_LIFETIME:
+            return len(self.lifetime)
+        now = time.time() if now is None else now
+        sketch = self.windows[window].get(int(now // WINDOW_SECONDS[window]) - ago)
+        return len(sketch) if sketch is not None else 0
+
+    def trend(self, window: str, n: int, now: float = None) -> List[int]:
+        """Оценки за последние ``n`` окон, от старых к текущему."""
+        return [self.count(window=window, now=now, ago=ago) for ago in range(n - 1, -1, -1)]
+
+    def union(self, window: str, n: int, now: float = None) -> int:
+        """Уникальные пользователи за последние ``n`` окон вместе, например за 7 суток."""
+        now = time.time() if now is None else now
+        current = int(now // WINDOW_SECONDS[window])
+        res = HyperLogLog(p=self.p)
+        for start, sketch in self.windows[window].items():
+            if current - n < start <= current:
+                res.merge(sketch)
+        return len(res)
+
+    def merge(self, other: 'UniqueCounter'):
+        """Добавить окна ``other`` - например сохранённые до перезапуска или из другого процесса."""
+        for window, sketches in other.windows.items():
+            for start, sketch in sketches.items():
+                self._window(window=window, start=start).merge(sketch)
+        self.lifetime.merge(other.lifetime)
+
+    def snapshot(self) -> 'UniqueCounter':
+        """Копия для сохранения в другом потоке: только копирование регистров."""
+        res = UniqueCounter(p=self.p, lifetime_p=self.lifetime.p, keep_hours=self.keep[WINDOW_HOUR],
+                            keep_days=self.keep[WINDOW_DAY])
+        res.lifetime = self.lifetime.copy()
+        for window, sketches in self.windows.items():
+            res.windows[window] = OrderedDict((start, sketch.copy()) for start, sketch in sketches.items())
+        return res
+
+    def records(self) -> List[SketchRecord]:
+        """Все скетчи для ``Storage``."""
+        res = [SketchRecord(window=WINDOW_LIFETIME, start=0, p=self.lifetime.p,
+                            registers=encode_registers(self.lifetime.registers))]
+        for window, sketches in self.windows.items():
+            for start, sketch in sketches.items():
+                res.append(SketchRecord(window=window, start=start, p=sketch.p,
+                                        registers=encode_registers(sketch.registers)))
+        return res
+
+    @classmethod
+    def from_records(cls, records: Iterable[SketchRecord], **kwargs) -> 'UniqueCounter':
+        res = cls(**kwargs)
+        for record in records:
+            sketch = HyperLogLog(p=record.p, registers=decode_registers(record.registers))
+            if record.window == WINDOW_LIFETIME:
+                if sketch.p == res.lifetime.p:
+                    res.lifetime.merge(sketch)
+            elif record.window in res.windows and sketch.p == res.p:
+                res._window(window=record.window, start=record.start).merge(sketch)
+        return res
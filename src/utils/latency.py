@@ -0,0 +1,153 @@
+import math
+from array import array
+from typing import Dict, Iterable, List, Tuple
+
+# Точность гистограммы: 2 ** SUB_BITS корзин на каждую степень двойки, ошибка не больше ~3%
+SUB_BITS = 6
+SUB_COUNT = 1 << SUB_BITS
+HALF_COUNT = SUB_COUNT >> 1
+# Значения больше 2 ** MAX_BITS микросекунд (~12 дней) попадают в последнюю корзину
+MAX_BITS = 40
+BUCKETS = SUB_COUNT + (MAX_BITS - SUB_BITS) * HALF_COUNT
+
+# Границы корзин для Prometheus, секунды
+PROMETHEUS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def bucket_index(value: int) -> int:
+    """Номер корзины для значения в микросекундах."""
+    if value < SUB_COUNT:
+        return value
+    shift = value.bit_length() - SUB_BITS
+    return min(BUCKETS - 1, SUB_COUNT + (shift - 1) * HALF_COUNT + (value >> shift) - HALF_COUNT)
+
+
+def bucket_value(index: int) -> int:
+    """Наибольшее значение в корзине, микросекунды."""
+    if index < SUB_COUNT:
+        return index
+    shift, sub = divmod(index - SUB_COUNT, HALF_COUNT)
+    shift += 1
+    return ((sub + HALF_COUNT + 1) << shift) - 1
+
+
+class LatencyRecorder:
+    """ Время ответа одного обработчика в фиксированной памяти.
+
+        Каждое значение попадает в лог-линейную гистограмму (как в HdrHistogram) за всё время работы
+        и в кольцевой буфер последних ``window`` значений. Запись - O(1) без аллокаций,
+        перцентили считаются по гистограмме при чтении.
+    """
+
+    __slots__ = ('counts', 'count', 'total', 'max', 'window', 'recent', 'pos')
+
+    def __init__(self, window: int = 1000):
+        self.counts = array('Q', bytes(8 * BUCKETS))
+        self.count = 0
+        self.total = 0.0  # milliseconds
+        self.max = 0.0  # milliseconds
+        self.window = window
+        self.recent = array('d', bytes(8 * window))
+        self.pos = 0
+
+    def record(self, ms: float):
+        self.counts[bucket_index(int(ms * 1000))] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+        self.recent[self.pos % self.window] = ms
+        self.pos += 1
+
+    def merge(self, other: 'LatencyRecorder'):
+        """Добавить гистограмму ``other``; кольцевой буфер не объединяется."""
+        for inx, n in enumerate(other.counts):
+            if n:
+                self.counts[inx] += n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def last(self) -> List[float]:
+        """Последние значения, не больше ``window``."""
+        if self.pos <= self.window:
+            return list(self.recent[:self.pos])
+        inx = self.pos % self.window
+        return list(self.recent[inx:]) + list(self.recent[:inx])
+
+    def window_percentiles(self, ps: Iterable[float] = (50, 95, 99)) -> Dict[str, float]:
+        """Точные перцентили и максимум по последним значениям, миллисекунды."""
+        data = sorted(self.last())
+        if not data:
+            return {}
+        res = {}
+        for p in ps:
+            res[f'p{p:g}'] = data[min(len(data) - 1, max(0, math.ceil(p / 100 * len(data)) - 1))]
+        res['max'] = data[-1]
+        return res
+
+    @property
+    def avg(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentiles(self, ps: Iterable[float] = (50, 95, 99)) -> Dict[str, float]:
+        """Перцентили и максимум, миллисекунды."""
+        if not self.count:
+            return {}
+        ps = sorted(ps)
+        res = {}
+        seen = 0
+        for inx, n in enumerate(self.counts):
+            seen += n
+            while ps and seen >= ps[0] / 100 * self.count:
+                # Верхняя граница корзины, но не больше реального максимума
+                res[f'p{ps.pop(0):g}'] = min(bucket_value(inx) / 1000, self.max)
+            if not ps:
+                break
+        res['max'] = self.max
+        return res
+
+    def cumulative(self, bounds: Iterable[float] = PROMETHEUS_BUCKETS) -> List[int]:
+        """Сколько значений не больше каждой из границ ``bounds`` (секунды)."""
+        res = []
+        seen = 0
+        inx = 0
+        for bound in bounds:
+            limit = bound * 10 ** 6
+            while inx < BUCKETS and bucket_value(inx) <= limit:
+                seen += self.counts[inx]
+                inx += 1
+            res.append(seen)
+        return res
+
+
+def format_percentiles(stats: Dict[str, float]) -> str:
+    return ', '.join(f'{k} {v:.0f}' for k, v in stats.items()) + ' (ms)'
+
+
+def prometheus_text(recorders: Dict[str, LatencyRecorder], name: str = 'bot_handler_latency_seconds',
+                    label: str = 'handler') -> str:
+    """Гистограммы в текстовом формате Prometheus."""
+    lines = [
+        f'# HELP {name} Handler response time.',
+        f'# TYPE {name} histogram',
+    ]
+    for key, rec in sorted(recorders.items()):
+        for bound, n in zip(PROMETHEUS_BUCKETS, rec.cumulative()):
+            lines.append(f'{name}_bucket{{{label}="{key}",le="{bound:g}"}} {n}')
+        lines.append(f'{name}_bucket{{{label}="{key}",le="+Inf"}} {rec.count}')
+        lines.append(f'{name}_sum{{{label}="{key}"}} {rec.total / 1000:.6f}')
+        lines.append(f'{name}_count{{{label}="{key}"}} {rec.count}')
+    return '\n'.join(lines) + '\n'
+
+
+def prometheus_values(metrics: Iterable[Tuple[str, str, str, float]]) -> str:
+    """Отдельные значения (имя, тип, описание, значение) в текстовом формате Prometheus."""
+    lines = []
+    for name, kind, doc, value in metrics:
+        lines.extend([
+            f'# HELP {name} {doc}',
+            f'# TYPE {name} {kind}',
+            f'{name} {value:g}',
+        ])
+    return '\n'.join(lines) + '\n'
@@ -1,9 +1,8 @@
 import logging
-
-import sentry_sdk
+import sys
 
 from functools import wraps
-from typing import Union
+from typing import Dict, Union
 
 
 logging.basicConfig(
@@ -12,6 +11,23 @@ logging.basicConfig(
 log = logging.getLogger(__name__)
 
 
+def capture_exception(error: Exception):
+    """Отправить ошибку в sentry, если он уже подключён (см. ``init_sentry``), без импорта ``sentry_sdk``."""
+    sentry_sdk = sys.modules.get('sentry_sdk')
+    if sentry_sdk is not None:
+        sentry_sdk.capture_exception(error=error)
+
+
+def init_sentry(dsn: str, traces_sample_rate: float):
+    """Подключить sentry. ``sentry_sdk`` импортируется только здесь: без dsn он не нужен, а импорт не быстрый."""
+    import sentry_sdk
+
+    sentry_sdk.init(
+        dsn=dsn,
+        traces_sample_rate=traces_sample_rate,
+    )
+
+
 def async_log_exception(f):
 
     @wraps(f)
@@ -19,7 +35,7 @@ def async_log_exception(f):
         try:
             return await f(*args, **kwargs)
         except Exception as e:
-            sentry_sdk.capture_exception(error=e)
+            capture_exception(error=e)
             log.error(f'Exception in {f.__name__}: {e}')
 
     return inner
@@ -38,3 +54,10 @@ def pretty_time_delta(seconds: Union[int, float]) -> str:
         return f'{minutes} min {seconds} sec'
     else:
         return f'{seconds} sec'
+
+
+def format_startup(stages: Dict[str, float]) -> str:
+    """Этапы запуска в порядке наступления, миллисекунды."""
+    if not stages:
+        return '-'
+    return ', '.join(f'{k} {v * 1000:.0f}' for k, v in sorted(stages.items(), key=lambda i: i[1])) + ' (ms)'
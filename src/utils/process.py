@@ -0,0 +1,86 @@
+""" Передача работы от запущенного процесса бота новому.
+
+    Работающий процесс держит блокировку ``flock`` на pid-файле. Новый процесс по блокировке
+    понимает, что предыдущий жив (pid-файл, оставшийся после падения, не заблокирован, и чужой
+    процесс с тем же pid не пострадает), просит его остановиться через ``SIGTERM`` и ждёт,
+    пока блокировка освободится.
+"""
+import asyncio
+import fcntl
+import logging
+import os
+import signal
+from typing import Optional
+
+
+log = logging.getLogger(__name__)
+
+
+class PidLock:
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fp = None
+
+    def owner(self) -> Optional[int]:
+        """pid процесса, который держит блокировку, или None."""
+        if self._fp is not None:
+            return os.getpid()
+        try:
+            fp = open(self.path, 'r')
+        except FileNotFoundError:
+            return None
+        with fp:
+            try:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                try:
+                    return int(fp.read().strip())
+                except ValueError:
+                    return None
+            return None
+
+    def try_acquire(self) -> bool:
+        if self._fp is not None:
+            return True
+        fp = open(self.path, 'a+')
+        try:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            fp.close()
+            return False
+        fp.seek(0)
+        fp.truncate()
+        fp.write(str(os.getpid()))
+        fp.flush()
+        self._fp = fp
+        return True
+
+    async def take_over(self, timeout: float = 30.0, poll: float = 0.05) -> Optional[int]:
+        """ Остановить процесс, который держит блокировку, и взять её себе. Вернуть pid остановленного.
+            Если он не остановился за ``timeout`` секунд - TimeoutError.
+        """
+        if self.try_acquire():
+            return None
+        pid = self.owner()
+        if pid is not None:
+            log.info(f'Stop previous process {pid}')
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while not self.try_acquire():
+            if loop.time() > deadline:
+                raise TimeoutError(f'Process {pid} still holds {self.path}')
+            await asyncio.sleep(poll)
+        return pid
+
+    def release(self):
+        if self._fp is not None:
+            # Пустой файл не заблокирован: следующему процессу некого останавливать
+            self._fp.truncate(0)
+            self._fp.close()
+            self._fp = None
@@ -0,0 +1,234 @@
+import bisect
+import sys
+from array import array
+from typing import Any, Callable, Iterable, Iterator, List, Tuple
+
+
+class RankIndex:
+    """ Упорядоченное множество ключей с быстрым поиском позиции.
+
+        Ключи лежат в отсортированных блоках ограниченного размера, а размеры блоков
+        хранятся в дереве Фенвика. Поэтому вставка, удаление, позиция ключа и ключ
+        по позиции стоят O(log n), а не O(n) как в простом списке.
+    """
+
+    def __init__(self, load: int = 512):
+        self.load = load
+        self._blocks: List[list] = []
+        # Ключ сравнения последнего элемента каждого блока
+        self._maxes: list = []
+        self._tree: List[int] = [0]
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self) -> Iterator[Any]:
+        for block in self._blocks:
+            yield from block
+
+    def __getitem__(self, index: int) -> Any:
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError('RankIndex index out of range')
+        pos, offset = self._locate(index)
+        return self._blocks[pos][offset]
+
+    def update(self, keys: Iterable[Any]):
+        """Добавить много ключей разом; в пустой индекс - за один проход без вставок по одному."""
+        if self._blocks:
+            for key in keys:
+                self.add(key)
+            return
+
+        keys = self._sorted(keys)
+        self._blocks = [self._block(keys[i:i + self.load]) for i in range(0, len(keys), self.load)]
+        self._maxes = [self._key(block[-1]) for block in self._blocks]
+        self._len = len(keys)
+        self._build()
+
+    def clear(self):
+        self._blocks = []
+        self._maxes = []
+        self._tree = [0]
+        self._len = 0
+
+    def add(self, key: Any):
+        if not self._blocks:
+            self._blocks.append(self._block([key]))
+            self._maxes.append(self._key(key))
+            self._len = 1
+            self._build()
+            return
+
+        value = self._key(key)
+        pos = bisect.bisect_left(self._maxes, value)
+        if pos == len(self._maxes):
+            pos -= 1
+            self._blocks[pos].append(key)
+            self._maxes[pos] = value
+        else:
+            block = self._blocks[pos]
+            block.insert(self._bisect(block, value), key)
+        self._len += 1
+
+        block = self._blocks[pos]
+        if len(block) > 2 * self.load:
+            self._blocks[pos:pos + 1] = [block[:self.load], block[self.load:]]
+            self._maxes[pos:pos + 1] = [self._key(block[self.load - 1]), self._key(block[-1])]
+            self._build()
+        else:
+            self._update(pos, 1)
+
+    def remove(self, key: Any):
+        pos, offset = self._find(key)
+        block = self._blocks[pos]
+        del block[offset]
+        self._len -= 1
+
+        if not block:
+            del self._blocks[pos]
+            del self._maxes[pos]
+            self._build()
+            return
+
+        self._maxes[pos] = self._key(block[-1])
+        if len(block) < self.load // 2 and len(self._blocks) > 1:
+            # Маленький блок сливаем с соседом, чтобы число блоков оставалось ~ n / load
+            left = pos - 1 if pos > 0 else pos
+            merged = self._blocks[left] + self._blocks[left + 1]
+            if len(merged) > 2 * self.load:
+                half = len(merged) // 2
+                self._blocks[left:left + 2] = [merged[:half], merged[half:]]
+                self._maxes[left:left + 2] = [self._key(merged[half - 1]), self._key(merged[-1])]
+            else:
+                self._blocks[left:left + 2] = [merged]
+                self._maxes[left:left + 2] = [self._key(merged[-1])]
+            self._build()
+        else:
+            self._update(pos, -1)
+
+    def index(self, key: Any) -> int:
+        """Позиция ключа (с нуля), ValueError если ключа нет."""
+        pos, offset = self._find(key)
+        return self._prefix(pos) + offset
+
+    def bisect_left(self, key: Any) -> int:
+        """Сколько ключей строго меньше ``key``."""
+        pos = bisect.bisect_left(self._maxes, key)
+        if pos == len(self._maxes):
+            return self._len
+        return self._prefix(pos) + self._bisect(self._blocks[pos], key)
+
+    def islice(self, start: int = 0, stop: int = None) -> Iterator[Any]:
+        """Ключи с позициями [start, stop) без копирования всего индекса."""
+        stop = self._len if stop is None else min(stop, self._len)
+        start = max(start, 0)
+        if start >= stop:
+            return
+        left = stop - start
+        pos, offset = self._locate(start)
+        while left > 0:
+            chunk = self._blocks[pos][offset:offset + left]
+            yield from chunk
+            left -= len(chunk)
+            pos += 1
+            offset = 0
+
+    def _find(self, key: Any) -> Tuple[int, int]:
+        value = self._key(key)
+        pos = bisect.bisect_left(self._maxes, value)
+        if pos < len(self._maxes):
+            block = self._blocks[pos]
+            offset = self._bisect(block, value)
+            if offset < len(block) and block[offset] == key:
+                return pos, offset
+        raise ValueError(f'{key!r} not in RankIndex')
+
+    # Сравнение ключей, см. ``KeyedRankIndex``
+
+    _bisect = staticmethod(bisect.bisect_left)
+    _block = staticmethod(list)
+    _sorted = staticmethod(sorted)
+
+    @staticmethod
+    def _key(key: Any) -> Any:
+        return key
+
+    # Дерево Фенвика по длинам блоков, индексация с единицы
+
+    def _build(self):
+        tree = [0] + [len(b) for b in self._blocks]
+        size = len(tree)
+        for i in range(1, size):
+            j = i + (i & -i)
+            if j < size:
+                tree[j] += tree[i]
+        self._tree = tree
+
+    def _update(self, pos: int, delta: int):
+        tree = self._tree
+        i = pos + 1
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, pos: int) -> int:
+        """Суммарная длина блоков [0, pos)."""
+        tree = self._tree
+        total = 0
+        while pos > 0:
+            total += tree[pos]
+            pos -= pos & -pos
+        return total
+
+    def _locate(self, index: int) -> Tuple[int, int]:
+        """Номер блока и смещение в нём для позиции ``index``."""
+        tree = self._tree
+        size = len(tree) - 1
+        pos = 0
+        step = 1 << (size.bit_length() - 1) if size else 0
+        while step:
+            nxt = pos + step
+            if nxt <= size and tree[nxt] <= index:
+                pos = nxt
+                index -= tree[nxt]
+            step >>= 1
+        return pos, index
+
+
+class KeyedRankIndex(RankIndex):
+    """ ``RankIndex`` по целым числам (например, номерам строк колонок), упорядоченным по ``key(n)``.
+
+        Блоки - ``array('q')``, поэтому ключ занимает 8 байт без отдельного объекта, а порядок
+        вычисляется из колонок при сравнении. ``key`` должен различать все числа. ``bisect_left``
+        принимает значение ``key``, а не само число.
+    """
+
+    def __init__(self, key: Callable[[int], Any], load: int = 512):
+        super().__init__(load=load)
+        self._key = key
+
+    @staticmethod
+    def _block(keys: Iterable[int]) -> array:
+        return array('q', keys)
+
+    def _sorted(self, keys: Iterable[int]) -> List[int]:
+        return sorted(keys, key=self._key)
+
+    # ``key`` у ``bisect`` есть с Python 3.10, до этого поиск по блоку идёт в цикле
+    if sys.version_info >= (3, 10):
+        def _bisect(self, seq, value: Any) -> int:
+            return bisect.bisect_left(seq, value, key=self._key)
+    else:
+        def _bisect(self, seq, value: Any) -> int:
+            key = self._key
+            lo, hi = 0, len(seq)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if key(seq[mid]) < value:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
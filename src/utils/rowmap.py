@@ -0,0 +1,117 @@
+from array import array
+from typing import Optional
+
+# Мультипликативное хеширование Фибоначчи: старшие биты произведения перемешаны лучше младших
+_MULT = 0x9E3779B97F4A7C15
+_MASK64 = (1 << 64) - 1
+
+_EMPTY = 0
+_DELETED = -1
+
+
+class RowMap:
+    """ Словарь ключ -> номер строки колонок без объектов на запись.
+
+        Открытая адресация в ``array('q')``: в слоте лежит номер строки + 1, а сам ключ
+        читается из колонки ``keys`` по этому номеру. Поэтому запись стоит один слот (8 байт),
+        а слотов держится от полутора до четырёх на запись. Удалённые слоты помечаются
+        и убираются при следующей перестройке.
+    """
+
+    def __init__(self, keys: array):
+        self.keys = keys
+        self._slots = array('q', bytes(8 * 8))
+        self._shift = 64 - 3
+        self._len = 0
+        # Занятые и удалённые слоты: от них зависит длина цепочек поиска
+        self._used = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __contains__(self, key: int) -> bool:
+        return self.get(key) is not None
+
+    def _start(self, key: int) -> int:
+        return ((key * _MULT) & _MASK64) >> self._shift
+
+    def get(self, key: int) -> Optional[int]:
+        slots = self._slots
+        keys = self.keys
+        mask = len(slots) - 1
+        i = self._start(key)
+        while True:
+            value = slots[i]
+            if value == _EMPTY:
+                return None
+            if value > 0 and keys[value - 1] == key:
+                return value - 1
+            i = (i + 1) & mask
+
+    def set(self, key: int, row: int):
+        """Запомнить строку ключа. Ключа ещё не должно быть, строка ``row`` в ``keys`` уже заполнена."""
+        self._grow(count=1)
+        slots = self._slots
+        mask = len(slots) - 1
+        i = self._start(key)
+        while slots[i] > 0:
+            i = (i + 1) & mask
+        if slots[i] == _EMPTY:
+            self._used += 1
+        slots[i] = row + 1
+        self._len += 1
+
+    def extend(self, start: int):
+        """Запомнить строки ``keys`` с ``start`` до конца, как ``set`` для каждой, но одним циклом, например при загрузке."""
+        count = len(self.keys) - start
+        self._grow(count=count)
+        slots = self._slots
+        keys = self.keys
+        mask = len(slots) - 1
+        shift = self._shift
+        for row in range(start, len(keys)):
+            i = ((keys[row] * _MULT) & _MASK64) >> shift
+            while slots[i] > 0:
+                i = (i + 1) & mask
+            if slots[i] == _EMPTY:
+                self._used += 1
+            slots[i] = row + 1
+        self._len += count
+
+    def pop(self, key: int) -> int:
+        """Забыть ключ и вернуть его строку, KeyError если ключа нет."""
+        slots = self._slots
+        keys = self.keys
+        mask = len(slots) - 1
+        i = self._start(key)
+        while True:
+            value = slots[i]
+            if value == _EMPTY:
+                raise KeyError(key)
+            if value > 0 and keys[value - 1] == key:
+                slots[i] = _DELETED
+                self._len -= 1
+                return value - 1
+            i = (i + 1) & mask
+
+    @staticmethod
+    def _size_for(count: int) -> int:
+        size = 8
+        while size < count * 2:
+            size *= 2
+        return size
+
+    def _grow(self, count: int):
+        """Перестроить таблицу, если после ``count`` новых записей она заполнится больше чем на 2/3."""
+        if (self._used + count) * 3 > len(self._slots) * 2:
+            self._resize(size=self._size_for(self._len + count))
+
+    def _resize(self, size: int):
+        old = self._slots
+        self._slots = array('q', bytes(8 * size))
+        self._shift = 64 - (size.bit_length() - 1)
+        self._used = 0
+        self._len = 0
+        for value in old:
+            if value > 0:
+                self.set(self.keys[value - 1], value - 1)
@@ -0,0 +1,101 @@
+import asyncio
+import heapq
+import time
+from itertools import count
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Set, Tuple
+
+
+class DeferredScheduler:
+    """ Отложенные корутины на event loop.
+
+        Все задачи лежат в одной куче по времени запуска, и на loop висит один таймер
+        на ближайшую из них. Обработчику не нужно держать свою корутину в ``asyncio.sleep``
+        ради ответа, который надо отправить позже.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None):
+        self._loop = loop
+        self._heap: List[Tuple[float, int, Callable[..., Awaitable], tuple]] = []
+        self._seq = count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        return self._loop
+
+    def __len__(self) -> int:
+        """Сколько задач ещё ждут запуска или выполняются."""
+        return len(self._heap) + len(self._tasks)
+
+    def call_later(self, delay: float, func: Callable[..., Awaitable], *args):
+        """Запустить ``func(*args)`` через ``delay`` секунд."""
+        entry = (self.loop.time() + delay, next(self._seq), func, args)
+        heapq.heappush(self._heap, entry)
+        if self._heap[0] is entry:
+            self._arm()
+
+    def _arm(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._heap:
+            self._timer = self.loop.call_at(self._heap[0][0], self._run_due)
+
+    def _run_due(self):
+        self._timer = None
+        now = self.loop.time()
+        while self._heap and self._heap[0][0] <= now:
+            _, _, func, args = heapq.heappop(self._heap)
+            self._spawn(func(*args))
+        self._arm()
+
+    def _spawn(self, coro: Awaitable):
+        task = self.loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def drain(self):
+        """Запустить все отложенные задачи не дожидаясь их времени и дождаться завершения."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._heap:
+            _, _, func, args = heapq.heappop(self._heap)
+            self._spawn(func(*args))
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+class RoundClock:
+    """ Границы раундов по настенным часам.
+
+        Раунд ``n`` начинается в ``n * period`` секунд от начала эпохи. Каждое ожидание считается
+        заново от текущего времени, поэтому опоздание одного тика не накапливается.
+    """
+
+    def __init__(self, period: float, clock: Callable[[], float] = time.time):
+        self.period = period
+        self.clock = clock
+
+    def current(self) -> int:
+        """Номер текущего раунда."""
+        return int(self.clock() // self.period)
+
+    def time_left(self) -> float:
+        """Сколько секунд осталось до начала следующего раунда."""
+        return max(0.0, (self.current() + 1) * self.period - self.clock())
+
+    async def ticks(self, last: int = None) -> AsyncIterator[int]:
+        """Номер раунда в момент начала каждого следующего раунда после ``last``."""
+        if last is None:
+            last = self.current()
+        while True:
+            await asyncio.sleep(self.time_left())
+            current = self.current()
+            # Таймер loop может сработать чуть раньше границы по настенным часам
+            if current > last:
+                last = current
+                yield current
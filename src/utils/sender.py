@@ -0,0 +1,299 @@
+import asyncio
+import heapq
+import logging
+from itertools import count
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram.utils.exceptions import RetryAfter
+
+
+log = logging.getLogger(__name__)
+
+# Приоритеты отправки: чем меньше, тем раньше
+PRIORITY_DICE = 0
+PRIORITY_REPLY = 1
+PRIORITY_STATS = 2
+
+
+class TokenBucket:
+    """Ведро токенов: ``rate`` токенов в секунду, не больше ``capacity`` подряд."""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated_at', 'blocked_until')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = now
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        if now > self.updated_at:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд можно будет взять токен."""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, until: float):
+        """Не выдавать токены до ``until``, например после ответа 429."""
+        self.blocked_until = max(self.blocked_until, until)
+        self.tokens = 0.0
+        self.updated_at = until
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return now >= self.blocked_until and self.tokens >= self.capacity
+
+
+class _Job:
+    __slots__ = ('chat_id', 'call', 'priority', 'seq', 'future', 'enqueued_at', 'attempts')
+
+    def __init__(self, chat_id: int, call: Callable[[], Awaitable], priority: int, seq: int,
+                 future: asyncio.Future, enqueued_at: float):
+        self.chat_id = chat_id
+        self.call = call
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+        self.enqueued_at = enqueued_at
+        self.attempts = 0
+
+
+class _Chat:
+    __slots__ = ('bucket', 'jobs', 'gen')
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.jobs: List[Tuple[int, int, _Job]] = []
+        # Поколение: в очередях ready/waiting действительна только последняя запись чата
+        self.gen = 0
+
+
+class OutboundDispatcher:
+    """ Единая очередь исходящих сообщений.
+
+        Отправка ограничена общим ведром токенов (лимит Bot API на бота) и ведром каждого чата
+        (1 сообщение в секунду в личку, 20 в минуту в группу). Из чатов, у которых есть токены,
+        первым отправляется самое приоритетное сообщение. На 429 чат блокируется на ``retry_after``
+        секунд, а сообщение возвращается в начало его очереди.
+    """
+
+    def __init__(self, global_rate: float = 30.0, chat_rate: float = 1.0, chat_burst: float = 3.0,
+                 group_rate: float = 20 / 60, group_burst: float = 20.0, max_retries: int = 3,
+                 max_idle_chats: int = 10000, loop: asyncio.AbstractEventLoop = None):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.max_idle_chats = max_idle_chats
+
+        self._loop = loop
+        self._global: Optional[TokenBucket] = None
+        self._chats: Dict[int, _Chat] = {}
+        self._ready: List[Tuple[int, int, int, int]] = []  # (priority, seq, gen, chat_id)
+        self._waiting: List[Tuple[float, int, int]] = []  # (ready_at, gen, chat_id)
+        self._seq = count()
+        self._event: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._in_flight = set()
+
+        # Метрики
+        self.depth = 0
+        self.depth_by_priority: Dict[int, int] = {}
+        self.dispatched = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.dropped = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        return self._loop
+
+    @property
+    def wait_avg(self) -> float:
+        """Среднее время ожидания в очереди, секунды."""
+        return self.wait_total / self.dispatched if self.dispatched else 0.0
+
+    def start(self):
+        if self._worker is None or self._worker.done():
+            self._event = asyncio.Event()
+            self._global = TokenBucket(rate=self.global_rate, capacity=self.global_rate, now=self.loop.time())
+            self._worker = self.loop.create_task(self._run())
+
+    async def close(self, timeout: float = 5.0):
+        """ Дождаться отправки всего, что уже в очереди, и остановить обработчик. Что не отправлено
+            за ``timeout`` секунд (например, очередь в группу с лимитом 20 в минуту), отбрасывается.
+        """
+        deadline = self.loop.time() + timeout
+        while (self.depth or self._in_flight) and self.loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        if self.depth:
+            log.warning(f'Drop {self.depth} queued messages on shutdown')
+            self._drop()
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+    async def send(self, chat_id: int, call: Callable[[], Awaitable], priority: int = PRIORITY_REPLY) -> Any:
+        """Поставить ``call()`` в очередь и вернуть его результат после отправки."""
+        self.start()
+        now = self.loop.time()
+        job = _Job(
+            chat_id=chat_id,
+            call=call,
+            priority=priority,
+            seq=next(self._seq),
+            future=self.loop.create_future(),
+            enqueued_at=now,
+        )
+        self._push(job=job, now=now)
+        return await job.future
+
+    def _drop(self):
+        """Отменить все сообщения в очереди: их ``send`` завершится ``CancelledError``."""
+        for chat in self._chats.values():
+            for _, _, job in chat.jobs:
+                job.future.cancel()
+            chat.jobs.clear()
+            chat.gen += 1
+        self.dropped += self.depth
+        self.depth = 0
+        self.depth_by_priority.clear()
+        self._ready.clear()
+        self._waiting.clear()
+
+    def _bucket(self, chat_id: int, now: float) -> TokenBucket:
+        # Отрицательные chat_id у групп и каналов
+        if chat_id < 0:
+            return TokenBucket(rate=self.group_rate, capacity=self.group_burst, now=now)
+        return TokenBucket(rate=self.chat_rate, capacity=self.chat_burst, now=now)
+
+    def _chat(self, chat_id: int, now: float) -> _Chat:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if len(self._chats) >= self.max_idle_chats:
+                self._prune(now=now)
+            chat = self._chats[chat_id] = _Chat(bucket=self._bucket(chat_id=chat_id, now=now))
+        return chat
+
+    def _push(self, job: _Job, now: float):
+        chat = self._chat(chat_id=job.chat_id, now=now)
+        entry = (job.priority, job.seq, job)
+        heapq.heappush(chat.jobs, entry)
+        self.depth += 1
+        self.depth_by_priority[job.priority] = self.depth_by_priority.get(job.priority, 0) + 1
+        if chat.jobs[0] is entry:
+            self._schedule(chat_id=job.chat_id, chat=chat, now=now)
+        self._event.set()
+
+    def _schedule(self, chat_id: int, chat: _Chat, now: float):
+        """Поставить чат в ready или waiting по его голове очереди."""
+        chat.gen += 1
+        if not chat.jobs:
+            return
+        delay = chat.bucket.delay(now)
+        if delay <= 0:
+            priority, seq, _ = chat.jobs[0]
+            heapq.heappush(self._ready, (priority, seq, chat.gen, chat_id))
+        else:
+            heapq.heappush(self._waiting, (now + delay, chat.gen, chat_id))
+
+    def _wake(self, now: float):
+        while self._waiting and self._waiting[0][0] <= now:
+            _, gen, chat_id = heapq.heappop(self._waiting)
+            chat = self._chats.get(chat_id)
+            if chat is not None and chat.gen == gen:
+                self._schedule(chat_id=chat_id, chat=chat, now=now)
+
+    def _prune(self, now: float):
+        idle = [chat_id for chat_id, chat in self._chats.items() if not chat.jobs and chat.bucket.is_full(now)]
+        for chat_id in idle:
+            del self._chats[chat_id]
+
+    async def _run(self):
+        while True:
+            now = self.loop.time()
+            self._wake(now=now)
+
+            if not self._ready:
+                timeout = self._waiting[0][0] - now if self._waiting else None
+                self._event.clear()
+                try:
+                    await asyncio.wait_for(self._event.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            delay = self._global.delay(now)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            _, _, gen, chat_id = heapq.heappop(self._ready)
+            chat = self._chats.get(chat_id)
+            if chat is None or chat.gen != gen:
+                continue
+            if chat.bucket.delay(now) > 0:
+                self._schedule(chat_id=chat_id, chat=chat, now=now)
+                continue
+
+            _, _, job = heapq.heappop(chat.jobs)
+            self.depth -= 1
+            self.depth_by_priority[job.priority] -= 1
+            chat.bucket.take(now)
+            self._global.take(now)
+            self._schedule(chat_id=chat_id, chat=chat, now=now)
+
+            wait = now - job.enqueued_at
+            self.dispatched += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+            task = self.loop.create_task(self._execute(job=job))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _execute(self, job: _Job):
+        try:
+            result = await job.call()
+        except RetryAfter as e:
+            self.retried += 1
+            if job.attempts >= self.max_retries:
+                self.failed += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+                return
+            log.warning(f'Flood control for chat {job.chat_id}, retry in {e.timeout} sec')
+            job.attempts += 1
+
+            now = self.loop.time()
+            self._chat(chat_id=job.chat_id, now=now).bucket.block(until=now + e.timeout)
+            self._push(job=job, now=now)
+            return
+        except Exception as e:
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+            return
+
+        self.sent += 1
+        if not job.future.done():
+            job.future.set_result(result)
@@ -0,0 +1,210 @@
+""" Бинарный формат снимка таблицы рекордов.
+
+    Файл состоит из заголовка и колонок фиксированной ширины, за которыми идёт таблица строк:
+
+        header      magic, version, count
+        chat_id     count * int64
+        score       count * int64
+        created_at  count * float64
+        name_offset (count + 1) * uint64, смещения в таблице строк
+        names       utf-8 строки ``full_name`` подряд
+
+    Все числа little-endian. Колонки читаются прямо из ``mmap`` без разбора файла целиком,
+    а ``LeaderItem`` создаётся только для запрошенной строки.
+
+    Конвертация из текущих JSON файлов и обратно::
+
+        python -m src.utils.snapshot to-bin src/last_day.json src/last_day.bin
+        python -m src.utils.snapshot to-json src/last_day.bin src/last_day.json
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections import abc
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+MAGIC = b'BDSN'
+VERSION = 1
+HEADER = struct.Struct('<4sHxxQ')
+
+Row = Tuple[int, str, int, float]
+
+
+def write_snapshot(path: str, rows: Iterable[Row]):
+    """Записать строки (chat_id, full_name, score, created_at) в бинарный снимок."""
+    chat_ids = array('q')
+    scores = array('q')
+    created_ats = array('d')
+    offsets = array('Q', [0])
+    names = bytearray()
+    for chat_id, full_name, score, created_at in rows:
+        chat_ids.append(chat_id)
+        scores.append(score)
+        created_ats.append(created_at)
+        names += full_name.encode('utf-8')
+        offsets.append(len(names))
+
+    if sys.byteorder != 'little':
+        for column in (chat_ids, scores, created_ats, offsets):
+            column.byteswap()
+
+    with open(path, 'wb') as fp:
+        fp.write(HEADER.pack(MAGIC, VERSION, len(chat_ids)))
+        for column in (chat_ids, scores, created_ats, offsets):
+            column.tofile(fp)
+        fp.write(names)
+        fp.flush()
+        os.fsync(fp.fileno())
+
+
+class SnapshotReader(abc.Sequence):
+    """ Снимок, отображённый в память. Индексация возвращает ``klass`` для одной строки,
+        колонки ``chat_ids``, ``scores`` и ``created_ats`` доступны без копирования.
+    """
+
+    def __init__(self, path: str, klass: Callable[..., Any]):
+        self.path = path
+        self.klass = klass
+        self._fp = open(path, 'rb')
+        self._mm = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._views: List[memoryview] = []
+
+        magic, version, count = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f'{path} is not a snapshot file')
+        self.count = count
+
+        offset = HEADER.size
+        self.chat_ids = self._column(offset, 'q', count)
+        offset += 8 * count
+        self.scores = self._column(offset, 'q', count)
+        offset += 8 * count
+        self.created_ats = self._column(offset, 'd', count)
+        offset += 8 * count
+        self.name_offsets = self._column(offset, 'Q', count + 1)
+        self._names_start = offset + 8 * (count + 1)
+
+    def _column(self, offset: int, typecode: str, count: int):
+        view = memoryview(self._mm)[offset:offset + 8 * count]
+        if sys.byteorder != 'little':
+            column = array(typecode)
+            column.frombytes(view)
+            column.byteswap()
+            view.release()
+            return column
+        column = view.cast(typecode)
+        self._views.extend([view, column])
+        return column
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index: int) -> Any:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.count))]
+        chat_id, full_name, score, created_at = self.row(index)
+        return self.klass(chat_id=chat_id, full_name=full_name, score=score, created_at=created_at)
+
+    def __iter__(self) -> Iterator[Any]:
+        for inx in range(self.count):
+            yield self[inx]
+
+    def full_name(self, index: int) -> str:
+        start = self._names_start + self.name_offsets[index]
+        end = self._names_start + self.name_offsets[index + 1]
+        return self._mm[start:end].decode('utf-8')
+
+    def row(self, index: int) -> Row:
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('snapshot index out of range')
+        return self.chat_ids[index], self.full_name(index), self.scores[index], self.created_ats[index]
+
+    def rows(self) -> Iterator[Row]:
+        for inx in range(self.count):
+            yield self.row(inx)
+
+    def close(self):
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self._mm.close()
+        self._fp.close()
+
+
+class SnapshotRows(abc.Sequence):
+    """ Строки снимка с наложенными изменениями из журнала. Элемент ``entries`` -
+        либо номер строки в снимке, либо уже готовый объект; ``None`` значит все строки снимка по порядку.
+    """
+
+    def __init__(self, reader: Optional[SnapshotReader], entries: Optional[list] = None):
+        self.reader = reader
+        self.entries = entries
+
+    def __len__(self) -> int:
+        if self.entries is not None:
+            return len(self.entries)
+        return len(self.reader) if self.reader is not None else 0
+
+    def __getitem__(self, index: int) -> Any:
+        entry = self.entry(index)
+        if isinstance(entry, int):
+            return self.reader[entry]
+        return entry
+
+    def __iter__(self) -> Iterator[Any]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def entry(self, index: int) -> Any:
+        return index if self.entries is None else self.entries[index]
+
+    def fields(self, index: int) -> Tuple[int, int, float]:
+        """(chat_id, score, created_at) строки без создания объекта."""
+        entry = self.entry(index)
+        if isinstance(entry, int):
+            reader = self.reader
+            return reader.chat_ids[entry], reader.scores[entry], reader.created_ats[entry]
+        return entry.chat_id, entry.score, entry.created_at
+
+
+def json_to_snapshot(json_path: str, snapshot_path: str):
+    with open(json_path, 'r') as fp:
+        data = json.load(fp=fp)
+    write_snapshot(
+        path=snapshot_path,
+        rows=((i['chat_id'], i['full_name'], i['score'], i['created_at']) for i in data),
+    )
+
+
+def snapshot_to_json(snapshot_path: str, json_path: str):
+    reader = SnapshotReader(path=snapshot_path, klass=dict)
+    try:
+        data = list(reader)
+    finally:
+        reader.close()
+    with open(json_path, 'w') as fp:
+        json.dump(obj=data, fp=fp)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert leader board storage between JSON and binary snapshot.')
+    parser.add_argument('command', choices=['to-bin', 'to-json'])
+    parser.add_argument('source')
+    parser.add_argument('target')
+    args = parser.parse_args()
+
+    if args.command == 'to-bin':
+        json_to_snapshot(json_path=args.source, snapshot_path=args.target)
+    else:
+        snapshot_to_json(snapshot_path=args.source, json_path=args.target)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,37 +1,316 @@
 import json
+import logging
 import os
-from dataclasses import is_dataclass, asdict
-from typing import Any, List
+import shutil
+import threading
+from dataclasses import asdict, astuple
+from functools import partial
+from typing import Any, Callable, Iterable, List, Optional, Sequence, Tuple
+
+from src.utils.snapshot import SnapshotReader, SnapshotRows, json_to_snapshot, write_snapshot
+
+
+log = logging.getLogger(__name__)
+
+# Операции журнала
+JOURNAL_PUT = 'put'
+JOURNAL_DELETE = 'del'
+JOURNAL_CLEAR = 'clear'
+
+# Форматы снимка
+FORMAT_JSON = 'json'
+FORMAT_BIN = 'bin'
 
 
 class Storage:
     """ Хранилище для сбрасывания более-менее важной информации на диск.
         Данный бот не предполагает никакой нагрузки или сложной логики, поэтому просто сохраним
         промежуточные результаты для более мягкого деплоя.
+
+        В режиме журнала (``journal=True``) каждое изменение дописывается одной строкой
+        в ``<filename>.journal``, а полный снимок пишется только при сжатии журнала.
+        ``load`` восстанавливает состояние как снимок + журнал.
+
+        Формат ``bin`` хранит снимок в бинарном виде (см. ``src.utils.snapshot``) и подходит
+        только для записей с полями ``LeaderItem``. ``load`` тогда возвращает ленивый ``SnapshotRows``.
+
+        С ``read_only`` файлы, которые ещё пишет другой процесс, только читаются: недописанная
+        запись журнала не отрезается, а то, что он допишет позже, можно дочитать ``read_tail``.
     """
-    def __init__(self, filename: str, klass, base_path: str = None, dry_run: bool = False):
+    def __init__(self, filename: str, klass, base_path: str = None, dry_run: bool = False,
+                 journal: bool = False, key: str = 'chat_id', compact_every: int = 10000, fmt: str = FORMAT_JSON,
+                 read_only: bool = False):
         self.base_path = base_path or os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
-        self.filename = f'{filename}.json'
+        self.fmt = fmt
+        self.filename = f'{filename}.{fmt}'
         self.path = os.path.join(self.base_path, self.filename)
+        self.json_path = os.path.join(self.base_path, f'{filename}.json')
+        self.journal_path = os.path.join(self.base_path, f'{filename}.journal')
+        # Журнал, который сейчас сжимается в снимок
+        self.compact_path = f'{self.journal_path}.compact'
         self.klass = klass
         self.dry_run = dry_run
 
+        # Журнал
+        self.journal = journal
+        self.key = key
+        self.compact_every = compact_every
+        self.journal_size = 0
+        self._journal_fp = None
+        self._compacting = False
+        # Снимок могут писать два потока сразу (сохранение и вытеснение таблицы): временный файл один
+        self._write_lock = threading.Lock()
+
+        # Что было прочитано в ``load``: снимок, журнал и сколько байт журнала
+        self.read_only = read_only
+        self._loaded_snapshot: Optional[Tuple[int, int, int]] = None
+        self._loaded_journal: Optional[int] = None
+        self.journal_offset = 0
+
     def save(self, objs: List[Any]):
-        assert all([is_dataclass(i) for i in objs]), 'Only dataclasses allowed here!'
+        """Записать полный снимок: сначала во временный файл, потом атомарно переименовать."""
         if self.dry_run:
             return
 
-        data = [asdict(i) for i in objs]
-        with open(self.path, 'w+') as fp:
-            json.dump(obj=data, fp=fp)
+        self._write_snapshot(objs=objs)
+        if self.journal:
+            # Всё из журнала уже попало в снимок
+            self.close()
+            open(self.journal_path, 'w').close()
+            self.journal_size = 0
+
+    def _write_snapshot(self, objs: Iterable[Any]):
+        """ ``objs`` - датаклассы или снимок с методом ``rows()`` (см. ``BoardColumns``),
+            из которого бинарный формат пишется без создания объектов.
+        """
+        tmp_path = f'{self.path}.tmp'
+        with self._write_lock:
+            if self.fmt == FORMAT_BIN:
+                rows = objs.rows() if hasattr(objs, 'rows') else (astuple(i) for i in objs)
+                write_snapshot(path=tmp_path, rows=rows)
+            else:
+                data = [asdict(i) for i in objs]
+                with open(tmp_path, 'w') as fp:
+                    json.dump(obj=data, fp=fp)
+                    fp.flush()
+                    os.fsync(fp.fileno())
+            os.replace(tmp_path, self.path)
+
+    def append(self, op: str, obj: Any = None):
+        """Дописать одну операцию в журнал."""
+        if not self.journal or self.dry_run:
+            return
+
+        record = {'op': op}
+        if obj is not None:
+            record['obj'] = asdict(obj)
+        if self._journal_fp is None:
+            self._journal_fp = open(self.journal_path, 'a')
+        self._journal_fp.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.journal_size += 1
+
+    def flush(self, objs: List[Any]):
+        """ Сохранить состояние. В режиме журнала полный снимок пишется только
+            когда журнал вырос больше ``compact_every`` записей.
+        """
+        self.begin_flush(get_objs=lambda: objs)()
 
-    def load(self) -> List[Any]:
+    def begin_flush(self, get_objs: Callable[[], Iterable[Any]]) -> Callable[[], None]:
+        """ Подготовить сохранение и вернуть его блокирующую часть (запись снимка, fsync).
+
+            Подготовка быстрая и выполняется там же, где меняются данные. Возвращённую функцию
+            можно выполнить в другом потоке: новые записи журнала тем временем идут в новый файл.
+            Поэтому ``get_objs`` должна вернуть копию, которую дальнейшие изменения не затронут.
+        """
         if self.dry_run:
-            return []
+            return _noop
+        if not self.journal:
+            return partial(self._write_snapshot, get_objs())
+
+        if self.journal_size >= self.compact_every and not self._compacting:
+            objs = get_objs()
+            # Текущий журнал откладывается до записи снимка и удаляется после неё
+            self.close()
+            if os.path.isfile(self.journal_path):
+                os.replace(self.journal_path, self.compact_path)
+            open(self.journal_path, 'w').close()
+            self.journal_size = 0
+            self._compacting = True
+            return partial(self._compact, objs)
 
-        if not os.path.isfile(self.path):
+        return self.begin_sync()
+
+    @property
+    def journaled(self) -> bool:
+        """Изменения дописываются в журнал, так что ``begin_sync`` делает их сохранёнными."""
+        return self.journal and not self.dry_run
+
+    def begin_sync(self) -> Callable[[], None]:
+        """Только дописать журнал на диск, без снимка: подготовка - сбросить буфер, блокирующая часть - fsync."""
+        if self._journal_fp is None:
+            return _noop
+        self._journal_fp.flush()
+        return partial(_fsync, os.dup(self._journal_fp.fileno()))
+
+    def _compact(self, objs: Iterable[Any]):
+        try:
+            self._write_snapshot(objs=objs)
+            if os.path.isfile(self.compact_path):
+                os.remove(self.compact_path)
+        finally:
+            self._compacting = False
+
+    def close(self):
+        if self._journal_fp is not None:
+            self._journal_fp.close()
+            self._journal_fp = None
+
+    def load(self) -> Sequence[Any]:
+        if self.dry_run:
             return []
-        with open(self.path, 'r') as fp:
-            data = json.load(fp=fp)
+
+        self._loaded_snapshot = _identity(self.path)
+        self._loaded_journal = None
+        self.journal_offset = 0
+        if self.journal and os.path.isfile(self.compact_path) and not self.read_only:
+            self._restore_compact()
+
+        if self.fmt == FORMAT_BIN:
+            return self._load_snapshot()
+
+        data = []
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as fp:
+                data = json.load(fp=fp)
+
+        if self.journal and os.path.isfile(self.journal_path):
+            items = self._replay(items={i[self.key]: i for i in data})
+            data = list(items.values())
+
         res = [self.klass(**i) for i in data]
         return res
+
+    def _restore_compact(self):
+        """Сжатие не успело записать снимок: вернуть отложенный журнал в начало текущего."""
+        log.warning(f'Restore unfinished compaction of {self.journal_path}')
+        tmp_path = f'{self.journal_path}.tmp'
+        with open(tmp_path, 'wb') as dst:
+            for path in (self.compact_path, self.journal_path):
+                if os.path.isfile(path):
+                    with open(path, 'rb') as src:
+                        shutil.copyfileobj(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp_path, self.journal_path)
+        os.remove(self.compact_path)
+
+    def _load_snapshot(self) -> SnapshotRows:
+        if not os.path.isfile(self.path) and os.path.isfile(self.json_path):
+            # Переезд со старого JSON хранилища
+            log.info(f'Convert {self.json_path} to {self.path}')
+            json_to_snapshot(json_path=self.json_path, snapshot_path=self.path)
+
+        reader = None
+        if os.path.isfile(self.path):
+            reader = SnapshotReader(path=self.path, klass=self.klass)
+        if not self.journal or not os.path.isfile(self.journal_path):
+            return SnapshotRows(reader=reader)
+
+        # Строки снимка остаются номерами строк, объекты создаются только для записей журнала
+        items = {}
+        if reader is not None:
+            items = {chat_id: inx for inx, chat_id in enumerate(reader.chat_ids)}
+        items = self._replay(items=items)
+        entries = [i if isinstance(i, int) else self.klass(**i) for i in items.values()]
+        return SnapshotRows(reader=reader, entries=entries)
+
+    def _replay(self, items: dict) -> dict:
+        self.journal_size = 0
+        if self.read_only and os.path.isfile(self.compact_path):
+            # Другой процесс сейчас сжимает журнал: отложенная часть идёт перед текущей
+            items = self._replay_file(path=self.compact_path, items=items)
+        return self._replay_file(path=self.journal_path, items=items)
+
+    def _replay_file(self, path: str, items: dict) -> dict:
+        offset = 0
+        with open(path, 'rb') as fp:
+            self._loaded_journal = os.fstat(fp.fileno()).st_ino
+            for line in fp:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('incomplete record')
+                    record = json.loads(line)
+                except ValueError:
+                    # Недописанная при падении последняя строка: отрезать её,
+                    # чтобы новые записи не склеились с мусором
+                    if not self.read_only:
+                        log.warning(f'Truncate broken journal record in {path}')
+                    break
+                offset += len(line)
+
+                op = record['op']
+                if op == JOURNAL_PUT:
+                    obj = record['obj']
+                    items.pop(obj[self.key], None)
+                    items[obj[self.key]] = obj
+                elif op == JOURNAL_DELETE:
+                    items.pop(record['obj'][self.key], None)
+                elif op == JOURNAL_CLEAR:
+                    items = {}
+                self.journal_size += 1
+
+        if offset != os.path.getsize(path) and not self.read_only:
+            os.truncate(path, offset)
+        self.journal_offset = offset
+        return items
+
+    def read_tail(self) -> Optional[List[Tuple[str, Any]]]:
+        """ Операции журнала ``(op, obj)``, которые другой процесс дописал после ``load``.
+            None, если с тех пор снимок или журнал переписаны целиком и нужен новый ``load``.
+        """
+        if self.dry_run or not self.journal:
+            return []
+        if _identity(self.path) != self._loaded_snapshot or os.path.isfile(self.compact_path):
+            return None
+        journal = _identity(self.journal_path)
+        if journal is None:
+            return [] if self.journal_offset == 0 else None
+        if self._loaded_journal is not None and journal[0] != self._loaded_journal:
+            return None
+        if journal[2] < self.journal_offset:
+            return None
+
+        res = []
+        with open(self.journal_path, 'rb') as fp:
+            self._loaded_journal = os.fstat(fp.fileno()).st_ino
+            fp.seek(self.journal_offset)
+            for line in fp:
+                if not line.endswith(b'\n'):
+                    # Другой процесс не дописал запись: её разберёт полный ``load``
+                    return None
+                record = json.loads(line)
+                obj = self.klass(**record['obj']) if 'obj' in record else None
+                res.append((record['op'], obj))
+                self.journal_offset += len(line)
+                self.journal_size += 1
+        return res
+
+
+def _noop():
+    pass
+
+
+def _identity(path: str) -> Optional[Tuple[int, int, int]]:
+    """(inode, mtime, размер) файла: меняется, если файл переписан или заменён."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _fsync(fd: int):
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,101 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+from typing import List, Optional
+
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+
+
+log = logging.getLogger(__name__)
+
+# Telegram присылает в этом заголовке ``secret_token`` из ``setWebhook``
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def secret_from_token(token: str) -> str:
+    """Секрет webhook по умолчанию: его знают только Telegram и тот, у кого есть токен бота."""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class WebhookServer:
+    """ Приём обновлений от Telegram через webhook.
+
+        Обновление сразу кладётся в ограниченную очередь и Telegram получает ``200``, не дожидаясь
+        обработчика. Обновления разбирают ``concurrency`` воркеров. Если очередь полна, сервер
+        отвечает ``503`` и Telegram пришлёт обновление позже - так обработчики, которые не успевают,
+        притормаживают приём вместо бесконечного роста очереди.
+
+        Запросы без заголовка ``SECRET_HEADER`` с ``secret_token`` отклоняются с ``403``: иначе
+        любой, кто достучится до порта, сможет прислать обновление от имени любого пользователя.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, secret_token: str, path: str = '/webhook', concurrency: int = 64,
+                 max_queue: int = 1024):
+        self.dispatcher = dispatcher
+        self.secret_token = secret_token
+        self.path = path
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.queue: Optional[asyncio.Queue] = None
+        self.workers: List[asyncio.Task] = []
+
+        # Метрики
+        self.accepted = 0
+        self.rejected = 0
+        self.forbidden = 0
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0
+
+    def make_app(self, app: Optional[web.Application] = None) -> web.Application:
+        app = app or web.Application()
+        app.router.add_post(self.path, self.handle)
+        app.on_startup.append(self.on_startup)
+        app.on_shutdown.append(self.on_shutdown)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret_token):
+            self.forbidden += 1
+            return web.Response(status=403)
+        try:
+            update = types.Update(**await request.json())
+        except (ValueError, TypeError):
+            return web.Response(status=400)
+        if self.queue is None or self.queue.full():
+            self.rejected += 1
+            return web.Response(status=503)
+
+        self.queue.put_nowait(update)
+        self.accepted += 1
+        return web.Response()
+
+    async def on_startup(self, app: web.Application):
+        # Воркеры наследуют контекст, в котором aiogram ищет текущего бота и диспетчер
+        Bot.set_current(self.dispatcher.bot)
+        Dispatcher.set_current(self.dispatcher)
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self.workers = [asyncio.ensure_future(self.worker()) for _ in range(self.concurrency)]
+
+    async def on_shutdown(self, app: web.Application):
+        await self.queue.join()
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    async def worker(self):
+        while True:
+            update = await self.queue.get()
+            self.busy += 1
+            try:
+                await self.dispatcher.process_update(update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                log.error(f'Exception while processing update {update.update_id}: {e}')
+            finally:
+                self.busy -= 1
+                self.queue.task_done()